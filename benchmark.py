@@ -0,0 +1,531 @@
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from xml.sax.saxutils import escape, quoteattr
+
+import main
+from main import align_sorted_columns
+
+
+# sizes of today's pn metadata exports (pn_metadata.xml, pn__metadata.xml), scaled by --scales.
+base_study_event_defs = 3
+base_signing_unit_defs = 35
+base_item_group_defs = 50
+base_item_refs = 300
+item_group_refs_per_signing_unit = 8
+code_list_defs_per_signing_unit = 1.5
+
+# every benchmark run is appended here so runs can be compared over time.
+benchmark_results_file_name = "benchmark_results.jsonl"
+
+
+# ---------------------------------------- alignment
+
+
+def generate_kdig_kdit_columns(row_count, mismatch_rate=0.05, seed=0):
+    """
+    returns two unsorted kdig-->kdit / ig-->it columns of roughly row_count rows.
+    mismatch_rate of the rows only exist on one side.
+    """
+    rnd = random.Random(seed)
+    kdig_kdit_column = []
+    ig_it_column = []
+    for row in range(row_count):
+        value = "IG{0:06d}-->IT{1:08d}".format(row // 20, row)
+        roll = rnd.random()
+        if roll < mismatch_rate / 2:
+            kdig_kdit_column.append(value)
+        elif roll < mismatch_rate:
+            ig_it_column.append(value)
+        else:
+            kdig_kdit_column.append(value)
+            ig_it_column.append(value)
+
+    rnd.shuffle(kdig_kdit_column)
+    rnd.shuffle(ig_it_column)
+
+    return kdig_kdit_column, ig_it_column
+
+
+def benchmark_alignment(row_counts, mismatch_rate):
+    """
+    times sorting + align_sorted_columns for each row count.
+    """
+    print("------------------------------- align_sorted_columns -------------------------------")
+    print("{:>10} {:>12} {:>12} {:>14}".format("rows", "sort (s)", "align (s)", "align us/row"))
+    for row_count in row_counts:
+        kdig_kdit_column, ig_it_column = generate_kdig_kdit_columns(row_count, mismatch_rate)
+
+        start = time.perf_counter()
+        kdig_kdit_column = sorted(kdig_kdit_column)
+        ig_it_column = sorted(ig_it_column)
+        sort_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        aligned_kdig_kdit, aligned_ig_it = align_sorted_columns(kdig_kdit_column, ig_it_column)
+        align_time = time.perf_counter() - start
+
+        assert len(aligned_kdig_kdit) == len(aligned_ig_it)
+        print("{:>10} {:>12.4f} {:>12.4f} {:>14.3f}".format(row_count, sort_time, align_time, align_time / row_count * 1e6))
+
+
+# ---------------------------------------- synthetic pn metadata / ods export
+
+
+def generate_pn_metadata(pn_metadata_file_name, study_event_defs, signing_unit_defs, item_group_defs, item_refs, protocols=("BENCH-001",), seed=0):
+    """
+    writes a synthetic Study/MetaData/DataDictionary document shaped like a real pn metadata export.
+    the LogPad StudyEventDef references every generated signing unit plus the excluded admin ones, the other
+    StudyEventDefs reference a sample of them. item_refs are spread evenly over the item groups.
+    returns (kdSU_name_map, kdSU_kdIG_kdIT_map) as the checker will read them back, excluded kdSU/kdIG left out.
+    """
+    rnd = random.Random(seed)
+    kdSU_values = ["SU{0:05d}".format(su) for su in range(signing_unit_defs)]
+    kdIG_values = ["IG{0:05d}".format(ig) for ig in range(item_group_defs)]
+    kdIG_kdIT_map = dict((kdIG, []) for kdIG in kdIG_values)
+    for it in range(item_refs):
+        kdIG_kdIT_map[kdIG_values[it % item_group_defs]].append("IT{0:06d}".format(it))
+
+    kdSU_name_map = {}
+    kdSU_kdIG_kdIT_map = {}
+    signing_unit_item_groups = {}
+    for kdSU in kdSU_values:
+        kdIG_list = rnd.sample(kdIG_values, min(item_group_refs_per_signing_unit, item_group_defs))
+        signing_unit_item_groups[kdSU] = kdIG_list
+        kdSU_name_map[kdSU] = "Signing Unit {}".format(kdSU[2:])
+        kdSU_kdIG_kdIT_map[kdSU] = dict((kdIG, kdIG_kdIT_map[kdIG]) for kdIG in kdIG_list)
+    # the admin signing units and item groups every real export carries, and the checker skips.
+    admin_kdSU_values = main.kdSU_exclusion_list[:5]
+    for kdSU in admin_kdSU_values:
+        signing_unit_item_groups[kdSU] = kdIG_values[:2]
+    admin_kdIG_values = main.kdIG_exclusion_list[:3]
+
+    def item_ref(kdIT, order):
+        return ('        <ItemRef ID="LogPad.ItemRef.{0}" CarryInRepeatingGroup="No" CodeListDisplay="None" CountInMetrics="Yes" InPrimaryKey="No" LabelLoc="Left" '
+                'NullPermitted="Yes" ItemDefID="LogPad.ItemDef.{0}" Name={1} SequenceOrder="{2}" Stored="Yes" SysVar="None" UIControl="TextBox" kdIT={1}>\n'
+                '          <Question>\n            <TranslatableText>{3}</TranslatableText>\n          </Question>\n'
+                '        </ItemRef>\n').format(kdIT[2:], quoteattr(kdIT), order, "Question for {}".format(kdIT))
+
+    with open(pn_metadata_file_name, 'w') as f:
+        f.write('<Study IDPrefix="LogPad" Version="1">\n')
+        f.write('  <MetaData DTDHeaderVersion="1056" DesignerVersion="715" Version="1">\n')
+        f.write('    <Identification SponsorStudyName={0} Title={0}>\n      <Description>{1}</Description>\n    </Identification>\n'.format(quoteattr(protocols[0]), escape(protocols[0])))
+        f.write('    <DataDictionary ID="LogPad.DataDictionary.1">\n')
+
+        f.write('      <CodeListDef ID="LogPad.CodeListDef.1" Name="Protocol" CodedValueType="Integer">\n')
+        f.write('        <CodeListItem CodedValue="-9999" Description="&lt;Unspecified Protocol&gt;"/>\n')
+        for count, protocol in enumerate(protocols):
+            f.write('        <CodeListItem CodedValue="{}" Description={}/>\n'.format(count, quoteattr(protocol)))
+        f.write('      </CodeListDef>\n')
+        for code_list in range(int(signing_unit_defs * code_list_defs_per_signing_unit)):
+            f.write('      <CodeListDef ID="LogPad.CodeListDef.{0}" Name="CodeList{0}" CodedValueType="Integer">\n'.format(code_list + 2))
+            for value in range(10):
+                f.write('        <CodeListItem CodedValue="{0}" Description="Value {0}"><Decode><TranslatableText>Value {0}</TranslatableText></Decode></CodeListItem>\n'.format(value))
+            f.write('      </CodeListDef>\n')
+
+        for it in range(item_refs):
+            f.write('      <ItemDef ID="LogPad.ItemDef.{0:06d}" DataType="Text" Name="IT{0:06d}" kdIT="IT{0:06d}" Length="50"><Question><TranslatableText>IT{0:06d}</TranslatableText></Question></ItemDef>\n'.format(it))
+
+        for kdIG in admin_kdIG_values:
+            f.write('      <ItemGroupDef ID="LogPad.ItemGroupDef.{0}" ItemGroupRole="None" kdIG="{0}" Name="{0}">\n'.format(kdIG))
+            f.write(item_ref("IT{}".format(kdIG), 1))
+            f.write('      </ItemGroupDef>\n')
+        for kdIG in kdIG_values:
+            f.write('      <ItemGroupDef ID="LogPad.ItemGroupDef.{0}" ItemGroupRole="None" ItemGroupStyle="SingleColumnInTable" kdIG="{1}" Name="Item Group {0}">\n'.format(kdIG[2:], kdIG))
+            for order, kdIT in enumerate(kdIG_kdIT_map[kdIG]):
+                f.write(item_ref(kdIT, order + 1))
+            f.write('      </ItemGroupDef>\n')
+
+        for kdSU, kdIG_list in signing_unit_item_groups.items():
+            f.write('      <SigningUnitDef ID="LogPad.SigningUnitDef.{0}" kdSU="{0}" Name={1}>\n'.format(kdSU, quoteattr(kdSU_name_map.get(kdSU, kdSU))))
+            for kdIG in admin_kdIG_values + kdIG_list:
+                f.write('        <ItemGroupRef ID="LogPad.ItemGroupRef.{0}.{1}" ItemGroupStyle="SingleColumnInTable" HeaderType="None" kdIG="{1}" Name="{1}"/>\n'.format(kdSU, kdIG))
+            f.write('      </SigningUnitDef>\n')
+
+        for study_event in range(study_event_defs):
+            kdSE = "LogPad" if study_event == 0 else "Visit{}".format(study_event)
+            kdSU_list = admin_kdSU_values + kdSU_values if study_event == 0 else rnd.sample(kdSU_values, len(kdSU_values) // 3)
+            f.write('      <StudyEventDef EventType="None" ID="LogPad.StudyEventDef.{0}" Name="{1}" kdSE="{1}">\n'.format(study_event, kdSE))
+            for kdSU in kdSU_list:
+                f.write('        <SigningUnitRef ID="LogPad.SigningUnitRef.{0}.{1}" SigningUnitDefID="LogPad.SigningUnitDef.{1}" kdSU="{1}"/>\n'.format(study_event, kdSU))
+            f.write('      </StudyEventDef>\n')
+
+        f.write('    </DataDictionary>\n')
+
+        # the Protocol section after the data dictionary is as large as a third of it, and the checker never reads it.
+        f.write('    <Protocol ID="LogPad.Protocol.1">\n')
+        for kdSU in kdSU_values:
+            for visit in range(10):
+                f.write('      <ScheduleRef ID="LogPad.ScheduleRef.{0}.{1}" SigningUnitDefID="LogPad.SigningUnitDef.{0}" Mandatory="No" OrderNumber="{1}" Window="P1D"/>\n'.format(kdSU, visit))
+        f.write('    </Protocol>\n  </MetaData>\n</Study>\n')
+
+    return kdSU_name_map, kdSU_kdIG_kdIT_map
+
+
+def generate_ods_export(ods_file_name, kdSU_name_map, kdSU_kdIG_kdIT_map, mismatch_rate=0.05, seed=0):
+    """
+    writes the study designer ODS export (a questionnaires json) of the generated study.
+    mismatch_rate of the signing units, item groups and items are renamed, dropped or added on the study designer side.
+    """
+    rnd = random.Random(seed)
+
+    def mismatch(value, suffix):
+        return value + suffix if rnd.random() < mismatch_rate else value
+
+    with open(ods_file_name, 'w') as f:
+        f.write('{"studyName": "synthetic", "questionnaires": [')
+        first = True
+        for kdSU in kdSU_name_map:
+            if rnd.random() < mismatch_rate / 3:
+                continue
+            items = []
+            for kdIG, kdIT_list in kdSU_kdIG_kdIT_map[kdSU].items():
+                ig = mismatch(kdIG, "X")
+                for kdIT in kdIT_list:
+                    if rnd.random() < mismatch_rate / 3:
+                        continue
+                    items.append({"id": len(items), "type": "question", "ig": ig, "it": mismatch(kdIT, "Z"), "includeInReports": rnd.random() < 0.7})
+                if rnd.random() < mismatch_rate:
+                    items.append({"id": len(items), "type": "question", "ig": kdIG, "it": "Extra{}".format(kdIT_list[0] if kdIT_list else kdIG), "includeInReports": True})
+            items.append({"id": len(items), "type": "header", "ig": "-", "it": "Header", "includeInReports": False})
+            questionnaire = {"su": mismatch(kdSU, "X") if rnd.random() < mismatch_rate / 3 else kdSU, "name": mismatch(kdSU_name_map[kdSU], " v2"), "items": items}
+            f.write(('' if first else ', ') + json.dumps(questionnaire))
+            first = False
+        f.write(']}')
+
+
+def generate_study(directory, scale, mismatch_rate=0.05, seed=0):
+    """
+    writes <directory>/bench_<scale>x.xml and its ODS export at scale times today's sizes.
+    returns (pn_metadata_file_name, ods_file_name, protocol).
+    """
+    protocol = "BENCH-{}X".format(scale)
+    pn_metadata_file_name = os.path.join(directory, "bench_{}x.xml".format(scale))
+    ods_file_name = os.path.join(directory, "bench_{}x.ods.json".format(scale))
+    kdSU_name_map, kdSU_kdIG_kdIT_map = generate_pn_metadata(pn_metadata_file_name, base_study_event_defs, int(base_signing_unit_defs * scale), int(base_item_group_defs * scale),
+                                                             int(base_item_refs * scale), (protocol,), seed)
+    generate_ods_export(ods_file_name, kdSU_name_map, kdSU_kdIG_kdIT_map, mismatch_rate, seed)
+
+    return pn_metadata_file_name, ods_file_name, protocol
+
+
+# ---------------------------------------- stand-in study designer api
+
+
+@contextlib.contextmanager
+def serve_study_designer(designs, exports, etags=False):
+    """
+    serves the designs list and the ODS exports (designId => file name) on a local port and points main at it.
+    with etags every response carries an ETag and a matching If-None-Match is answered with 304.
+    yields the list of (path, status) of the requests served so far.
+    """
+    served = []
+
+    class StudyDesignerHandler(BaseHTTPRequestHandler):
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path == '/api/v2/designs':
+                body = json.dumps(designs).encode('utf8')
+            elif self.path.startswith('/api/v1/json/export/') and self.path.split('/')[5] in exports:
+                with open(exports[self.path.split('/')[5]], 'rb') as f:
+                    body = f.read()
+            else:
+                served.append((self.path, 404))
+                self.send_response(404)
+                self.end_headers()
+                return
+            etag = '"{}"'.format(hashlib.sha256(body).hexdigest()[:16]) if etags else None
+            if etag is not None and self.headers.get('If-None-Match') == etag:
+                served.append((self.path, 304))
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+            served.append((self.path, 200))
+            self.send_response(200)
+            if etag is not None:
+                self.send_header('ETag', etag)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StudyDesignerHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    urls = main.study_designer_designs_url, main.study_designer_export_url
+    main.study_designer_designs_url = "http://127.0.0.1:{}/api/v2/designs".format(server.server_port)
+    main.study_designer_export_url = "http://127.0.0.1:{}/api/v1/json/export/{{0}}/ods".format(server.server_port)
+    try:
+        yield served
+    finally:
+        main.study_designer_designs_url, main.study_designer_export_url = urls
+        server.shutdown()
+        server.server_close()
+
+
+# ---------------------------------------- pipeline stages
+
+
+def time_call(function, repeat):
+    """
+    returns the best wall time of repeat calls of function and its last result. stdout is discarded while timing.
+    """
+    best_time = None
+    for run in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            result = function()
+            elapsed = time.perf_counter() - start
+        best_time = elapsed if best_time is None else min(best_time, elapsed)
+
+    return best_time, result
+
+
+def benchmark_stages(scales, stages, mismatch_rate, repeat, results_file_name=benchmark_results_file_name, record_results=True):
+    """
+    generates a synthetic study at each scale and times each stage of main.py on it.
+    every timing is printed and compared with the previous run recorded in results_file_name, and with record_results
+    appended to it.
+    """
+    previous_results = load_benchmark_results(results_file_name)
+    run = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+    }
+    records = []
+
+    print("------------------------------- pipeline stages -------------------------------")
+    print("{:>6} {:<24} {:>12} {:>10} {:>12}".format("scale", "stage", "seconds", "rows", "vs previous"))
+    working_directory = os.getcwd()
+    directory = tempfile.mkdtemp(prefix="metadata-checker-benchmark-")
+    try:
+        os.chdir(directory)
+        for scale in scales:
+            pn_metadata_file_name, ods_file_name, protocol = generate_study(directory, scale, mismatch_rate)
+            stage_functions = create_stage_functions(pn_metadata_file_name, ods_file_name, protocol)
+            designs = [{'protocol': [protocol], 'designId': 'bench@1'}]
+
+            with serve_study_designer(designs, {'bench@1': ods_file_name}):
+                for stage in stages:
+                    seconds, rows = time_call(stage_functions[stage], repeat)
+                    record = dict(run, scale=scale, stage=stage, seconds=round(seconds, 6), rows=rows,
+                                  pn_metadata_bytes=os.path.getsize(pn_metadata_file_name), ods_bytes=os.path.getsize(ods_file_name))
+                    records.append(record)
+
+                    previous = previous_results.get((scale, stage))
+                    change = "" if previous is None else "{:+.1f}%".format((seconds / previous['seconds'] - 1) * 100 if previous['seconds'] else 0)
+                    print("{:>6} {:<24} {:>12.4f} {:>10} {:>12}".format(scale, stage, seconds, "" if rows is None else rows, change))
+    finally:
+        os.chdir(working_directory)
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if record_results:
+        with open(results_file_name, 'a') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+        print("\nappended {} results to {}".format(len(records), results_file_name))
+
+    return records
+
+
+def create_stage_functions(pn_metadata_file_name, ods_file_name, protocol):
+    """
+    returns stage name => function running that stage on the generated study. each returns its row count,
+    or None for the end to end runs.
+    """
+    parsed = {}
+    rules = main.default_exclusion_rules()
+
+    def parse_streaming():
+        parsed['pn_metadata'] = main.create_pn_metadata_kdSU_kdIG_kdIT_dictionary_streaming(pn_metadata_file_name, rules)
+        return sum(len(kdIT_list) for kdIG_kdIT_map in parsed['pn_metadata'][2].values() for kdIT_list in kdIG_kdIT_map.values())
+
+    def parse_soup():
+        soup_datadictionary, pn_metadata_protocol = main.find_study_protocols(pn_metadata_file_name)
+        kdSU_name_map, kdSU_kdIG_kdIT_map = main.create_pn_metadata_kdSU_kdIG_kdIT_dictionary(main.index_pn_metadata(soup_datadictionary), rules)
+        return sum(len(kdIT_list) for kdIG_kdIT_map in kdSU_kdIG_kdIT_map.values() for kdIT_list in kdIG_kdIT_map.values())
+
+    def ods_streaming():
+        questionnaires = main.iter_json_array_items((chunk.decode('latin-1') for chunk in main.read_file_chunks(ods_file_name)), 'questionnaires')
+        parsed['ods'] = main.create_study_designer_su_ig_it_dictionary_streaming(questionnaires, rules)
+        return sum(len(items) for ig_it_map in parsed['ods'][1].values() for items in ig_it_map.values())
+
+    def ods_full():
+        with open(ods_file_name, 'rb') as f:
+            study_designer_json = json.loads(f.read().decode('latin-1').encode('utf8'))
+        su_name_map, su_ig_it_map = main.create_study_designer_su_ig_it_dictionary(study_designer_json, rules)
+        return sum(len(items) for ig_it_map in su_ig_it_map.values() for items in ig_it_map.values())
+
+    def ensure_parsed():
+        if 'pn_metadata' not in parsed:
+            parse_streaming()
+        if 'ods' not in parsed:
+            ods_streaming()
+
+    def diff():
+        ensure_parsed()
+        pn_metadata_protocol, kdSU_name_map, kdSU_kdIG_kdIT_map = parsed['pn_metadata']
+        su_name_map, su_ig_it_map = parsed['ods']
+        parsed['level_diffs'] = main.diff_pn_metadata_against_study_designer(kdSU_name_map, kdSU_kdIG_kdIT_map, su_name_map, su_ig_it_map)
+        return sum(len(level_diff.columns[level_diff.left_column]) for level_diff in parsed['level_diffs'])
+
+    def write_reports():
+        if 'level_diffs' not in parsed:
+            diff()
+        main.write_pn_metadata_reports(pn_metadata_file_name, parsed['level_diffs'])
+        return sum(len(level_diff.columns[level_diff.left_column]) for level_diff in parsed['level_diffs'])
+
+    def end_to_end(use_cache):
+        def run():
+            main.run_pn_metadata_check(pn_metadata_file_name, use_cache=use_cache, interactive=False)
+        return run
+
+    def end_to_end_warm():
+        # the first call of a repeat fills the caches, best-of picks a warm one.
+        return end_to_end(True)()
+
+    return {
+        'parse_streaming': parse_streaming,
+        'parse_soup': parse_soup,
+        'ods_streaming': ods_streaming,
+        'ods_full': ods_full,
+        'diff': diff,
+        'write_reports': write_reports,
+        'end_to_end': end_to_end(False),
+        'end_to_end_cached': end_to_end_warm,
+    }
+
+
+benchmark_stage_names = ['parse_streaming', 'parse_soup', 'ods_streaming', 'ods_full', 'diff', 'write_reports', 'end_to_end', 'end_to_end_cached']
+
+
+# ---------------------------------------- startup
+
+
+def benchmark_startup(frozen_executable=None, repeat=5):
+    """
+    times how long main.py, and optionally a pyinstaller build of it, take to answer --help, --version and --replay.
+    none of those should import requests, bs4, lxml or pandas. a bare interpreter start is timed for reference.
+    """
+    main_file_name = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+    executables = [("script", [sys.executable, main_file_name])]
+    if frozen_executable:
+        executables.append(("frozen", [os.path.abspath(frozen_executable)]))
+
+    print("------------------------------- startup -------------------------------")
+    print("{:<8} {:<24} {:>12}".format("build", "command", "seconds"))
+    working_directory = os.getcwd()
+    directory = tempfile.mkdtemp(prefix="metadata-checker-benchmark-")
+    try:
+        os.chdir(directory)
+        # --replay needs a recorded check of an unchanged file.
+        pn_metadata_file_name, ods_file_name, protocol = generate_study(directory, 1)
+        with serve_study_designer([{'protocol': [protocol], 'designId': 'bench@1'}], {'bench@1': ods_file_name}):
+            with contextlib.redirect_stdout(io.StringIO()):
+                main.run_pn_metadata_check(pn_metadata_file_name, interactive=False)
+
+        commands = [("interpreter", None), ("import main", None), ("--help", ["--help"]), ("--version", ["--version"]),
+                    ("--replay", ["--replay", os.path.basename(pn_metadata_file_name)])]
+        for build, executable in executables:
+            for name, arguments in commands:
+                if name == "interpreter" or name == "import main":
+                    if build != "script":
+                        continue
+                    command = [sys.executable, "-c", "pass" if name == "interpreter" else "import sys; sys.path.insert(0, {!r}); import main".format(os.path.dirname(main_file_name))]
+                else:
+                    command = executable + arguments
+                best_time = None
+                for run in range(repeat):
+                    start = time.perf_counter()
+                    subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                    elapsed = time.perf_counter() - start
+                    best_time = elapsed if best_time is None else min(best_time, elapsed)
+                print("{:<8} {:<24} {:>12.4f}".format(build, name, best_time))
+    finally:
+        os.chdir(working_directory)
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+# ---------------------------------------- recorded results
+
+
+def git_commit():
+    """
+    returns the current commit of the repository, or None outside of a git checkout.
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_benchmark_results(results_file_name):
+    """
+    returns (scale, stage) => the most recent recorded result.
+    """
+    previous_results = {}
+    if os.path.exists(results_file_name):
+        with open(results_file_name) as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    previous_results[(record['scale'], record['stage'])] = record
+
+    return previous_results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmarks the metadata checker.")
+    parser.add_argument("--suite", choices=["stages", "alignment", "startup"], default="stages",
+                        help="stages (default) times each stage of main.py on synthetic studies, alignment times align_sorted_columns, "
+                             "startup times the commands that should answer without the heavy imports.")
+    parser.add_argument("--frozen", metavar="EXECUTABLE",
+                        help="also time this pyinstaller build of main.py in the startup suite.")
+    parser.add_argument("--scales", type=float, nargs="+", default=[1, 10, 100],
+                        help="synthetic study sizes as multiples of today's exports (default: %(default)s).")
+    parser.add_argument("--stages", nargs="+", choices=benchmark_stage_names, default=benchmark_stage_names,
+                        help="stages to time (default: all).")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="time each stage this many times and keep the best (default: %(default)s).")
+    parser.add_argument("--results", default=benchmark_results_file_name,
+                        help="append the stage timings to this json lines file (default: %(default)s).")
+    parser.add_argument("--no-record", action="store_true",
+                        help="print the stage timings without appending them to --results.")
+    parser.add_argument("--generate", metavar="DIRECTORY",
+                        help="only write the synthetic pn metadata and ODS export of each scale to DIRECTORY.")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000, 100000, 500000],
+                        help="kdig-->kdit row counts to align.")
+    parser.add_argument("--mismatch-rate", type=float, default=0.05,
+                        help="fraction of rows only present on one side (default: %(default)s).")
+    args = parser.parse_args()
+
+    scales = [int(scale) if scale == int(scale) else scale for scale in args.scales]
+    if args.generate:
+        os.makedirs(args.generate, exist_ok=True)
+        for scale in scales:
+            pn_metadata_file_name, ods_file_name, protocol = generate_study(args.generate, scale, args.mismatch_rate)
+            print("{} ({} bytes), {} ({} bytes), protocol {}".format(pn_metadata_file_name, os.path.getsize(pn_metadata_file_name),
+                                                                    ods_file_name, os.path.getsize(ods_file_name), protocol))
+    elif args.suite == "alignment":
+        benchmark_alignment(args.rows, args.mismatch_rate)
+    elif args.suite == "startup":
+        benchmark_startup(args.frozen, args.repeat)
+    else:
+        benchmark_stages(scales, args.stages, args.mismatch_rate, args.repeat, args.results, not args.no_record)
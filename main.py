@@ -1,12 +1,36 @@
-import requests
 import json
 import sys
 import io
 import os
 import pickle
-from bs4 import BeautifulSoup
-import pandas as pd
-
+import argparse
+import csv
+import struct
+import mmap
+from array import array
+import contextlib
+import threading
+import time
+import tracemalloc
+import cProfile
+import collections
+from collections import namedtuple
+import glob
+import fnmatch
+import hashlib
+import re
+# requests, bs4, lxml, pandas and concurrent.futures are imported by the functions that use them, so that
+# --help, --version and --replay answer without paying for them. pyinstaller still finds function level imports.
+try:
+    import resource
+except ImportError:  # windows builds have no getrusage, peak rss is left out of the profile there.
+    resource = None
+
+
+__version__ = "1.1.0"
+
+# only the kdSU's under these StudyEventDef's are checked.
+kdSE_inclusion_list = ["LogPad"]
 
 # this is the exclusion list for kdSU's under StudyEventDef with "kdSE"="LogPad"
 # e.g.
@@ -33,8 +57,66 @@ kdIG_exclusion_list = ["Protocol", "Header", "FormLevelData", "CG", "LogPadPerfo
 # for study designer if ig is equal to any item in the list below, it is ignored.
 ig_exclusion_list = ["-", ""]
 
-# this is used for writing buffer out to terminal.
-sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding="UTF-8")
+# a study can replace the lists above with a rules file, see compile_exclusion_rules. pn_metadata.xml picks up
+# pn_metadata.rules.json from the same directory unless --rules names another one.
+exclusion_rules_suffix = ".rules.json"
+exclusion_rule_kinds = ['kdSE', 'kdSU', 'kdIG', 'kdIT', 'su', 'ig', 'it']
+
+# parsed pn metadata is pickled here, keyed by the file's content hash and the exclusion rules in effect.
+# bump pn_metadata_cache_version whenever the cached structures change shape.
+pn_metadata_cache_directory = "cache/pn_metadata"
+pn_metadata_cache_version = 2
+pn_metadata_cache_max_size_mb = 256
+# the most recently used parses are also kept in memory for the long-running modes (--watch, --serve).
+pn_metadata_memo_size = 8
+pn_metadata_memo = collections.OrderedDict()
+pn_metadata_memo_lock = threading.Lock()
+
+# study designer api. responses are cached under http_cache_directory and revalidated with ETag/Last-Modified.
+# exports of a pinned designId@version never change, so those are served from disk without a request.
+study_designer_designs_url = "http://naphznv3a.phtstudy.com:3006/api/v2/designs"
+study_designer_export_url = "http://naphznv3a.phtstudy.com:3010/api/v1/json/export/{0}/ods"
+study_designer_timeout = (5, 120)  # (connect, read) seconds
+http_cache_directory = "cache/http"
+study_designer_fetch_workers = 4  # concurrent ODS export downloads when a study has several protocols
+# parsed exports of pinned designs are also kept in memory, so long-running modes (--watch) skip the json parse.
+study_designer_memo_size = 16
+study_designer_memo = collections.OrderedDict()
+study_designer_memo_lock = threading.Lock()
+
+# --watch polls the directory this often and waits until a file has stopped changing for watch_debounce_seconds.
+watch_poll_interval = 1.0
+watch_debounce_seconds = 2.0
+
+# --serve listens on service_host unless an address is given, and refuses uploads beyond service_max_upload_mb.
+service_host = "127.0.0.1"
+service_max_upload_mb = 512
+
+# per signing unit fingerprints and diff results of the previous run of each file, used by --incremental.
+incremental_directory = "cache/incremental"
+incremental_state_version = 2
+
+# --profile writes reports/<file>_profile.json with the wall time, cpu time, memory and counts of every stage.
+profile_stages = None  # list of finished stage records while a profiled run is in progress, None otherwise
+profile_http_requests = None  # list of study designer requests made during a profiled run
+profile_lock = threading.Lock()
+profile_local = threading.local()  # per thread stack of the stages currently open
+profile_open_stages = []  # stages open across all threads, they share the process wide traced peak
+
+# every check appends its mismatches here, --query answers questions across runs and studies from it.
+history_database_file_name = "reports/mismatch_history.sqlite"
+history_database_timeout = 30  # seconds to wait for another batch worker's write
+
+# --enqueue and --work share jobs through a sqlite queue file, which may sit on a filesystem shared between hosts as
+# long as it supports file locks. a claimed job is leased for job_lease_seconds and renewed while its check runs, so
+# the jobs of a worker that died go back to the queue. hosts compare lease times by wall clock.
+job_queue_timeout = 60  # seconds to wait for another worker's claim or update
+job_lease_seconds = 300
+job_max_attempts = 3
+job_poll_interval = 5.0  # seconds an idle worker waits before looking for retried jobs again
+
+# the results of the last check of each file, keyed like the pn metadata cache. --replay prints them back.
+results_directory = "cache/results"
 
 # ---------------------------------------- initialization
 
@@ -58,6 +140,8 @@ def find_study_protocols(pn_metadata_file_name):
     """
     parses pn metadata file and returns a list of study protocols
     """
+    from bs4 import BeautifulSoup
+
     with open(pn_metadata_file_name, 'r') as f:
 
         soup = BeautifulSoup(f.read(), 'lxml')
@@ -75,85 +159,252 @@ def find_study_protocols(pn_metadata_file_name):
     # soup_datadictionary will be used later to find kdSUs.
     return soup_datadictionary, pn_metadata_protocol
 
+# ---------------------------------------- exclusion rules
+
+# one keep(name) => bool function per entry of exclusion_rule_kinds, plus the canonical json of the rules as key.
+ExclusionRules = namedtuple('ExclusionRules', exclusion_rule_kinds + ['key'])
+
+
+def compile_name_patterns(patterns):
+    """
+    returns match(name) => bool for a list of exact names, "glob:" patterns and "re:" regular expressions,
+    or None when the list is empty. globs and regular expressions have to match the whole name.
+    """
+    exact_names = set()
+    expressions = []
+    for pattern in patterns:
+        if not isinstance(pattern, str):
+            raise ValueError("patterns must be strings, not {!r}".format(pattern))
+        if pattern.startswith("glob:"):
+            expressions.append(re.compile(fnmatch.translate(pattern[len("glob:"):])))
+        elif pattern.startswith("re:"):
+            try:
+                expressions.append(re.compile(pattern[len("re:"):]))
+            except re.error as e:
+                raise ValueError("invalid regular expression {!r}: {}".format(pattern, e))
+        else:
+            exact_names.add(pattern)
+
+    if not expressions:
+        return frozenset(exact_names).__contains__ if exact_names else None
+
+    # the expressions without groups are folded into one alternation, so a name is scanned once. one with groups is
+    # matched on its own: in the alternation its groups would be renumbered under its backreferences.
+    compiled_expressions = [expression for expression in expressions if expression.groups > 0]
+    ungrouped_expressions = [expression for expression in expressions if expression.groups == 0]
+    try:
+        if len(ungrouped_expressions) > 1:
+            ungrouped_expressions = [re.compile("|".join("(?:{})".format(expression.pattern) for expression in ungrouped_expressions))]
+    except re.error:
+        pass  # inline global flags such as (?i) are only allowed at the start of their own expression.
+    compiled_expressions.extend(ungrouped_expressions)
+    exact_names = frozenset(exact_names)
+
+    def match(name):
+        return name in exact_names or any(expression.fullmatch(name) is not None for expression in compiled_expressions)
+
+    return match
+
+
+def compile_name_rule(include=None, exclude=()):
+    """
+    returns keep(name) => bool: the name matches include (when given) and does not match exclude.
+    """
+    included = compile_name_patterns(include) if include is not None else None
+    excluded = compile_name_patterns(exclude)
+
+    if included is None and include is not None:
+        return lambda name: False
+    if included is None and excluded is None:
+        return lambda name: True
+    if included is None:
+        return lambda name: not excluded(name)
+    if excluded is None:
+        return included
+    return lambda name: included(name) and not excluded(name)
+
+
+def default_exclusion_rules_source():
+    """
+    returns the hard-coded inclusion and exclusion lists in the rules file format.
+    """
+    return {
+        'kdSE': {'include': list(kdSE_inclusion_list)},
+        'kdSU': {'exclude': list(kdSU_exclusion_list)},
+        'kdIG': {'exclude': list(kdIG_exclusion_list)},
+        'kdIT': {},
+        'su': {'exclude': list(su_exclusion_list)},
+        'ig': {'exclude': list(ig_exclusion_list)},
+        'it': {},
+    }
+
+
+def compile_exclusion_rules(rules_source=None):
+    """
+    compiles kind => {"include": [pattern, ...], "exclude": [pattern, ...]} into ExclusionRules. e.g.
+      {"kdSU": {"exclude": ["AddUser", "glob:Visit*", "re:Register[A-Z]+[0-9]*"]}, "ig": {"exclude": ["-", ""]}}
+    a kind given replaces its hard-coded rule as a whole, kinds left out keep the hard-coded rule.
+    without include every name is kept unless it matches exclude. raises ValueError on a malformed rule.
+    """
+    rules = default_exclusion_rules_source()
+    for kind, rule in (rules_source or {}).items():
+        if kind not in exclusion_rule_kinds:
+            raise ValueError("unknown kind {!r}, expected one of {}".format(kind, ', '.join(exclusion_rule_kinds)))
+        if not isinstance(rule, dict) or set(rule) - {'include', 'exclude'}:
+            raise ValueError("the rule for {} must be an object with include and/or exclude lists".format(kind))
+        for patterns in rule.values():
+            if not isinstance(patterns, list):
+                raise ValueError("include and exclude of {} must be lists".format(kind))
+        rules[kind] = rule
+
+    keep = dict((kind, compile_name_rule(rules[kind].get('include'), rules[kind].get('exclude', ()))) for kind in exclusion_rule_kinds)
+    return ExclusionRules(key=json.dumps(rules, sort_keys=True), **keep)
+
+
+def default_exclusion_rules():
+    """
+    returns the compiled hard-coded inclusion and exclusion lists.
+    """
+    return compile_exclusion_rules()
+
+
+def load_exclusion_rules(rules_file_name):
+    """
+    reads and compiles a rules file. raises OSError or ValueError naming the file when it cannot be used.
+    """
+    with open(rules_file_name, encoding='utf8') as f:
+        try:
+            rules_source = json.load(f)
+        except ValueError as e:
+            raise ValueError("{} is not valid json: {}".format(rules_file_name, e))
+
+    if not isinstance(rules_source, dict):
+        raise ValueError("{} must hold a json object".format(rules_file_name))
+    try:
+        return compile_exclusion_rules(rules_source)
+    except ValueError as e:
+        raise ValueError("{}: {}".format(rules_file_name, e))
+
+
+def find_exclusion_rules(pn_metadata_file_name, rules_file_name=None):
+    """
+    returns the rules for a study: rules_file_name when given, else <file>.rules.json next to the pn metadata file,
+    else the hard-coded lists.
+    """
+    if rules_file_name is None:
+        study_rules_file_name = os.path.splitext(pn_metadata_file_name)[0] + exclusion_rules_suffix
+        if os.path.isfile(study_rules_file_name):
+            rules_file_name = study_rules_file_name
+
+    if rules_file_name is None:
+        return default_exclusion_rules()
+    return load_exclusion_rules(rules_file_name)
+
 # ---------------------------------------- parsing pn_metadata
 
 
-def find_pn_metadata_kdSU_values(soup_datadictionary, kdSU_exclusion_list):
+def new_pn_metadata_index():
     """
-    find the list of nontrivial kdSU values in pn_metadata
+    returns an empty pn metadata index.
+    kdSE => [kdSU, ...], kdSU => (name, [kdIG, ...]), kdIG => [kdIT, ...] and kdIT => {kdIG, ...}
     """
-    all_kdSU_values = []
+    return {'kdSE': {}, 'kdSU': {}, 'kdIG': {}, 'kdIT': {}}
+
+
+def add_to_pn_metadata_index(pn_metadata_index, tag, key, name=None, children=()):
+    """
+    records one studyeventdef, signingunitdef or itemgroupdef in the index.
+    later definitions of the same key replace earlier ones, same as the original find_all scans did.
+    """
+    if tag == 'studyeventdef':
+        pn_metadata_index['kdSE'].setdefault(key, []).extend(children)
+    elif tag == 'signingunitdef':
+        pn_metadata_index['kdSU'][key] = (name, list(children))
+    elif tag == 'itemgroupdef':
+        pn_metadata_index['kdIG'][key] = list(children)
+        for kdIT in children:
+            pn_metadata_index['kdIT'].setdefault(kdIT, set()).add(key)
+
+
+def index_pn_metadata(soup_datadictionary):
+    """
+    walks the data dictionary once and indexes the kdSE, kdSU, kdIG and kdIT relationships.
+    """
+    pn_metadata_index = new_pn_metadata_index()
+
+    for element in soup_datadictionary.find_all(['studyeventdef', 'signingunitdef', 'itemgroupdef']):
+        if element.name == 'studyeventdef':
+            children = [signingunitref['kdsu'] for signingunitref in element.find_all('signingunitref')]
+            add_to_pn_metadata_index(pn_metadata_index, 'studyeventdef', element['kdse'], children=children)
+        elif element.name == 'signingunitdef':
+            children = [itemgroupref['kdig'] for itemgroupref in element.find_all('itemgroupref')]
+            add_to_pn_metadata_index(pn_metadata_index, 'signingunitdef', element['kdsu'], element['name'], children)
+        else:
+            children = [itemref['kdit'] for itemref in element.find_all('itemref')]
+            add_to_pn_metadata_index(pn_metadata_index, 'itemgroupdef', element['kdig'], children=children)
 
-    for studyeventdef in soup_datadictionary.find_all('studyeventdef'):
-        if studyeventdef['kdse'] == 'LogPad':
-            for signingunitref in studyeventdef.find_all('signingunitref'):
-                all_kdSU_values.append(signingunitref['kdsu'])
+    return pn_metadata_index
 
-    valid_kdSU_values = list(set(all_kdSU_values) - set(kdSU_exclusion_list))
 
-    return valid_kdSU_values
+def find_pn_metadata_kdSU_values(pn_metadata_index, rules):
+    """
+    find the set of nontrivial kdSU values in pn_metadata
+    """
+    return set(kdSU for kdSE, kdSU_list in pn_metadata_index['kdSE'].items() if rules.kdSE(kdSE) for kdSU in kdSU_list if rules.kdSU(kdSU))
 
 
-def create_pn_metadata_kdSU_name_dictionary(valid_kdSU_values, soup_datadictionary):
+def create_pn_metadata_kdSU_name_dictionary(valid_kdSU_values, pn_metadata_index):
     """
     returns a dictionary that maps kdsu to corresponding name
     """
     kdSU_Name_map = {}
 
-    for signingunitdef in soup_datadictionary.find_all('signingunitdef'):
-        if signingunitdef['kdsu'] in valid_kdSU_values:
-            kdSU_Name_map[signingunitdef['kdsu']] = signingunitdef['name']
+    for kdSU, (name, kdIG_list) in pn_metadata_index['kdSU'].items():
+        if kdSU in valid_kdSU_values:
+            kdSU_Name_map[kdSU] = name
 
     return kdSU_Name_map
 
 
-def create_pn_metadata_kdSU_kdIG_dictionary(valid_kdSU_values, soup_datadictionary, kdIG_exclusion_list):
+def create_pn_metadata_kdSU_kdIG_dictionary(valid_kdSU_values, pn_metadata_index, rules):
     """
     finds the list of nontrivial kdIG values in pn_metadata
     """
-
     kdSU_kdIG_map = {}
 
-    for signingunitdef in soup_datadictionary.find_all('signingunitdef'):
-        if signingunitdef['kdsu'] in valid_kdSU_values:
-            kdSU_kdIG_map[signingunitdef['kdsu']] = []
-            for itemgroupref in signingunitdef.find_all('itemgroupref'):
-                kdSU_kdIG_map[signingunitdef['kdsu']].append(itemgroupref['kdig'])
-
-    # removing items from kdIG exclusion list:
-    for kdSU, kdIG_list in kdSU_kdIG_map.items():
-        valid_kdIG_list = list(set(kdIG_list) - set(kdIG_exclusion_list))
-        kdSU_kdIG_map[kdSU] = valid_kdIG_list
+    for kdSU, (name, kdIG_list) in pn_metadata_index['kdSU'].items():
+        if kdSU in valid_kdSU_values:
+            kdSU_kdIG_map[kdSU] = list(set(kdIG for kdIG in kdIG_list if rules.kdIG(kdIG)))
 
     return kdSU_kdIG_map
 
 
-def create_pn_metadata_kdIG_kdIT_dictionary(kdSU_kdIG_map, soup_datadictionary):
+def create_pn_metadata_kdIG_kdIT_dictionary(kdSU_kdIG_map, pn_metadata_index, rules):
     """
-    finds the list of nontrivial kdIG values in pn_metadata
+    returns the kdIG => kdIT lists for every kdIG referenced by a valid kdSU
     """
-
     kdIG_kdIT_map = {}
 
-    for itemgroupdef in soup_datadictionary.find_all('itemgroupdef'):
-        kdIG_kdIT_map[itemgroupdef['kdig']] = []
-        for itemref in itemgroupdef.find_all('itemref'):
-            kdIG_kdIT_map[itemgroupdef['kdig']].append(itemref['kdit'])
+    for kdSU, kdIG_list in kdSU_kdIG_map.items():
+        for kdIG in kdIG_list:
+            if kdIG not in kdIG_kdIT_map:
+                kdIG_kdIT_map[kdIG] = [kdIT for kdIT in pn_metadata_index['kdIG'][kdIG] if rules.kdIT(kdIT)]
 
     return kdIG_kdIT_map
 
 
-def create_pn_metadata_kdSU_kdIG_kdIT_dictionary(soup_datadictionary, kdSU_exclusion_list, kdIG_exclusion_list):
+def create_pn_metadata_kdSU_kdIG_kdIT_dictionary(pn_metadata_index, rules=None):
     """
-    creates a nested dictionary that holds kdSU kdIG kdIT relationships.
+    creates a nested dictionary that holds kdSU kdIG kdIT relationships, leaving out what the exclusion rules drop.
     """
-    valid_kdSU_values = find_pn_metadata_kdSU_values(soup_datadictionary, kdSU_exclusion_list)
-    print("pn_metadata list of valid kdSU values: \n{} \n".format(valid_kdSU_values))
-    kdSU_kdIG_map = create_pn_metadata_kdSU_kdIG_dictionary(valid_kdSU_values, soup_datadictionary, kdIG_exclusion_list)
-    kdIG_kdIT_map = create_pn_metadata_kdIG_kdIT_dictionary(kdSU_kdIG_map, soup_datadictionary)
+    rules = rules or default_exclusion_rules()
+    valid_kdSU_values = find_pn_metadata_kdSU_values(pn_metadata_index, rules)
+    print("pn_metadata list of valid kdSU values: \n{} \n".format(list(valid_kdSU_values)))
+    kdSU_kdIG_map = create_pn_metadata_kdSU_kdIG_dictionary(valid_kdSU_values, pn_metadata_index, rules)
+    kdIG_kdIT_map = create_pn_metadata_kdIG_kdIT_dictionary(kdSU_kdIG_map, pn_metadata_index, rules)
 
     # kdsu => name map:
-    kdSU_Name_map = create_pn_metadata_kdSU_name_dictionary(valid_kdSU_values, soup_datadictionary)
+    kdSU_Name_map = create_pn_metadata_kdSU_name_dictionary(valid_kdSU_values, pn_metadata_index)
 
     kdSU_kdIG_kdIT_map = {}  # initializing
     for kdSU, kdIG_list in kdSU_kdIG_map.items():
@@ -163,23 +414,419 @@ def create_pn_metadata_kdSU_kdIG_kdIT_dictionary(soup_datadictionary, kdSU_exclu
 
     return kdSU_Name_map, kdSU_kdIG_kdIT_map
 
+# ---------------------------------------- streaming pn_metadata
+
+
+def iterparse_pn_metadata(pn_metadata_file_name, on_protocols=None, rules=None):
+    """
+    streams through pn metadata file and indexes only the parts of the data dictionary the checker needs.
+    elements are cleared as soon as they are consumed so memory stays flat as the file grows.
+    on_protocols(pn_metadata_protocol) is called as soon as the Protocol CodeListDef has been read.
+    definitions and references the exclusion rules drop are skipped as they are read: an excluded StudyEventDef,
+    SigningUnitDef or ItemGroupDef is cleared child by child instead of being held until it ends.
+    """
+    from lxml import etree
+
+    rules = rules or default_exclusion_rules()
+    pn_metadata_protocol = []
+    pn_metadata_index = new_pn_metadata_index()
+
+    collected_tags = ('CodeListDef', 'StudyEventDef', 'SigningUnitDef', 'ItemGroupDef')
+    # tag => (key attribute, rule) of the definitions the rules can drop.
+    pruned_tags = {'StudyEventDef': ('kdSE', rules.kdSE), 'SigningUnitDef': ('kdSU', rules.kdSU), 'ItemGroupDef': ('kdIG', rules.kdIG)}
+    in_datadictionary = False
+    collecting = 0  # > 0 while inside a kept one of collected_tags; its children are needed until it ends.
+    kept = []  # whether each open collected element is kept, innermost last.
+    element_count = 0
+    pruned_count = 0
+
+    for event, element in etree.iterparse(pn_metadata_file_name, events=('start', 'end'), recover=True, huge_tree=True):
+        tag = element.tag
+
+        if event == 'start':
+            if tag == 'DataDictionary' and element.getparent() is not None and element.getparent().tag == 'MetaData':
+                in_datadictionary = True
+            elif in_datadictionary and tag in collected_tags:
+                if tag in pruned_tags:
+                    key, keep = pruned_tags[tag]
+                    value = element.get(key)
+                    kept.append(value is None or keep(value))
+                else:
+                    kept.append(True)
+                if kept[-1]:
+                    collecting += 1
+            continue
+
+        element_count += 1
+
+        if in_datadictionary and tag in collected_tags and not kept.pop():
+            pruned_count += 1
+        elif in_datadictionary and tag in collected_tags:
+            collecting -= 1
+            if tag == 'CodeListDef':
+                if element.get('Name') == 'Protocol':
+                    for codelistitem in element.iter('CodeListItem'):
+                        protocol = codelistitem.attrib['Description']
+                        if protocol not in ['<Unspecified Protocol>']:
+                            pn_metadata_protocol.append(protocol)
+                    if on_protocols is not None:
+                        on_protocols(list(pn_metadata_protocol))
+                        on_protocols = None
+            elif tag == 'StudyEventDef':
+                children = [signingunitref.attrib['kdSU'] for signingunitref in element.iter('SigningUnitRef') if rules.kdSU(signingunitref.attrib['kdSU'])]
+                add_to_pn_metadata_index(pn_metadata_index, 'studyeventdef', element.attrib['kdSE'], children=children)
+            elif tag == 'SigningUnitDef':
+                children = [itemgroupref.attrib['kdIG'] for itemgroupref in element.iter('ItemGroupRef') if rules.kdIG(itemgroupref.attrib['kdIG'])]
+                add_to_pn_metadata_index(pn_metadata_index, 'signingunitdef', element.attrib['kdSU'], element.attrib['Name'], children)
+            elif tag == 'ItemGroupDef':
+                children = [itemref.attrib['kdIT'] for itemref in element.iter('ItemRef') if rules.kdIT(itemref.attrib['kdIT'])]
+                add_to_pn_metadata_index(pn_metadata_index, 'itemgroupdef', element.attrib['kdIG'], children=children)
+        elif tag == 'DataDictionary':
+            in_datadictionary = False
+
+        if collecting == 0:
+            # nothing above this element needs it anymore.
+            element.clear(keep_tail=True)
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+    add_profile_counts(elements=element_count, pruned=pruned_count, input_bytes=os.path.getsize(pn_metadata_file_name))
+    return pn_metadata_protocol, pn_metadata_index
+
+
+def create_pn_metadata_kdSU_kdIG_kdIT_dictionary_streaming(pn_metadata_file_name, rules=None, on_protocols=None):
+    """
+    streaming counterpart of find_study_protocols + create_pn_metadata_kdSU_kdIG_kdIT_dictionary.
+    returns the protocols along with the same kdSU => name and kdSU => kdIG => kdIT maps.
+    """
+    rules = rules or default_exclusion_rules()
+    with profile_stage('iterparse_pn_metadata'):
+        pn_metadata_protocol, pn_metadata_index = iterparse_pn_metadata(pn_metadata_file_name, on_protocols, rules)
+    with profile_stage('build_pn_metadata_maps'):
+        kdSU_Name_map, kdSU_kdIG_kdIT_map = create_pn_metadata_kdSU_kdIG_kdIT_dictionary(pn_metadata_index, rules)
+
+    return pn_metadata_protocol, kdSU_Name_map, kdSU_kdIG_kdIT_map
+
+# ---------------------------------------- pn_metadata cache
+
+
+def pn_metadata_cache_key(pn_metadata_file_name, rules):
+    """
+    returns a key made of the file's content hash and the exclusion rules used to build the maps.
+    """
+    sha256 = hashlib.sha256()
+    with open(pn_metadata_file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+
+    sha256.update(json.dumps([pn_metadata_cache_version, rules.key]).encode('utf8'))
+
+    return sha256.hexdigest()
+
+
+def load_pn_metadata_cache(cache_key):
+    """
+    returns (pn_metadata_protocol, kdSU_Name_map, kdSU_kdIG_kdIT_map) from the cache or None on a miss.
+    """
+    cache_file_name = os.path.join(pn_metadata_cache_directory, "{}.pickle".format(cache_key))
+    try:
+        with open(cache_file_name, 'rb') as f:
+            cached = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return None
+
+    # touching the file keeps recently used entries at the back of the eviction order.
+    try:
+        os.utime(cache_file_name)
+    except OSError:
+        pass  # another process evicted it after it was read.
+    return cached
+
+
+def save_pn_metadata_cache(cache_key, pn_metadata_protocol, kdSU_Name_map, kdSU_kdIG_kdIT_map, max_size_mb=pn_metadata_cache_max_size_mb):
+    """
+    pickles the parsed pn metadata and evicts least recently used entries beyond max_size_mb.
+    """
+    if not os.path.isdir(pn_metadata_cache_directory):
+        os.makedirs(pn_metadata_cache_directory)
+
+    cache_file_name = os.path.join(pn_metadata_cache_directory, "{}.pickle".format(cache_key))
+    temp_file_name = "{}.{}.{}.tmp".format(cache_file_name, os.getpid(), threading.get_ident())
+    with open(temp_file_name, 'wb') as f:
+        pickle.dump((pn_metadata_protocol, kdSU_Name_map, kdSU_kdIG_kdIT_map), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_file_name, cache_file_name)
+
+    evict_pn_metadata_cache(max_size_mb)
+
+
+def evict_pn_metadata_cache(max_size_mb):
+    """
+    removes the least recently used cache entries until the cache fits in max_size_mb.
+    """
+    entries = []
+    for entry in os.scandir(pn_metadata_cache_directory):
+        if entry.name.endswith(".pickle"):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue  # another process evicted it first.
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total_size = sum(size for mtime, size, path in entries)
+    for mtime, size, path in sorted(entries):
+        if total_size <= max_size_mb * 1024 * 1024:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass  # another process evicted it first.
+        total_size -= size
+
+
+def clear_pn_metadata_cache():
+    """
+    removes every cached pn metadata entry.
+    """
+    with pn_metadata_memo_lock:
+        pn_metadata_memo.clear()
+    if os.path.isdir(pn_metadata_cache_directory):
+        for entry in os.scandir(pn_metadata_cache_directory):
+            if entry.name.endswith(".pickle") or entry.name.endswith(".tmp"):
+                os.remove(entry.path)
+
+
+def remember_pn_metadata(cache_key, parsed):
+    """
+    keeps a parse in the in-memory lru, dropping the least recently used ones beyond pn_metadata_memo_size.
+    """
+    with pn_metadata_memo_lock:
+        pn_metadata_memo[cache_key] = parsed
+        pn_metadata_memo.move_to_end(cache_key)
+        while len(pn_metadata_memo) > pn_metadata_memo_size:
+            pn_metadata_memo.popitem(last=False)
+
+
+def parse_pn_metadata(pn_metadata_file_name, parser="streaming", use_cache=True, cache_size_mb=pn_metadata_cache_max_size_mb, on_protocols=None, rules=None):
+    """
+    returns (pn_metadata_protocol, kdSU_Name_map, kdSU_kdIG_kdIT_map), from the cache when the file has been parsed before.
+    on_protocols(pn_metadata_protocol) is called as soon as the protocols are known, before the kdSU maps are built.
+    rules defaults to the hard-coded exclusion lists, see compile_exclusion_rules.
+    """
+    rules = rules or default_exclusion_rules()
+    if use_cache:
+        with profile_stage('load_pn_metadata_cache'):
+            cache_key = pn_metadata_cache_key(pn_metadata_file_name, rules)
+            with pn_metadata_memo_lock:
+                cached = pn_metadata_memo.get(cache_key)
+                if cached is not None:
+                    pn_metadata_memo.move_to_end(cache_key)
+            if cached is None:
+                cached = load_pn_metadata_cache(cache_key)
+                if cached is not None:
+                    remember_pn_metadata(cache_key, cached)
+            add_profile_counts(hit=cached is not None)
+        if cached is not None:
+            print("using cached parse of {}... \n".format(pn_metadata_file_name))
+            print("the protocols for this study according to {0} are: \n{1} \n".format(pn_metadata_file_name, cached[0]))
+            if on_protocols is not None:
+                on_protocols(list(cached[0]))
+            return cached
+
+    print("parsing {}... \n".format(pn_metadata_file_name))
+
+    with profile_stage('parse_pn_metadata', parser=parser):
+        if parser == "soup":
+            with profile_stage('find_study_protocols', input_bytes=os.path.getsize(pn_metadata_file_name)):
+                soup_datadictionary, pn_metadata_protocol = find_study_protocols(pn_metadata_file_name)
+            print("the protocols for this study according to {0} are: \n{1} \n".format(pn_metadata_file_name, pn_metadata_protocol))
+            if on_protocols is not None:
+                on_protocols(list(pn_metadata_protocol))
+
+            with profile_stage('index_pn_metadata'):
+                pn_metadata_index = index_pn_metadata(soup_datadictionary)
+                add_profile_counts(definitions=sum(len(pn_metadata_index[tag]) for tag in pn_metadata_index))
+            with profile_stage('build_pn_metadata_maps'):
+                kdSU_Name_map, kdSU_kdIG_kdIT_map = create_pn_metadata_kdSU_kdIG_kdIT_dictionary(pn_metadata_index, rules)
+        else:
+            pn_metadata_protocol, kdSU_Name_map, kdSU_kdIG_kdIT_map = create_pn_metadata_kdSU_kdIG_kdIT_dictionary_streaming(pn_metadata_file_name, rules, on_protocols)
+            print("the protocols for this study according to {0} are: \n{1} \n".format(pn_metadata_file_name, pn_metadata_protocol))
+        if profile_stages is not None:
+            add_profile_counts(kdSU=len(kdSU_Name_map), kdIG=sum(len(kdIG_kdIT_map) for kdIG_kdIT_map in kdSU_kdIG_kdIT_map.values()),
+                               kdIT=sum(len(kdIT_list) for kdIG_kdIT_map in kdSU_kdIG_kdIT_map.values() for kdIT_list in kdIG_kdIT_map.values()))
+
+    if use_cache:
+        with profile_stage('save_pn_metadata_cache'):
+            save_pn_metadata_cache(cache_key, pn_metadata_protocol, kdSU_Name_map, kdSU_kdIG_kdIT_map, cache_size_mb)
+        remember_pn_metadata(cache_key, (pn_metadata_protocol, kdSU_Name_map, kdSU_kdIG_kdIT_map))
+
+    return pn_metadata_protocol, kdSU_Name_map, kdSU_kdIG_kdIT_map
+
 # ---------------------------------------- getting study designer json
 
 
-def get_all_study_design_ids(pn_metadata_protocol):
+http_session = None
+
+
+def get_http_session():
     """
-    get all studies in json format and serialize if not done alraedy
+    returns the shared pooled session used for every study designer request.
     """
+    global http_session
+    if http_session is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
 
-    response = requests.get("http://naphznv3a.phtstudy.com:3006/api/v2/designs")
-    content = response.content.decode('latin-1').encode('utf8')
-    study_dict_list = json.loads(content)
+        retry = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["GET"])
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry)
+        http_session = requests.Session()
+        http_session.mount("http://", adapter)
+        http_session.mount("https://", adapter)
 
-    study_design_ids = []
+    return http_session
+
+
+def read_file_chunks(file_name, chunk_size=64 * 1024):
+    """
+    yields the content of a file in chunks.
+    """
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            yield chunk
+
+
+def http_stream_cached(url, immutable=False, use_cache=True, chunk_size=64 * 1024):
+    """
+    yields the body of a GET request to url in chunks, without holding the whole body in memory.
+    cached bodies are revalidated with If-None-Match/If-Modified-Since, immutable ones are read from disk without a request.
+    """
+    request = {'url': url, 'status': None, 'source': 'network', 'bytes': 0, 'latency_s': None, 'wall_s': None}
+    start_time = time.perf_counter()
+    try:
+        for chunk in http_stream_cached_chunks(url, immutable, use_cache, chunk_size, request):
+            request['bytes'] += len(chunk)
+            yield chunk
+    finally:
+        request['wall_s'] = round(time.perf_counter() - start_time, 6)
+        add_profile_http_request(request)
+
+
+def http_stream_cached_chunks(url, immutable, use_cache, chunk_size, request):
+    """
+    does the work of http_stream_cached, noting the status, the source of the body and the latency in request.
+    """
+    start_time = time.perf_counter()
+    cache_key = hashlib.sha256(url.encode('utf8')).hexdigest()
+    cache_file_name = os.path.join(http_cache_directory, "{}.pickle".format(cache_key))
+    body_file_name = os.path.join(http_cache_directory, "{}.body".format(cache_key))
+    cached = None
+    if use_cache and os.path.exists(body_file_name):
+        try:
+            with open(cache_file_name, 'rb') as f:
+                cached = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            cached = None
+
+    if cached is not None and immutable:
+        request['source'] = 'cache'
+        yield from read_file_chunks(body_file_name, chunk_size)
+        return
+
+    headers = {}
+    if cached is not None:
+        if cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+        if cached['last_modified']:
+            headers['If-Modified-Since'] = cached['last_modified']
+
+    with get_http_session().get(url, headers=headers, timeout=study_designer_timeout, stream=True) as response:
+        request['status'] = response.status_code
+        request['latency_s'] = round(time.perf_counter() - start_time, 6)
+        if response.status_code == 304 and cached is not None:
+            request['source'] = 'revalidated'
+            yield from read_file_chunks(body_file_name, chunk_size)
+            return
+        response.raise_for_status()
+
+        if not use_cache:
+            yield from response.iter_content(chunk_size)
+            return
+
+        if not os.path.isdir(http_cache_directory):
+            os.makedirs(http_cache_directory, exist_ok=True)
+
+        # the body is written to disk as it streams through, and only replaces the cached one once complete.
+        temp_body_file_name = "{}.{}.{}.tmp".format(body_file_name, os.getpid(), threading.get_ident())
+        try:
+            with open(temp_body_file_name, 'wb') as f:
+                for chunk in response.iter_content(chunk_size):
+                    f.write(chunk)
+                    yield chunk
+            os.replace(temp_body_file_name, body_file_name)
+        finally:
+            if os.path.exists(temp_body_file_name):
+                os.remove(temp_body_file_name)
+
+        cached = {'url': url, 'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+        temp_file_name = "{}.{}.{}.tmp".format(cache_file_name, os.getpid(), threading.get_ident())
+        with open(temp_file_name, 'wb') as f:
+            pickle.dump(cached, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_file_name, cache_file_name)
+
+
+def http_get_cached(url, immutable=False, use_cache=True):
+    """
+    returns the body of a GET request to url. see http_stream_cached.
+    """
+    return b''.join(http_stream_cached(url, immutable, use_cache))
 
-    for study in study_dict_list:
-        if study['protocol'] == pn_metadata_protocol:
-            study_design_ids.append(study['designId'])
+
+def clear_http_cache():
+    """
+    removes every cached study designer response.
+    """
+    with study_designer_memo_lock:
+        study_designer_memo.clear()
+    if os.path.isdir(http_cache_directory):
+        for entry in os.scandir(http_cache_directory):
+            if entry.name.endswith(".pickle") or entry.name.endswith(".body") or entry.name.endswith(".tmp"):
+                os.remove(entry.path)
+
+
+def index_study_designs(use_cache=True):
+    """
+    downloads the designs list once and returns protocol => [designId, ...]
+    """
+    with profile_stage('index_study_designs'):
+        content = http_get_cached(study_designer_designs_url, use_cache=use_cache)
+        content = content.decode('latin-1').encode('utf8')
+        study_dict_list = json.loads(content)
+
+        study_designs = {}
+        for study in study_dict_list:
+            # a design may list a single protocol or several.
+            protocols = study['protocol'] if isinstance(study['protocol'], list) else [study['protocol']]
+            for protocol in protocols:
+                study_designs.setdefault(protocol, []).append(study['designId'])
+        add_profile_counts(designs=len(study_dict_list), protocols=len(study_designs))
+
+    return study_designs
+
+
+def get_all_study_design_ids(pn_metadata_protocol, use_cache=True, study_designs=None):
+    """
+    returns the design ids of one protocol, or of every protocol in a list of protocols.
+    study_designs is the index_study_designs result, downloaded when not given.
+    """
+    if study_designs is None:
+        study_designs = index_study_designs(use_cache)
+
+    protocols = pn_metadata_protocol if isinstance(pn_metadata_protocol, list) else [pn_metadata_protocol]
+    study_design_ids = []
+    for protocol in protocols:
+        for design_id in study_designs.get(protocol, []):
+            if design_id not in study_design_ids:
+                study_design_ids.append(design_id)
 
     return study_design_ids
 
@@ -199,12 +846,15 @@ def find_latest_design_id(study_design_ids):
     return latest_design_id
 
 
-def get_study_designer_json(soup_datadictionary, pn_metadata_protocol):
+def find_study_design_id(pn_metadata_protocol, use_cache=True, interactive=True):
     """
-    use the latest design id to retrieve the correct study designer json
+    returns the latest design id for the protocol, asking the user for one if the protocol has none.
     """
-    study_design_ids = get_all_study_design_ids(pn_metadata_protocol)
-    if len(study_design_ids) == 0:
+    study_design_ids = get_all_study_design_ids(pn_metadata_protocol, use_cache)
+    if len(study_design_ids) == 0 and not interactive:
+        print("Unable to find design ids associated with the protocol name in pn_metadata xml file: {}".format(pn_metadata_protocol))
+        sys.exit(1)
+    elif len(study_design_ids) == 0:
         print("Unable to find design ids associated with the protocol name in pn_metadata xml file. You may enter your design idea of interest here: ")
         latest_design_id = input("Enter the full name of the pn metadata xml file you would like to parse (e.g. pn_metadata.xml): ")
 
@@ -213,90 +863,329 @@ def get_study_designer_json(soup_datadictionary, pn_metadata_protocol):
         latest_design_id = find_latest_design_id(study_design_ids)
         print("the latest study design id: \n{} \n".format(latest_design_id))
 
-    response = requests.get("http://naphznv3a.phtstudy.com:3010/api/v1/json/export/{0}/ods".format(latest_design_id))
-    content = response.content.decode('latin-1').encode('utf8')
-    study_designer_json = json.loads(content)
-    print("retrieved study json from http request to: \nhttp://naphznv3a.phtstudy.com:3010/api/v1/json/export/{0}/ods \n".format(latest_design_id))
+    return latest_design_id
 
-    return study_designer_json
+
+json_structural_characters = re.compile(r'[{}\[\]"]')
+json_string_characters = re.compile(r'["\\]')
+
+
+def iter_json_array_items(text_chunks, key, prune_field=None, keep=None):
+    """
+    yields each item of the array stored under key in the top-level json object, as soon as the item has been read.
+    only the item being read is kept in memory. raises KeyError if the document has no such array.
+    with prune_field, an item whose string prune_field fails keep(value) is skipped from there on: the rest of it
+    is scanned past without being kept or decoded, and it is not yielded.
+    """
+    buffer = ''
+    position = 0
+    depth = 0
+    in_string = False
+    string_start = 0
+    last_top_level_string = None
+    in_array = False
+    found_array = False
+    item_start = None
+    skipping_item = False
+    last_item_string = None
+    last_item_string_end = 0
+    reading_prune_field = False
+
+    for text in text_chunks:
+        buffer += text
+        while True:
+            if in_string:
+                match = json_string_characters.search(buffer, position)
+                if match is None:
+                    position = len(buffer)
+                    break
+                if match.group() == '\\':
+                    if match.end() >= len(buffer):
+                        # the escaped character is in the next chunk.
+                        position = match.start()
+                        break
+                    position = match.end() + 1
+                    continue
+                in_string = False
+                position = match.end()
+                if depth == 1:
+                    last_top_level_string = buffer[string_start:match.start()]
+                elif depth == 3 and item_start is not None and prune_field is not None:
+                    if reading_prune_field:
+                        reading_prune_field = False
+                        if not keep(json.loads(buffer[string_start - 1:position])):
+                            skipping_item = True
+                            item_start = None
+                    else:
+                        last_item_string = buffer[string_start:match.start()]
+                        last_item_string_end = position
+                continue
+
+            match = json_structural_characters.search(buffer, position)
+            if match is None:
+                position = len(buffer)
+                break
+            character = match.group()
+            position = match.end()
+            if character == '"':
+                in_string = True
+                string_start = position
+                # a string right after "prune_field": is its value.
+                if depth == 3 and item_start is not None and last_item_string == prune_field and buffer[last_item_string_end:match.start()].strip() == ':':
+                    reading_prune_field = True
+            elif character in '{[':
+                depth += 1
+                if character == '[' and depth == 2 and last_top_level_string == key:
+                    # the string right before a top-level array is its key.
+                    in_array = True
+                    found_array = True
+                elif character == '{' and depth == 3 and in_array:
+                    item_start = match.start()
+                    last_item_string = None
+            else:
+                depth -= 1
+                if in_array and depth == 2 and item_start is not None:
+                    yield json.loads(buffer[item_start:position])
+                    item_start = None
+                elif in_array and depth == 2 and skipping_item:
+                    skipping_item = False
+                elif in_array and depth == 1:
+                    in_array = False
+
+        # drop everything that has been consumed.
+        keep_from = item_start if item_start is not None else (string_start if in_string else position)
+        if keep_from > 0:
+            buffer = buffer[keep_from:]
+            position -= keep_from
+            string_start -= keep_from
+            last_item_string_end -= keep_from
+            if item_start is not None:
+                item_start -= keep_from
+
+    if not found_array:
+        raise KeyError(key)
 
 # ---------------------------------------- parsing study designer
 
 
-def create_study_designer_su_name_dictionary(study_designer_json, su_exclusion_list):
+class StudyDesignerResponseError(ValueError):
+    """
+    the study designer api returned json that is not a design export.
+    """
+
+
+def incorrect_study_designer_json(e):
+    """
+    returns the StudyDesignerResponseError for a KeyError, TypeError or json error raised while reading an export.
+    """
+    if isinstance(e, KeyError):
+        return StudyDesignerResponseError("study designer API get request returned an incorrect json, missing key: {}".format(e))
+    if isinstance(e, json.JSONDecodeError):
+        return StudyDesignerResponseError("study designer API get request did not return json: {}".format(e))
+    return StudyDesignerResponseError("study designer API get request returned an incorrect json: {}".format(e))
+
+
+def create_study_designer_su_name_dictionary(study_designer_json, rules):
     """
     creates a dictionary that maps su => name
     """
     try:
         su_name_map = {}
         for questionnaire in study_designer_json['questionnaires']:
-            if questionnaire['su'] not in su_exclusion_list:
+            if rules.su(questionnaire['su']):
                 su_name_map[questionnaire['su']] = questionnaire['name']
 
         return su_name_map
 
-    except KeyError as e:
-        print("study designer API get request returned an incorrect json\n:{}".format(study_designer_json))
-        sys.exit()
+    except (KeyError, TypeError) as e:
+        raise incorrect_study_designer_json(e)
 
 
-def create_study_designer_su_ig_it_dictionary(study_designer_json, su_exclusion_list, ig_exclusion_list):
+# one questionnaire item of su_ig_it_map[su][ig]. names are interned since the same su/ig/it repeats across items.
+StudyDesignerItem = namedtuple('StudyDesignerItem', ['it', 'includeInReports'])
+
+
+def add_study_designer_questionnaire(su_ig_it_map, questionnaire, rules):
+    """
+    adds the su => ig => [StudyDesignerItem, ...] relationships of one questionnaire to su_ig_it_map.
+    the items of an excluded su are never looked at.
+    """
+    if rules.su(questionnaire['su']):
+        ig_it_map = {}
+        for item in questionnaire['items']:
+            ig = item['ig']
+            if rules.ig(ig) and rules.it(item['it']):
+                if ig not in ig_it_map:
+                    ig_it_map[sys.intern(ig)] = []
+                ig_it_map[ig].append(StudyDesignerItem(sys.intern(item['it']), item['includeInReports']))
+        su_ig_it_map[sys.intern(questionnaire['su'])] = ig_it_map
+
+
+def create_study_designer_su_ig_it_dictionary(study_designer_json, rules=None):
     """
-    creates a nested dictionary for su ig it relationships
+    creates a nested dictionary for su ig it relationships.
+    raises StudyDesignerResponseError when the json is not a design export.
     """
+    rules = rules or default_exclusion_rules()
+    su_name_map = create_study_designer_su_name_dictionary(study_designer_json, rules)
+    su_ig_it_map = {}
+
+    try:
+        for questionnaire in study_designer_json['questionnaires']:
+            add_study_designer_questionnaire(su_ig_it_map, questionnaire, rules)
+    except (KeyError, TypeError) as e:
+        raise incorrect_study_designer_json(e)
 
-    su_name_map = create_study_designer_su_name_dictionary(study_designer_json, su_exclusion_list)
+    return su_name_map, su_ig_it_map
+
+
+def create_study_designer_su_ig_it_dictionary_streaming(questionnaires, rules=None):
+    """
+    streaming counterpart of create_study_designer_su_ig_it_dictionary. questionnaires is an iterator, each
+    questionnaire is folded into su_name_map and su_ig_it_map as it arrives and then dropped.
+    raises StudyDesignerResponseError when the json is not a design export.
+    """
+    rules = rules or default_exclusion_rules()
+    su_name_map = {}
     su_ig_it_map = {}
 
-    for questionnaire in study_designer_json['questionnaires']:
-        if questionnaire['su'] not in su_exclusion_list:
-            su_ig_it_map[questionnaire['su']] = {}
-            questionnaire_unique_ig_list = []
-            for item in questionnaire['items']:
-                if item['ig'] not in ig_exclusion_list:
-                    if item['ig'] not in questionnaire_unique_ig_list:
-                        su_ig_it_map[questionnaire['su']][item['ig']] = []
-                        su_ig_it_map[questionnaire['su']][item['ig']].append('.'.join([item['it'], str(item['includeInReports'])]))
-                        questionnaire_unique_ig_list.append(item['ig'])
-                    else:
-                        su_ig_it_map[questionnaire['su']][item['ig']].append('.'.join([item['it'], str(item['includeInReports'])]))
+    try:
+        for questionnaire in questionnaires:
+            if rules.su(questionnaire['su']):
+                su_name_map[questionnaire['su']] = questionnaire['name']
+            add_study_designer_questionnaire(su_ig_it_map, questionnaire, rules)
+
+    except (KeyError, TypeError, json.JSONDecodeError) as e:
+        raise incorrect_study_designer_json(e)
 
     return su_name_map, su_ig_it_map
 
 
-# ---------------------------------------- creating csvs and report diffs
-def smaller_list_to_larger_comparison(sm, lg):
+def fetch_study_designer_maps(latest_design_id, use_cache=True, ods_parser="streaming", rules=None):
     """
-    this function and next are used to insert --- MISMATCH --- in report columns where values mismatch.
-    make sure both lists are sorted before calling these functions.
+    downloads the export of one design and returns (su_name_map, su_ig_it_map, export_url).
+    the streaming ods_parser reads the export incrementally; full loads the whole json first.
     """
-    for i in range(len(sm)):
-        if sm[i] != lg[i]:
-            if sm[i] > lg[i]:
-                sm.insert(i, '~~~ MISMATCH ~~~')
-            else:
-                lg.insert(i, '~~~ MISMATCH ~~~')
+    rules = rules or default_exclusion_rules()
+    # designId@version pins an immutable export.
+    export_url = study_designer_export_url.format(latest_design_id)
+    immutable = '@' in latest_design_id
+
+    memo_key = (export_url, ods_parser, rules.key)
+    if immutable and use_cache:
+        with study_designer_memo_lock:
+            if memo_key in study_designer_memo:
+                study_designer_memo.move_to_end(memo_key)
+                su_name_map, su_ig_it_map = study_designer_memo[memo_key]
+                return su_name_map, su_ig_it_map, export_url
+
+    with profile_stage('fetch_study_designer_maps', design_id=latest_design_id, ods_parser=ods_parser):
+        if ods_parser == "full":
+            content = http_get_cached(export_url, immutable, use_cache)
+            try:
+                study_designer_json = json.loads(content.decode('latin-1').encode('utf8'))
+            except json.JSONDecodeError as e:
+                raise incorrect_study_designer_json(e)
+            su_name_map, su_ig_it_map = create_study_designer_su_ig_it_dictionary(study_designer_json, rules)
+        else:
+            # latin-1 maps every byte to one character, same as the full parser.
+            chunks = http_stream_cached(export_url, immutable, use_cache)
+            # excluded questionnaires are skipped by the scanner as soon as their su has been read.
+            questionnaires = iter_json_array_items((chunk.decode('latin-1') for chunk in chunks), 'questionnaires', 'su', rules.su)
+            su_name_map, su_ig_it_map = create_study_designer_su_ig_it_dictionary_streaming(questionnaires, rules)
+        if profile_stages is not None:
+            add_profile_counts(su=len(su_ig_it_map), ig=sum(len(ig_it_map) for ig_it_map in su_ig_it_map.values()),
+                               it=sum(len(items) for ig_it_map in su_ig_it_map.values() for items in ig_it_map.values()))
+
+    if immutable and use_cache:
+        # the maps are only ever read after this, so every check of the design can share them.
+        with study_designer_memo_lock:
+            study_designer_memo[memo_key] = (su_name_map, su_ig_it_map)
+            while len(study_designer_memo) > study_designer_memo_size:
+                study_designer_memo.popitem(last=False)
+
+    return su_name_map, su_ig_it_map, export_url
+
+
+def get_study_designer_maps(pn_metadata_protocol, use_cache=True, interactive=True, ods_parser="streaming", rules=None):
+    """
+    returns (su_name_map, su_ig_it_map, latest_design_id) for the latest design of the protocol.
+    """
+    latest_design_id = find_study_design_id(pn_metadata_protocol, use_cache, interactive)
+    su_name_map, su_ig_it_map, export_url = fetch_study_designer_maps(latest_design_id, use_cache, ods_parser, rules)
+    print("retrieved study json from http request to: \n{} \n".format(export_url))
 
+    return su_name_map, su_ig_it_map, latest_design_id
 
-def larger_list_to_smaller_comparison(list_a, list_b):
 
-    lg = list_a
-    sm = list_b
+def prefetch_study_designer_maps(pn_metadata_protocol, use_cache=True, ods_parser="streaming", workers=study_designer_fetch_workers, rules=None):
+    """
+    resolves the latest design of every protocol from a single designs list download and fetches the distinct
+    exports concurrently. never prints or prompts, so it can run in the background of the pn metadata parse.
+    returns protocol => (study_design_ids, latest_design_id, export_url, su_name_map, su_ig_it_map), with None after
+    study_design_ids for protocols without designs.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    study_designs = index_study_designs(use_cache)
+
+    latest_design_ids = {}
+    for protocol in pn_metadata_protocol:
+        study_design_ids = get_all_study_design_ids(protocol, use_cache, study_designs)
+        latest_design_ids[protocol] = (study_design_ids, find_latest_design_id(study_design_ids) if study_design_ids else None)
+
+    design_ids = sorted(set(latest_design_id for study_design_ids, latest_design_id in latest_design_ids.values() if latest_design_id is not None))
+    fetched = {}
+    if design_ids:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = dict((design_id, executor.submit(fetch_study_designer_maps, design_id, use_cache, ods_parser, rules)) for design_id in design_ids)
+            for design_id, future in futures.items():
+                fetched[design_id] = future.result()
+
+    protocol_designs = {}
+    for protocol, (study_design_ids, latest_design_id) in latest_design_ids.items():
+        if latest_design_id is None:
+            protocol_designs[protocol] = (study_design_ids, None, None, None, None)
+        else:
+            su_name_map, su_ig_it_map, export_url = fetched[latest_design_id]
+            protocol_designs[protocol] = (study_design_ids, latest_design_id, export_url, su_name_map, su_ig_it_map)
 
-    if len(list_b) > len(list_a):
-        lg = list_b
-        sm = list_a
+    return protocol_designs
 
-    for i in range(len(lg)):
-        if i < len(sm):
-            if lg[i] != sm[i] and sm[i] != '~~~ MISMATCH ~~~' and lg[i] != '~~~ MISMATCH ~~~':
-                if sm[i] > lg[i]:
-                    sm.insert(i, '~~~ MISMATCH ~~~')
-                else:
-                    lg.insert(i, '~~~ MISMATCH ~~~')
-                    larger_list_to_smaller_comparison(lg, sm)
+
+# ---------------------------------------- creating csvs and report diffs
+def align_sorted_columns(left, right):
+    """
+    merges two sorted columns into rows, inserting ~~~ MISMATCH ~~~ opposite every value the other column does not have.
+    equal values share a row. runs in a single pass over both columns.
+    """
+    aligned_left = []
+    aligned_right = []
+    i = 0
+    j = 0
+    while i < len(left) and j < len(right):
+        if left[i] == right[j]:
+            aligned_left.append(left[i])
+            aligned_right.append(right[j])
+            i += 1
+            j += 1
+        elif left[i] < right[j]:
+            aligned_left.append(left[i])
+            aligned_right.append('~~~ MISMATCH ~~~')
+            i += 1
         else:
-            sm.append('~~~ MISMATCH ~~~')
+            aligned_left.append('~~~ MISMATCH ~~~')
+            aligned_right.append(right[j])
+            j += 1
+
+    for item in left[i:]:
+        aligned_left.append(item)
+        aligned_right.append('~~~ MISMATCH ~~~')
+    for item in right[j:]:
+        aligned_left.append('~~~ MISMATCH ~~~')
+        aligned_right.append(item)
+
+    return aligned_left, aligned_right
 
 
 def add_includeInReports(ig_it_column, dict_includeInReports):
@@ -314,268 +1203,1901 @@ def add_includeInReports(ig_it_column, dict_includeInReports):
     return it_includeInReports
 
 
-# ----------------------------------------
+# ---------------------------------------- diff engine
+
+# (level, csv file name, pn_metadata column, study designer column) in report order.
+diff_levels = [
+    ('kdsu_su_name', 'kdsu_su_name.csv', 'kdsu_name', 'su_name'),
+    ('kdsu_su_id', 'kdsu_su_id.csv', 'kdsu', 'su'),
+    ('kdsu.kdig_su.ig_id', 'kdsu.kdig_su.ig_id.csv', 'kdsu-->kdig', 'su-->ig'),
+    ('kdig.kdit_ig.it_id', 'kdig.kdit_ig.it_it.includeInReports_id.csv', 'kdig-->kdit', 'ig-->it'),
+]
+
+# level => (title, pn_metadata only message, study designer only message) printed to the terminal.
+diff_level_messages = {
+    'kdsu_su_name': ("kdsu - su - names",
+                     "pn_metadata has the following kdsu names that are not present in study designer su name set: (kdsu_name vs. su_name)",
+                     "study_designer has the following su names values that are not present in pn_metadata kdsu name set: (su name vs. kdsu name)"),
+    'kdsu_su_id': ("kdsu - su - id",
+                   "pn_metadata has the following kdsu id values that are not present in study designer su id set: (kdsu vs. su)",
+                   "study_designer has the following su id values that are not present in pn_metadata kdsu id set: (su vs. kdsu)"),
+    'kdsu.kdig_su.ig_id': ("kdig - ig - id",
+                           "pn_metadata has the following kdig values that are not present in study designer ig set: (kdsu-->kdig vs. su-->ig)",
+                           "study_designer has the following su values that are not present in pn_metadata kdsu set: (su-->ig vs. kdsu-->kdig)"),
+    'kdig.kdit_ig.it_id': ("kdit - it - id",
+                           "pn_metadata has the following kdit values that are not present in study designer it set: (kdig-->kdit vs. ig-->it)",
+                           "study_designer has the following it values that are not present in pn_metadata kdit set: (ig-->it vs. kdig-->kdit)"),
+}
+
+# left_only / right_only are the sorted values missing from the other side, columns holds the aligned csv columns.
+LevelDiff = namedtuple('LevelDiff', ['level', 'csv_name', 'left_column', 'right_column', 'left_only', 'right_only', 'columns'])
+
+
+def normalize_diff_keys(kdSU_name_map, kdSU_kdIG_kdIT_map, su_name_map, su_ig_it_map):
+    """
+    flattens both sides into one pn_metadata and one study designer key column per level.
+    also returns the it => includeInReports lookup used by the kdit level.
+    """
+    kdsu_kdig = []
+    kdig_kdit = []
+    for kdsu, kdig_dict in kdSU_kdIG_kdIT_map.items():
+        for kdig, kdit_list in kdig_dict.items():
+            kdsu_kdig.append('-->'.join([kdsu, kdig]))
+            for kdit in kdit_list:
+                kdig_kdit.append('-->'.join([kdig, kdit]))
 
+    su_ig = []
+    ig_it = []
+    dict_includeInReports = {}
+    for su, ig_dict in su_ig_it_map.items():
+        for ig, it_list in ig_dict.items():
+            su_ig.append('-->'.join([su, ig]))
+            for item in it_list:
+                ig_it.append('-->'.join([ig, item.it]))
+                dict_includeInReports[item.it] = item.includeInReports
 
-def create_kdsu_su_name_csv_diff_report(kdSU_name_map, su_name_map):
+    keys = {
+        'kdsu_su_name': (list(kdSU_name_map.values()), list(su_name_map.values())),
+        'kdsu_su_id': (list(kdSU_name_map), list(su_name_map)),
+        'kdsu.kdig_su.ig_id': (kdsu_kdig, su_ig),
+        'kdig.kdit_ig.it_id': (kdig_kdit, ig_it),
+    }
 
-    df_dict = {}
-    df_dict['kdsu_name'] = []
-    df_dict['su_name'] = []
-    for kdsu, name in kdSU_name_map.items():
-        df_dict['kdsu_name'].append(name)
-    for su, name in su_name_map.items():
-        df_dict['su_name'].append(name)
+    return keys, dict_includeInReports
 
-    # report
-    kdsu_su_diff_name = sorted(list(set(df_dict['kdsu_name']) - set(df_dict['su_name'])))
-    su_kdsu_diff_name = sorted(list(set(df_dict['su_name']) - set(df_dict['kdsu_name'])))
 
-    print("------------------------------- kdsu - su - names -------------------------------")
-    print("pn_metadata has the following kdsu names that are not present in study designer su name set: (kdsu_name vs. su_name)")
-    if len(kdsu_su_diff_name) == 0:
-        print("ALL VALUES MATCH")
-    else:
-        for count, item in enumerate(kdsu_su_diff_name):
-            print('.    '.join([str(count + 1), item]))
-    print("study_designer has the following su names values that are not present in pn_metadata kdsu name set: (su name vs. kdsu name)")
-    if len(su_kdsu_diff_name) == 0:
-        print("ALL VALUES MATCH")
-    else:
-        for count, item in enumerate(su_kdsu_diff_name):
-            print('.    '.join([str(count + 1), item]))
-    print("\n")
-    # in case of rows not matching count, append the smaller one with 'ZZZ-None' so these rows end up at the buttom when column is sorted.
-    column_length_difference = len(df_dict['kdsu_name']) - len(df_dict['su_name'])
+def sorted_difference(sorted_keys, other_keys):
+    """
+    returns the unique values of an already sorted column that are not in the set other_keys, still sorted.
+    """
+    difference = []
+    for key in sorted_keys:
+        if key not in other_keys and (len(difference) == 0 or difference[-1] != key):
+            difference.append(key)
+
+    return difference
 
-    for column_name, column_rows in df_dict.items():
-        df_dict[column_name] = sorted(column_rows)
 
-    if column_length_difference > 0:
-        smaller_list_to_larger_comparison(df_dict['su_name'], df_dict['kdsu_name'])
-        larger_list_to_smaller_comparison(df_dict['kdsu_name'], df_dict['su_name'])
+def diff_group(left_keys, right_keys):
+    """
+    sorts, diffs and aligns one group of keys.
+    returns (left_column, right_column, left_only, right_only)
+    """
+    left_keys = sorted(left_keys)
+    right_keys = sorted(right_keys)
 
-    elif column_length_difference < 0:
-        smaller_list_to_larger_comparison(df_dict['kdsu_name'], df_dict['su_name'])
-        larger_list_to_smaller_comparison(df_dict['su_name'], df_dict['kdsu_name'])
+    left_only = sorted_difference(left_keys, set(right_keys))
+    right_only = sorted_difference(right_keys, set(left_keys))
+    left_column, right_column = align_sorted_columns(left_keys, right_keys)
 
-    df = pd.DataFrame(data=df_dict)
-    df.to_csv("csvs/{}_csvs/kdsu_su_name.csv".format(pn_metadata_file_name))
-    return df
+    return left_column, right_column, left_only, right_only
 
 
-def create_kdsu_su_id_csv_diff_report(kdSU_name_map, su_name_map):
+def level_diff_from_groups(level, group_results, dict_includeInReports):
+    """
+    concatenates the diff_group results of one level into a LevelDiff.
+    group_results maps a key prefix (kdsu/su or kdig/ig) to its result. keys sharing a prefix are contiguous
+    once sorted, so concatenating the groups in prefix order gives the same columns as diffing the level whole.
+    """
+    csv_name, left_column, right_column = [(csv_name, left_column, right_column) for name, csv_name, left_column, right_column in diff_levels if name == level][0]
 
-    df_dict = {}
-    df_dict['kdsu'] = []
-    df_dict['su'] = []
-    for kdsu, name in kdSU_name_map.items():
-        df_dict['kdsu'].append(kdsu)
-    for su, name in su_name_map.items():
-        df_dict['su'].append(su)
+    columns = {left_column: [], right_column: []}
+    left_only = []
+    right_only = []
+    for prefix in sorted(group_results, key=lambda prefix: prefix + '-->'):
+        group_left_column, group_right_column, group_left_only, group_right_only = group_results[prefix]
+        columns[left_column].extend(group_left_column)
+        columns[right_column].extend(group_right_column)
+        left_only.extend(group_left_only)
+        right_only.extend(group_right_only)
 
-    # report
-    kdsu_su_diff_id = sorted(list(set(df_dict['kdsu']) - set(df_dict['su'])))
-    su_kdsu_diff_id = sorted(list(set(df_dict['su']) - set(df_dict['kdsu'])))
+    if level == 'kdig.kdit_ig.it_id':
+        columns['it-->IncludeInReports'] = add_includeInReports(columns[right_column], dict_includeInReports)
 
-    print("------------------------------- kdsu - su - id -------------------------------")
-    print("pn_metadata has the following kdsu id values that are not present in study designer su id set: (kdsu vs. su)")
-    if len(kdsu_su_diff_id) == 0:
-        print("ALL VALUES MATCH")
-    else:
-        for count, item in enumerate(kdsu_su_diff_id):
-            print('.    '.join([str(count + 1), item]))
-    print("study_designer has the following su id values that are not present in pn_metadata kdsu id set: (su vs. kdsu)")
-    if len(su_kdsu_diff_id) == 0:
-        print("ALL VALUES MATCH")
-    else:
-        for count, item in enumerate(su_kdsu_diff_id):
-            print('.    '.join([str(count + 1), item]))
-    print("\n")
+    return LevelDiff(level, csv_name, left_column, right_column, left_only, right_only, columns)
 
-    # in case of rows not matching count, append the smaller one with 'ZZZ-None' so these rows end up at the buttom when column is sorted.
-    column_length_difference = len(df_dict['kdsu']) - len(df_dict['su'])
 
-    for column_name, column_rows in df_dict.items():
-        df_dict[column_name] = sorted(column_rows)
+def diff_pn_metadata_against_study_designer(kdSU_name_map, kdSU_kdIG_kdIT_map, su_name_map, su_ig_it_map):
+    """
+    computes all four report levels at once. returns a list of LevelDiff in report order.
+    every key column is sorted and hashed exactly once.
+    """
+    keys, dict_includeInReports = normalize_diff_keys(kdSU_name_map, kdSU_kdIG_kdIT_map, su_name_map, su_ig_it_map)
 
-    if column_length_difference > 0:
-        smaller_list_to_larger_comparison(df_dict['su'], df_dict['kdsu'])
-        larger_list_to_smaller_comparison(df_dict['kdsu'], df_dict['su'])
+    level_diffs = []
+    for level, csv_name, left_column, right_column in diff_levels:
+        left_keys, right_keys = keys[level]
+        level_diffs.append(level_diff_from_groups(level, {'': diff_group(left_keys, right_keys)}, dict_includeInReports))
 
-    elif column_length_difference < 0:
-        smaller_list_to_larger_comparison(df_dict['kdsu'], df_dict['su'])
-        larger_list_to_smaller_comparison(df_dict['su'], df_dict['kdsu'])
+    return level_diffs
 
-    df = pd.DataFrame(data=df_dict)
-    df.to_csv("csvs/{}_csvs/kdsu_su_id.csv".format(pn_metadata_file_name))
-    return df
+# ---------------------------------------- incremental diffs
 
 
-def create_kdig_ig_id_csv_diff_report(kdSU_kdIG_kdIT_map, su_ig_it_map):
+def fingerprint_signing_units(su_ig_map):
+    """
+    returns su => sha1 of its ig => it subtree. works for both kdSU_kdIG_kdIT_map and su_ig_it_map.
+    """
+    fingerprints = {}
+    for su, ig_dict in su_ig_map.items():
+        subtree = json.dumps([[ig, ig_dict[ig]] for ig in sorted(ig_dict)])
+        fingerprints[su] = hashlib.sha1(subtree.encode('utf8')).hexdigest()
+
+    return fingerprints
+
+
+def find_item_group_members(su_ig_map):
+    """
+    returns ig => [su, ...] for every item group, in signing unit order.
+    """
+    members = {}
+    for su, ig_dict in su_ig_map.items():
+        for ig in ig_dict:
+            members.setdefault(ig, []).append(su)
+
+    return members
+
+
+def load_incremental_state(pn_metadata_file_name):
+    """
+    returns the fingerprints and group results stored by the previous run of this file, or an empty state.
+    """
+    state_file_name = os.path.join(incremental_directory, "{}.pickle".format(os.path.basename(pn_metadata_file_name)))
+    try:
+        with open(state_file_name, 'rb') as f:
+            state = pickle.load(f)
+        if state['version'] == incremental_state_version:
+            return state
+    except (OSError, pickle.UnpicklingError, EOFError, KeyError):
+        pass
+
+    return {'version': incremental_state_version, 'left_fingerprints': {}, 'right_fingerprints': {},
+            'left_groups': {}, 'right_groups': {}, 'su_results': {}, 'ig_results': {}}
+
+
+def save_incremental_state(pn_metadata_file_name, state):
+    """
+    stores this run's fingerprints and group results for the next run of this file.
+    """
+    if not os.path.isdir(incremental_directory):
+        os.makedirs(incremental_directory, exist_ok=True)
+
+    state_file_name = os.path.join(incremental_directory, "{}.pickle".format(os.path.basename(pn_metadata_file_name)))
+    temp_file_name = "{}.{}.tmp".format(state_file_name, os.getpid())
+    with open(temp_file_name, 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_file_name, state_file_name)
 
-    df_dict = {}
-    df_dict['kdsu-->kdig'] = []
-    df_dict['su-->ig'] = []
-    for kdsu, kdig_dict in kdSU_kdIG_kdIT_map.items():
-        for kdig, kdit_list in kdig_dict.items():
-            df_dict['kdsu-->kdig'].append('-->'.join([kdsu, kdig]))
 
+def diff_pn_metadata_against_study_designer_incremental(pn_metadata_file_name, kdSU_name_map, kdSU_kdIG_kdIT_map, su_name_map, su_ig_it_map):
+    """
+    same result as diff_pn_metadata_against_study_designer, but only re-diffs the signing units whose subtrees
+    changed since the last run of this file. kdsu-->kdig rows are grouped per signing unit and kdig-->kdit rows
+    per item group; an item group is re-diffed when any signing unit that has or had it changed.
+    the name and id levels are a handful of rows and are always recomputed.
+    """
+    state = load_incremental_state(pn_metadata_file_name)
+
+    left_fingerprints = fingerprint_signing_units(kdSU_kdIG_kdIT_map)
+    right_fingerprints = fingerprint_signing_units(su_ig_it_map)
+
+    changed_signing_units = set()
+    for fingerprints, previous_fingerprints in [(left_fingerprints, state['left_fingerprints']), (right_fingerprints, state['right_fingerprints'])]:
+        for su in set(fingerprints) | set(previous_fingerprints):
+            if fingerprints.get(su) != previous_fingerprints.get(su):
+                changed_signing_units.add(su)
+
+    changed_item_groups = set()
+    for su in changed_signing_units:
+        changed_item_groups.update(kdSU_kdIG_kdIT_map.get(su, {}))
+        changed_item_groups.update(su_ig_it_map.get(su, {}))
+        changed_item_groups.update(state['left_groups'].get(su, []))
+        changed_item_groups.update(state['right_groups'].get(su, []))
+
+    su_results = {}
+    for su in set(kdSU_kdIG_kdIT_map) | set(su_ig_it_map):
+        if su not in changed_signing_units and su in state['su_results']:
+            su_results[su] = state['su_results'][su]
+        else:
+            left_keys = ['-->'.join([su, kdig]) for kdig in kdSU_kdIG_kdIT_map.get(su, {})]
+            right_keys = ['-->'.join([su, ig]) for ig in su_ig_it_map.get(su, {})]
+            su_results[su] = diff_group(left_keys, right_keys)
+
+    left_members = find_item_group_members(kdSU_kdIG_kdIT_map)
+    right_members = find_item_group_members(su_ig_it_map)
+    ig_results = {}
+    for ig in set(left_members) | set(right_members):
+        if ig not in changed_item_groups and ig in state['ig_results']:
+            ig_results[ig] = state['ig_results'][ig]
+        else:
+            left_keys = ['-->'.join([ig, kdit]) for kdsu in left_members.get(ig, []) for kdit in kdSU_kdIG_kdIT_map[kdsu][ig]]
+            right_keys = ['-->'.join([ig, item.it]) for su in right_members.get(ig, []) for item in su_ig_it_map[su][ig]]
+            ig_results[ig] = diff_group(left_keys, right_keys)
+
+    print("incremental re-check: {0} of {1} signing units and {2} of {3} item groups re-diffed \n".format(
+        len(changed_signing_units), len(su_results), len(changed_item_groups), len(ig_results)))
+
+    save_incremental_state(pn_metadata_file_name, {
+        'version': incremental_state_version,
+        'left_fingerprints': left_fingerprints,
+        'right_fingerprints': right_fingerprints,
+        'left_groups': dict((kdsu, list(kdig_dict)) for kdsu, kdig_dict in kdSU_kdIG_kdIT_map.items()),
+        'right_groups': dict((su, list(ig_dict)) for su, ig_dict in su_ig_it_map.items()),
+        'su_results': su_results,
+        'ig_results': ig_results,
+    })
+
+    dict_includeInReports = {}
     for su, ig_dict in su_ig_it_map.items():
         for ig, it_list in ig_dict.items():
-            df_dict['su-->ig'].append('-->'.join([su, ig]))
+            for item in it_list:
+                dict_includeInReports[item.it] = item.includeInReports
 
-    # report
-    kdig_ig_diff = sorted(list(set(df_dict['kdsu-->kdig']) - set(df_dict['su-->ig'])))
-    ig_kdig_diff = sorted(list(set(df_dict['su-->ig']) - set(df_dict['kdsu-->kdig'])))
+    return [
+        level_diff_from_groups('kdsu_su_name', {'': diff_group(kdSU_name_map.values(), su_name_map.values())}, dict_includeInReports),
+        level_diff_from_groups('kdsu_su_id', {'': diff_group(kdSU_name_map, su_name_map)}, dict_includeInReports),
+        level_diff_from_groups('kdsu.kdig_su.ig_id', su_results, dict_includeInReports),
+        level_diff_from_groups('kdig.kdit_ig.it_id', ig_results, dict_includeInReports),
+    ]
 
-    print("------------------------------- kdig - ig - id -------------------------------")
-    print("pn_metadata has the following kdig values that are not present in study designer ig set: (kdsu-->kdig vs. su-->ig)")
-    if len(kdig_ig_diff) == 0:
-        print("ALL VALUES MATCH")
-    else:
-        for count, item in enumerate(kdig_ig_diff):
-            print('.    '.join([str(count + 1), item]))
-    print("study_designer has the following su values that are not present in pn_metadata kdsu set: (su-->ig vs. kdsu-->kdig)")
-    if len(ig_kdig_diff) == 0:
-        print("ALL VALUES MATCH")
-    else:
-        for count, item in enumerate(ig_kdig_diff):
-            print('.    '.join([str(count + 1), item]))
+
+def clear_incremental_state():
+    """
+    removes every stored incremental state.
+    """
+    if os.path.isdir(incremental_directory):
+        for entry in os.scandir(incremental_directory):
+            if entry.name.endswith(".pickle") or entry.name.endswith(".tmp"):
+                os.remove(entry.path)
+
+# ---------------------------------------- rendering diffs
+
+
+def print_level_diff(level_diff):
+    """
+    prints the values each side is missing for one level.
+    """
+    title, left_message, right_message = diff_level_messages[level_diff.level]
+
+    print("------------------------------- {} -------------------------------".format(title))
+    for message, only in [(left_message, level_diff.left_only), (right_message, level_diff.right_only)]:
+        print(message)
+        if len(only) == 0:
+            print("ALL VALUES MATCH")
+        else:
+            for count, item in enumerate(only):
+                print('.    '.join([str(count + 1), item]))
     print("\n")
 
-    column_length_difference = len(df_dict['kdsu-->kdig']) - len(df_dict['su-->ig'])
 
-    for column_name, column_rows in df_dict.items():
-        df_dict[column_name] = sorted(column_rows)
+def level_diff_dataframe(level_diff):
+    """
+    returns the aligned columns of one level as a pandas DataFrame.
+    pandas is optional and only imported here, the csvs and reports are written without it.
+    """
+    import pandas as pd
+    return pd.DataFrame(data=level_diff.columns)
 
-    if column_length_difference > 0:
-        smaller_list_to_larger_comparison(df_dict['su-->ig'], df_dict['kdsu-->kdig'])
-        larger_list_to_smaller_comparison(df_dict['kdsu-->kdig'], df_dict['su-->ig'])
 
-    elif column_length_difference < 0:
-        smaller_list_to_larger_comparison(df_dict['kdsu-->kdig'], df_dict['su-->ig'])
-        larger_list_to_smaller_comparison(df_dict['su-->ig'], df_dict['kdsu-->kdig'])
+def level_diff_rows(level_diff):
+    """
+    yields the aligned rows of one level as (index, [value, ...]), in column order.
+    """
+    columns = list(level_diff.columns.values())
+    for index, row in enumerate(zip(*columns)):
+        yield index, row
 
-    df = pd.DataFrame(data=df_dict)
-    df.to_csv("csvs/{}_csvs/kdsu.kdig_su.ig_id.csv".format(pn_metadata_file_name))
-    return df
 
+def write_level_diff_csv(level_diff, pn_metadata_file_name):
+    """
+    writes one level to csvs/<file>_csvs/ row by row, in the layout DataFrame.to_csv used: an unnamed index column
+    followed by the level's columns.
+    """
+    with open("csvs/{}_csvs/{}".format(pn_metadata_file_name, level_diff.csv_name), 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f, lineterminator=os.linesep)
+        writer.writerow([''] + list(level_diff.columns))
+        for index, row in level_diff_rows(level_diff):
+            writer.writerow([index] + list(row))
 
-def create_kdit_it_id_csv_diff_report(kdSU_kdIG_kdIT_map, su_ig_it_map):
-    '''
-    this function outputs two dataframes; one with columns kdig-->kdit ig-->it.
-    '''
 
-    df_dict = {}
+def escape_report_value(value):
+    """
+    escapes tabs and line breaks the way DataFrame.to_string does, so every row stays on one line.
+    """
+    return value.replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
 
-    df_dict['kdig-->kdit'] = []
-    df_dict['ig-->it'] = []
 
-    df_dict_includeInReports = {}
+def write_level_diff_text(level_diff, file):
+    """
+    writes one level as a fixed-width table, the same text DataFrame.to_string produced: a left aligned index,
+    then each column right aligned behind one space, its values prefixed with one more.
+    one pass over the columns finds the widths, a second one writes the rows out.
+    """
+    names = list(level_diff.columns)
+    columns = [level_diff.columns[name] for name in names]
+    row_count = len(columns[0]) if columns else 0
+    if row_count == 0:
+        file.write("Empty DataFrame\nColumns: [{}]\nIndex: []".format(', '.join(names)))
+        return
 
-    for kdsu, kdig_dict in kdSU_kdIG_kdIT_map.items():
-        for kdig, kdit_list in kdig_dict.items():
-            for kdit in kdit_list:
-                df_dict['kdig-->kdit'].append('-->'.join([kdig, kdit]))
+    index_width = len(str(row_count - 1))
+    widths = [max(len(name), max(len(escape_report_value(value)) for value in column) + 1) for name, column in zip(names, columns)]
 
-    for su, ig_dict in su_ig_it_map.items():
-        for ig, it_list in ig_dict.items():
-            for it in it_list:
-                temp = it.split('.')
-                it_without_includeinreport = temp[0]
-                df_dict['ig-->it'].append('-->'.join([ig, it_without_includeinreport]))
-                df_dict_includeInReports[it_without_includeinreport] = temp[1]
-
-    # report
-    kdit_it_diff = sorted(list(set(df_dict['kdig-->kdit']) - set(df_dict['ig-->it'])))
-    it_kdit_diff = sorted(list(set(df_dict['ig-->it']) - set(df_dict['kdig-->kdit'])))
-
-    print("------------------------------- kdit - it - id -------------------------------")
-    print("pn_metadata has the following kdit values that are not present in study designer it set: (kdig-->kdit vs. ig-->it)")
-    if len(kdit_it_diff) == 0:
-        print("ALL VALUES MATCH")
-    else:
-        for count, item in enumerate(kdit_it_diff):
-            print('.    '.join([str(count + 1), item]))
-    print("study_designer has the following it values that are not present in pn_metadata kdit set: (ig-->it vs. kdig-->kdit)")
-    if len(it_kdit_diff) == 0:
-        print("ALL VALUES MATCH")
-    else:
-        for count, item in enumerate(it_kdit_diff):
-            print('.    '.join([str(count + 1), item]))
-    print("\n")
+    file.write(' ' * index_width)
+    for name, width in zip(names, widths):
+        file.write(' ' + name.rjust(width))
+    for index, row in level_diff_rows(level_diff):
+        file.write('\n' + str(index).ljust(index_width))
+        for value, width in zip(row, widths):
+            file.write(' ' + escape_report_value(value).rjust(width))
 
-    column_length_difference = len(df_dict['kdig-->kdit']) - len(df_dict['ig-->it'])
 
-    for column_name, column_rows in df_dict.items():
-        df_dict[column_name] = sorted(column_rows)
+# ---------------------------------------- profiling
 
-    if column_length_difference > 0:
-        smaller_list_to_larger_comparison(df_dict['ig-->it'], df_dict['kdig-->kdit'])
-        larger_list_to_smaller_comparison(df_dict['kdig-->kdit'], df_dict['ig-->it'])
-        df_dict['it-->IncludeInReports'] = add_includeInReports(df_dict['ig-->it'], df_dict_includeInReports)
 
-    elif column_length_difference < 0:
-        smaller_list_to_larger_comparison(df_dict['kdig-->kdit'], df_dict['ig-->it'])
-        larger_list_to_smaller_comparison(df_dict['ig-->it'], df_dict['kdig-->kdit'])
-        df_dict['it-->IncludeInReports'] = add_includeInReports(df_dict['ig-->it'], df_dict_includeInReports)
+def peak_rss_mb():
+    """
+    returns the peak resident set size of the process so far in MB, or None where getrusage is unavailable.
+    """
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macos bytes.
+    return round(max_rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
 
-    df = pd.DataFrame(data=df_dict)
-    df.to_csv("csvs/{}_csvs/kdig.kdit_ig.it_it.includeInReports_id.csv".format(pn_metadata_file_name))
-    return df
 
+def fold_traced_peak():
+    """
+    tracemalloc only keeps one process wide peak. it is folded into every open stage and reset at each stage
+    boundary, so a stage ends up with the highest traced memory seen while it was open, on any thread.
+    call with profile_lock held.
+    """
+    if not tracemalloc.is_tracing():
+        return
+    traced_peak = tracemalloc.get_traced_memory()[1]
+    for stage in profile_open_stages:
+        stage['traced_peak_bytes'] = max(stage.get('traced_peak_bytes', 0), traced_peak)
+    tracemalloc.reset_peak()
 
-if __name__ == "__main__":
-    pn_metadata_file_name = user_input_pn_metadata_file_name()
-    # pn_metadata_file_name = "pn_metadata.xml"
-    print("parsing {}... \n".format(pn_metadata_file_name))
 
-    soup_datadictionary, pn_metadata_protocol = find_study_protocols(pn_metadata_file_name)
-    print("the protocols for this study according to {0} are: \n{1} \n".format(pn_metadata_file_name, pn_metadata_protocol))
+@contextlib.contextmanager
+def profile_stage(name, **counts):
+    """
+    records one pipeline stage of a profiled run: wall time, cpu time of the calling thread, peak rss,
+    the traced peak with --profile-memory, and any counts given here or through add_profile_counts.
+    does nothing when no profiled run is in progress.
+    """
+    if profile_stages is None:
+        yield
+        return
+
+    stack = getattr(profile_local, 'stack', None)
+    if stack is None:
+        stack = profile_local.stack = []
+    stage = {'stage': name, 'thread': threading.current_thread().name, 'depth': len(stack), 'start_s': time.perf_counter()}
+    stage.update(counts)
+    stack.append(stage)
+    with profile_lock:
+        fold_traced_peak()
+        profile_open_stages.append(stage)
+    start_time = time.perf_counter()
+    start_cpu_time = time.thread_time()
+    try:
+        yield
+    finally:
+        stage['wall_s'] = round(time.perf_counter() - start_time, 6)
+        stage['cpu_s'] = round(time.thread_time() - start_cpu_time, 6)
+        stage['peak_rss_mb'] = peak_rss_mb()
+        stack.pop()
+        with profile_lock:
+            fold_traced_peak()
+            profile_open_stages.remove(stage)
+            if 'traced_peak_bytes' in stage:
+                stage['traced_peak_mb'] = round(stage.pop('traced_peak_bytes') / (1024 * 1024), 2)
+            if profile_stages is not None:
+                profile_stages.append(stage)
+
+
+def add_profile_counts(**counts):
+    """
+    adds element/row counts to the innermost stage open on this thread.
+    """
+    stack = getattr(profile_local, 'stack', None)
+    if profile_stages is not None and stack:
+        stack[-1].update(counts)
+
+
+def add_profile_http_request(request):
+    """
+    records one study designer request: url, status, bytes, latency to the response headers and total time.
+    """
+    if profile_http_requests is not None:
+        with profile_lock:
+            profile_http_requests.append(request)
+
+
+@contextlib.contextmanager
+def profile_run(pn_metadata_file_name, trace_memory=False, cprofile=False):
+    """
+    profiles one check and writes reports/<file>_profile.json when it ends, whether it passed, failed or raised.
+    trace_memory turns on tracemalloc, which slows the run down noticeably.
+    cprofile also dumps reports/<file>_profile.pstats of the main thread for a look with pstats or snakeviz.
+    """
+    global profile_stages, profile_http_requests
+    profile_stages = []
+    profile_http_requests = []
+    started = time.time()
+    if trace_memory:
+        tracemalloc.start()
+    profiler = cProfile.Profile() if cprofile else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        with profile_stage('run', file=pn_metadata_file_name):
+            yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        if trace_memory:
+            tracemalloc.stop()
+
+        with profile_lock:
+            stages = sorted(profile_stages, key=lambda stage: stage['start_s'])
+            http_requests = profile_http_requests
+            profile_stages = None
+            profile_http_requests = None
+        # start_s becomes the offset from the start of the run.
+        run_start_time = stages[0]['start_s']
+        for stage in stages:
+            stage['start_s'] = round(stage['start_s'] - run_start_time, 6)
+
+        profile = {
+            'file': pn_metadata_file_name,
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(started)),
+            'python': sys.version.split()[0],
+            'stages': stages,
+            'http': {
+                'requests': http_requests,
+                'bytes': sum(request['bytes'] for request in http_requests),
+                'wall_s': round(sum(request['wall_s'] for request in http_requests), 6),
+            },
+        }
+
+        if not os.path.isdir("reports"):
+            os.makedirs("reports", exist_ok=True)
+        profile_file_name = "reports/{}_profile.json".format(os.path.basename(pn_metadata_file_name))
+        with open(profile_file_name, 'w') as f:
+            json.dump(profile, f, indent=2)
+        print("wrote run profile to: \n{} \n".format(profile_file_name))
+
+        if profiler is not None:
+            pstats_file_name = "reports/{}_profile.pstats".format(os.path.basename(pn_metadata_file_name))
+            profiler.dump_stats(pstats_file_name)
+            print("wrote cProfile stats to: \n{} \n".format(pstats_file_name))
+
+# ---------------------------------------- columnar reports
+#
+# --columnar also writes reports/<file>_report.mcr, all four diff tables of a run in one little-endian file that
+# can be memory-mapped and read without parsing any text. every string is stored once in a dictionary and the
+# columns hold uint32 ids into it. every section starts on an 8 byte boundary.
+#
+#   header           magic "MCHKCOL1", uint32 version, uint32 table_count, uint32 string_count,
+#                    uint32 metadata_id (a json object: file, written, checker version), uint64 dictionary_offset
+#   table_count x    uint32 level_id, uint32 csv_name_id, uint32 row_count, uint32 column_count,
+#                    uint64 bitmap_offset, uint64 columns_offset
+#   per table        column_count x (uint32 name_id, uint32 reserved, uint64 values_offset),
+#                    then each column's row_count x uint32 string ids,
+#                    then the mismatch bitmap: ceil(row_count / 8) bytes, bit i (lsb first) set when row i has
+#                    ~~~ MISMATCH ~~~ in any column
+#   dictionary       (string_count + 1) x uint64 offsets relative to the start of the utf-8 blob, then the blob
+
+
+columnar_report_magic = b'MCHKCOL1'
+columnar_report_version = 1
+columnar_report_header = struct.Struct('<8sIIIIQ')
+columnar_report_table = struct.Struct('<IIIIQQ')
+columnar_report_column = struct.Struct('<IIQ')
+
+ColumnarTable = namedtuple('ColumnarTable', ['level', 'csv_name', 'row_count', 'columns', 'mismatch_bitmap'])
+
+
+def pad_to_8(offset):
+    """
+    returns offset rounded up to the next multiple of 8.
+    """
+    return (offset + 7) & ~7
+
+
+def uint_array_bytes(typecode, values):
+    """
+    returns values as little-endian bytes of the given array typecode.
+    """
+    values = array(typecode, values)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values.tobytes()
+
+
+def write_columnar_report(file_name, level_diffs, metadata):
+    """
+    writes the level diffs of one run to file_name in the columnar layout described above.
+    """
+    string_ids = {}
+
+    def string_id(value):
+        if value not in string_ids:
+            string_ids[value] = len(string_ids)
+        return string_ids[value]
+
+    metadata_id = string_id(json.dumps(metadata, sort_keys=True))
+    string_id('~~~ MISMATCH ~~~')
+
+    tables = []
+    for level_diff in level_diffs:
+        names = list(level_diff.columns)
+        row_count = len(level_diff.columns[names[0]]) if names else 0
+        columns = [(string_id(name), uint_array_bytes('I', [string_id(value) for value in level_diff.columns[name]])) for name in names]
+        mismatch_bitmap = bytearray((row_count + 7) // 8)
+        for index, row in level_diff_rows(level_diff):
+            if '~~~ MISMATCH ~~~' in row:
+                mismatch_bitmap[index >> 3] |= 1 << (index & 7)
+        tables.append((string_id(level_diff.level), string_id(level_diff.csv_name), row_count, columns, bytes(mismatch_bitmap)))
+
+    # lay the sections out before writing anything.
+    offset = columnar_report_header.size + len(tables) * columnar_report_table.size
+    table_entries = []
+    for level_id, csv_name_id, row_count, columns, mismatch_bitmap in tables:
+        columns_offset = pad_to_8(offset)
+        offset = columns_offset + len(columns) * columnar_report_column.size
+        column_entries = []
+        for name_id, values in columns:
+            values_offset = pad_to_8(offset)
+            column_entries.append((name_id, values_offset, values))
+            offset = values_offset + len(values)
+        bitmap_offset = pad_to_8(offset)
+        offset = bitmap_offset + len(mismatch_bitmap)
+        table_entries.append((level_id, csv_name_id, row_count, columns_offset, column_entries, bitmap_offset, mismatch_bitmap))
+    dictionary_offset = pad_to_8(offset)
+
+    encoded_strings = [value.encode('utf8') for value in string_ids]
+    string_offsets = [0]
+    for encoded in encoded_strings:
+        string_offsets.append(string_offsets[-1] + len(encoded))
+
+    temp_file_name = "{}.{}.tmp".format(file_name, os.getpid())
+    with open(temp_file_name, 'wb') as f:
+
+        def write_at(position, data):
+            f.write(b'\0' * (position - f.tell()))
+            f.write(data)
+
+        f.write(columnar_report_header.pack(columnar_report_magic, columnar_report_version, len(tables), len(string_ids), metadata_id, dictionary_offset))
+        for level_id, csv_name_id, row_count, columns_offset, column_entries, bitmap_offset, mismatch_bitmap in table_entries:
+            f.write(columnar_report_table.pack(level_id, csv_name_id, row_count, len(column_entries), bitmap_offset, columns_offset))
+        for level_id, csv_name_id, row_count, columns_offset, column_entries, bitmap_offset, mismatch_bitmap in table_entries:
+            write_at(columns_offset, b''.join(columnar_report_column.pack(name_id, 0, values_offset) for name_id, values_offset, values in column_entries))
+            for name_id, values_offset, values in column_entries:
+                write_at(values_offset, values)
+            write_at(bitmap_offset, mismatch_bitmap)
+        write_at(dictionary_offset, uint_array_bytes('Q', string_offsets))
+        f.write(b''.join(encoded_strings))
+    os.replace(temp_file_name, file_name)
+
+
+def read_columnar_report(file_name):
+    """
+    memory-maps a columnar report and returns (metadata, strings, tables).
+    strings is the decoded dictionary. tables is a list of ColumnarTable whose columns map each column name to a
+    memoryview of uint32 string ids into strings, and whose mismatch_bitmap is a memoryview of the bitmap bytes,
+    so the column data is only paged in when it is used.
+    """
+    with open(file_name, 'rb') as f:
+        mapped = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    magic, version, table_count, string_count, metadata_id, dictionary_offset = columnar_report_header.unpack_from(mapped, 0)
+    if magic != columnar_report_magic or version != columnar_report_version:
+        raise ValueError("{} is not a version {} columnar report".format(file_name, columnar_report_version))
 
-    # pn_metadata
-    kdSU_name_map, kdSU_kdIG_kdIT_map = create_pn_metadata_kdSU_kdIG_kdIT_dictionary(soup_datadictionary, kdSU_exclusion_list, kdIG_exclusion_list)
-    # print("pn_metadata kdsu => name: \n{} \n".format(kdSU_name_map))
-    # print("pn_metadata kdSU => kdIG => kdIT: \n{} \n".format(kdSU_kdIG_kdIT_map))
+    def uint_view(typecode, offset, count):
+        size = array(typecode).itemsize
+        view = mapped[offset:offset + count * size]
+        if sys.byteorder != 'little':
+            values = array(typecode, view.tobytes())
+            values.byteswap()
+            return memoryview(values)
+        return view.cast(typecode)
 
-    # getting study designer study json
-    study_designer_json = get_study_designer_json(soup_datadictionary, pn_metadata_protocol)
+    string_offsets = uint_view('Q', dictionary_offset, string_count + 1)
+    blob_offset = dictionary_offset + (string_count + 1) * 8
+    strings = [bytes(mapped[blob_offset + string_offsets[i]:blob_offset + string_offsets[i + 1]]).decode('utf8') for i in range(string_count)]
 
-    # study designer
-    # print("parsing study designer json ... \n")
-    su_name_map, su_ig_it_map = create_study_designer_su_ig_it_dictionary(study_designer_json, su_exclusion_list, ig_exclusion_list)
-    # print("study_designer su => name: \n{} \n".format(su_name_map))
-    # print("study_designer su => ig => it: \n{} \n".format(su_ig_it_map))
+    tables = []
+    for table in range(table_count):
+        level_id, csv_name_id, row_count, column_count, bitmap_offset, columns_offset = columnar_report_table.unpack_from(mapped, columnar_report_header.size + table * columnar_report_table.size)
+        columns = {}
+        for column in range(column_count):
+            name_id, reserved, values_offset = columnar_report_column.unpack_from(mapped, columns_offset + column * columnar_report_column.size)
+            columns[strings[name_id]] = uint_view('I', values_offset, row_count)
+        tables.append(ColumnarTable(strings[level_id], strings[csv_name_id], row_count, columns, mapped[bitmap_offset:bitmap_offset + (row_count + 7) // 8]))
 
-    # print(su_ig_it_map)
+    return json.loads(strings[metadata_id]), strings, tables
+
+
+# ---------------------------------------- running checks
+
+
+def write_pn_metadata_reports(pn_metadata_file_name, level_diffs, columnar=False):
+    """
+    writes the four csvs under csvs/<file>_csvs/ and the combined reports/<file>_report.txt.
+    with columnar, also the four tables in one reports/<file>_report.mcr, see write_columnar_report.
+    """
+    pn_metadata_file_name = os.path.basename(pn_metadata_file_name)
 
-    # ---------------------------------------- creating csvs + reports
     if not os.path.exists("csvs/{}_csvs".format(pn_metadata_file_name)):
-        os.makedirs("csvs/{}_csvs".format(pn_metadata_file_name))
+        os.makedirs("csvs/{}_csvs".format(pn_metadata_file_name), exist_ok=True)
 
     report_file_name = "{}_report.txt".format(pn_metadata_file_name)
 
     if not os.path.isdir("reports"):
-        os.mkdir("reports")
+        os.makedirs("reports", exist_ok=True)
 
     if os.path.exists("reports/{}".format(report_file_name)):
         os.remove("reports/{}".format(report_file_name))
 
     with open("reports/{}".format(report_file_name), "a+") as file:
+        for level_diff in level_diffs:
+            print_level_diff(level_diff)
+            write_level_diff_csv(level_diff, pn_metadata_file_name)
+            write_level_diff_text(level_diff, file)
+            file.write('\n\n')
+
+    if columnar:
+        metadata = {'file': pn_metadata_file_name, 'written': time.strftime('%Y-%m-%dT%H:%M:%S'), 'version': __version__}
+        write_columnar_report("reports/{}_report.mcr".format(pn_metadata_file_name), level_diffs, metadata)
+
+
+def find_mismatch_levels(level_diffs):
+    """
+    returns the names of the report levels where pn_metadata and study designer differ.
+    """
+    return [level_diff.level for level_diff in level_diffs if level_diff.left_only or level_diff.right_only]
+
+
+def protocol_report_name(pn_metadata_file_name, protocol):
+    """
+    returns the name the csvs and report of one protocol are written under, e.g. pn_metadata.xml_ODS-OR1
+    """
+    return "{}_{}".format(os.path.basename(pn_metadata_file_name), re.sub(r'[^A-Za-z0-9._-]+', '_', protocol))
+
+
+def load_pn_metadata_and_designs(pn_metadata_file_name, parser="streaming", use_cache=True, cache_size_mb=pn_metadata_cache_max_size_mb, ods_parser="streaming", overlap=True, design_workers=study_designer_fetch_workers, rules=None, design_id=None):
+    """
+    parses the pn metadata file and fetches the latest design of each of its protocols.
+    with overlap, the study designer lookup and download start on a background thread as soon as the protocols
+    have been read, while the kdSU/kdIG/kdIT extraction carries on.
+    returns (pn_metadata_protocol, kdSU_name_map, kdSU_kdIG_kdIT_map, protocol_designs), see prefetch_study_designer_maps.
+    with design_id that design is downloaded alongside the parse instead, and protocol_designs only has a None entry.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    if design_id is not None:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(fetch_study_designer_maps, design_id, use_cache, ods_parser, rules)
+            pn_metadata_protocol, kdSU_name_map, kdSU_kdIG_kdIT_map = parse_pn_metadata(pn_metadata_file_name, parser, use_cache, cache_size_mb, rules=rules)
+            with profile_stage('get_study_designer_maps', overlapped=True):
+                su_name_map, su_ig_it_map, export_url = future.result()
+        return pn_metadata_protocol, kdSU_name_map, kdSU_kdIG_kdIT_map, {None: ([design_id], design_id, export_url, su_name_map, su_ig_it_map)}
+
+    prefetch = {}
+    with ThreadPoolExecutor(max_workers=1) as executor:
+
+        def on_protocols(pn_metadata_protocol):
+            prefetch['protocol'] = pn_metadata_protocol
+            prefetch['future'] = executor.submit(prefetch_study_designer_maps, pn_metadata_protocol, use_cache, ods_parser, design_workers, rules)
+
+        pn_metadata_protocol, kdSU_name_map, kdSU_kdIG_kdIT_map = parse_pn_metadata(pn_metadata_file_name, parser, use_cache, cache_size_mb, on_protocols if overlap else None, rules)
+        # print("pn_metadata kdsu => name: \n{} \n".format(kdSU_name_map))
+        # print("pn_metadata kdSU => kdIG => kdIT: \n{} \n".format(kdSU_kdIG_kdIT_map))
+
+        # study designer
+        with profile_stage('get_study_designer_maps', overlapped=bool(prefetch) and prefetch['protocol'] == pn_metadata_protocol):
+            if prefetch and prefetch['protocol'] == pn_metadata_protocol:
+                protocol_designs = prefetch['future'].result()
+            else:
+                if prefetch:
+                    # more protocols turned up after the first Protocol CodeListDef, the prefetched designs may be incomplete.
+                    prefetch['future'].cancel()
+                protocol_designs = prefetch_study_designer_maps(pn_metadata_protocol, use_cache, ods_parser, design_workers, rules)
+
+    return pn_metadata_protocol, kdSU_name_map, kdSU_kdIG_kdIT_map, protocol_designs
+
+
+def run_pn_metadata_check(pn_metadata_file_name, parser="streaming", use_cache=True, cache_size_mb=pn_metadata_cache_max_size_mb, interactive=True, incremental=False, ods_parser="streaming", overlap=True, design_workers=study_designer_fetch_workers, profile=False, profile_memory=False, cprofile=False, columnar=False, history=True, rules_file_name=None, design_id=None, history_database_file_name=None):
+    """
+    runs the whole check for one pn metadata file and writes its csvs and report.
+    overlap starts the study designer download while the file is still being parsed, see load_pn_metadata_and_designs.
+    every protocol with a design is checked against its latest design. with several protocols each one gets its own
+    csvs/<file>_<protocol>_csvs/ and reports/<file>_<protocol>_report.txt. with design_id the file is checked
+    against that design only.
+    returns the list of levels that do not match the study designer, prefixed with the protocol when there are several.
+    when not interactive, every protocol without a design adds "<protocol>: no study designer design" to the list.
+    profile (or profile_memory/cprofile) writes reports/<file>_profile.json, see profile_run.
+    columnar also writes the compact reports/<file>_report.mcr.
+    with history, every mismatch is appended to history_database_file_name (the default database if None), see record_mismatch_history.
+    the exclusion rules come from rules_file_name, the study's own rules file or the hard-coded lists, see find_exclusion_rules.
+    """
+    rules = find_exclusion_rules(pn_metadata_file_name, rules_file_name)
+    profiling = profile_run(pn_metadata_file_name, profile_memory, cprofile) if profile or profile_memory or cprofile else contextlib.nullcontext()
+    with profiling:
+        pn_metadata_protocol, kdSU_name_map, kdSU_kdIG_kdIT_map, protocol_designs = load_pn_metadata_and_designs(pn_metadata_file_name, parser, use_cache, cache_size_mb, ods_parser, overlap, design_workers, rules, design_id)
+
+        protocol_maps = {}
+        unresolved_protocols = []
+        for protocol in (pn_metadata_protocol if design_id is None else [None]):
+            study_design_ids, latest_design_id, export_url, su_name_map, su_ig_it_map = protocol_designs[protocol]
+            if latest_design_id is None:
+                print("Unable to find design ids associated with protocol {} in pn_metadata xml file. \n".format(protocol))
+                unresolved_protocols.append(protocol)
+                continue
+            if design_id is None:
+                print("the list of all study design ids based on study protocol {0} extracted from pn_metadata: \n{1} \n".format(protocol, study_design_ids))
+                print("the latest study design id: \n{} \n".format(latest_design_id))
+            else:
+                print("the study design id given: \n{} \n".format(design_id))
+            print("retrieved study json from http request to: \n{} \n".format(export_url))
+            protocol_maps[protocol] = (su_name_map, su_ig_it_map, latest_design_id)
+
+        if len(protocol_maps) == 0:
+            # no protocol has a design: ask for a design id, or give up when not interactive.
+            protocol_maps[None] = get_study_designer_maps(pn_metadata_protocol, use_cache, interactive, ods_parser, rules)
+        # print("study_designer su => name: \n{} \n".format(su_name_map))
+        # print("study_designer su => ig => it: \n{} \n".format(su_ig_it_map))
+
+        mismatch_levels = []
+        if not interactive and len(protocol_maps) > 0:
+            # a batch, queue or watch run must not pass a study that was only partly checked.
+            for protocol in unresolved_protocols:
+                mismatch_levels.append("{}: no study designer design".format(protocol))
+        check_results = []
+        for protocol, (su_name_map, su_ig_it_map, latest_design_id) in protocol_maps.items():
+            if len(protocol_maps) == 1:
+                report_name = os.path.basename(pn_metadata_file_name)
+            else:
+                report_name = protocol_report_name(pn_metadata_file_name, protocol)
+                print("=============================== protocol {} ===============================".format(protocol))
+
+            with profile_stage('diff', protocol=protocol, incremental=incremental):
+                if incremental:
+                    level_diffs = diff_pn_metadata_against_study_designer_incremental(report_name, kdSU_name_map, kdSU_kdIG_kdIT_map, su_name_map, su_ig_it_map)
+                else:
+                    level_diffs = diff_pn_metadata_against_study_designer(kdSU_name_map, kdSU_kdIG_kdIT_map, su_name_map, su_ig_it_map)
+                add_profile_counts(mismatches=dict((level_diff.level, len(level_diff.left_only) + len(level_diff.right_only)) for level_diff in level_diffs))
+            with profile_stage('write_pn_metadata_reports', protocol=protocol):
+                write_pn_metadata_reports(report_name, level_diffs, columnar)
+                add_profile_counts(rows=dict((level_diff.level, len(level_diff.columns[level_diff.left_column])) for level_diff in level_diffs))
+
+            for level in find_mismatch_levels(level_diffs):
+                mismatch_levels.append(level if len(protocol_maps) == 1 else "{}: {}".format(protocol, level))
+            check_results.append((protocol, latest_design_id, report_name, level_diffs))
+
+        if use_cache:
+            save_check_results(pn_metadata_file_name, check_results, mismatch_levels, rules)
+        if history:
+            with profile_stage('record_mismatch_history'):
+                record_mismatch_history(pn_metadata_file_name, check_results, history_database_file_name)
+
+        return mismatch_levels
+
+# ---------------------------------------- gating
+
+# cheapest level first: ids and names are one key per signing unit, the kdit level has one per item.
+gate_levels = ['kdsu_su_id', 'kdsu_su_name', 'kdsu.kdig_su.ig_id', 'kdig.kdit_ig.it_id']
+gate_summary_size = 5  # differences printed per side
+
+
+def gate_level_keys(level, kdSU_name_map, kdSU_kdIG_kdIT_map, su_name_map, su_ig_it_map):
+    """
+    returns the (pn_metadata, study designer) key sets of one level, the same keys normalize_diff_keys builds.
+    """
+    if level == 'kdsu_su_id':
+        return set(kdSU_name_map), set(su_name_map)
+    if level == 'kdsu_su_name':
+        return set(kdSU_name_map.values()), set(su_name_map.values())
+    if level == 'kdsu.kdig_su.ig_id':
+        return (set('-->'.join([kdsu, kdig]) for kdsu, kdig_dict in kdSU_kdIG_kdIT_map.items() for kdig in kdig_dict),
+                set('-->'.join([su, ig]) for su, ig_dict in su_ig_it_map.items() for ig in ig_dict))
+    return (set('-->'.join([kdig, kdit]) for kdig_dict in kdSU_kdIG_kdIT_map.values() for kdig, kdit_list in kdig_dict.items() for kdit in kdit_list),
+            set('-->'.join([ig, item.it]) for ig_dict in su_ig_it_map.values() for ig, it_list in ig_dict.items() for item in it_list))
+
+
+def gate_pn_metadata_against_study_designer(kdSU_name_map, kdSU_kdIG_kdIT_map, su_name_map, su_ig_it_map):
+    """
+    compares the levels in gate_levels order and stops at the first one that differs.
+    returns (level, left_only, right_only) for that level, or None when every level matches.
+    a level differs here exactly when find_mismatch_levels would report it, but nothing is sorted or aligned.
+    """
+    for level in gate_levels:
+        left_keys, right_keys = gate_level_keys(level, kdSU_name_map, kdSU_kdIG_kdIT_map, su_name_map, su_ig_it_map)
+        if left_keys != right_keys:
+            return level, sorted(left_keys - right_keys), sorted(right_keys - left_keys)
+
+    return None
+
+
+def gate_pn_metadata_file(pn_metadata_file_name, parser="streaming", use_cache=True, cache_size_mb=pn_metadata_cache_max_size_mb, ods_parser="streaming", overlap=True, design_workers=study_designer_fetch_workers, rules_file_name=None, design_id=None):
+    """
+    checks one pn metadata file against the latest design of each of its protocols, or against design_id, without writing anything.
+    returns None when everything matches, otherwise (protocol, design_id, level, left_only, right_only) for the
+    first difference found. raises LookupError when one of the protocols has no design, so a partly checked file never passes.
+    """
+    rules = find_exclusion_rules(pn_metadata_file_name, rules_file_name)
+    # the gate only prints its summary.
+    with contextlib.redirect_stdout(io.StringIO()):
+        pn_metadata_protocol, kdSU_name_map, kdSU_kdIG_kdIT_map, protocol_designs = load_pn_metadata_and_designs(pn_metadata_file_name, parser, use_cache, cache_size_mb, ods_parser, overlap, design_workers, rules, design_id)
+
+    unresolved_protocols = []
+    for protocol in (pn_metadata_protocol if design_id is None else [None]):
+        study_design_ids, latest_design_id, export_url, su_name_map, su_ig_it_map = protocol_designs[protocol]
+        if latest_design_id is None:
+            unresolved_protocols.append(protocol)
+            continue
+        difference = gate_pn_metadata_against_study_designer(kdSU_name_map, kdSU_kdIG_kdIT_map, su_name_map, su_ig_it_map)
+        if difference is not None:
+            return (protocol, latest_design_id) + difference
+
+    if len(pn_metadata_protocol) == 0 and design_id is None:
+        raise LookupError("no study designer design found for protocols (none)")
+    if unresolved_protocols:
+        raise LookupError("no study designer design found for protocols {}".format(', '.join(unresolved_protocols)))
+
+    return None
+
+
+def run_gate(paths, check_options=None):
+    """
+    gates every pn metadata file in paths, stopping at the first one that does not match its design.
+    prints one compact line per file and returns the exit status: 0 all matched, 1 a mismatch, 2 a file could not be checked.
+    """
+    check_options = check_options or {}
+    options = dict((key, check_options[key]) for key in ('parser', 'use_cache', 'cache_size_mb', 'ods_parser', 'overlap', 'design_workers', 'rules_file_name', 'design_id') if key in check_options)
+
+    for pn_metadata_file_name in collect_pn_metadata_file_names(paths):
+        start = time.perf_counter()
+        try:
+            difference = gate_pn_metadata_file(pn_metadata_file_name, **options)
+        except SystemExit:
+            # a gate that could not check must never pass.
+            print("ERROR    {}    check exited early".format(pn_metadata_file_name))
+            return 2
+        except Exception as e:
+            print("ERROR    {}    {}: {}".format(pn_metadata_file_name, type(e).__name__, e))
+            return 2
+        elapsed = time.perf_counter() - start
+
+        if difference is None:
+            print("PASS     {}    ({:.2f} s)".format(pn_metadata_file_name, elapsed))
+            continue
+
+        protocol, design_id, level, left_only, right_only = difference
+        print("FAIL     {}    {}{}: {} differs    ({:.2f} s)".format(pn_metadata_file_name, "" if protocol is None else protocol + " ", design_id, level, elapsed))
+        for side, only in (("pn_metadata only", left_only), ("study_designer only", right_only)):
+            if only:
+                more = ", ... {} more".format(len(only) - gate_summary_size) if len(only) > gate_summary_size else ""
+                print("         {} ({}): {}{}".format(side, len(only), ', '.join(only[:gate_summary_size]), more))
+        return 1
+
+    return 0
+
+# ---------------------------------------- replaying results
+
+
+def check_results_file_name(pn_metadata_file_name, rules):
+    """
+    returns where the results of the last check of this exact file content under these exclusion rules are kept.
+    """
+    cache_key = pn_metadata_cache_key(pn_metadata_file_name, rules)
+    return os.path.join(results_directory, "{}.json".format(cache_key))
+
+
+def save_check_results(pn_metadata_file_name, check_results, mismatch_levels, rules):
+    """
+    records the outcome of a check: per protocol the report it wrote and how many values each side is missing per level.
+    check_results is a list of (protocol, design_id, report_name, level_diffs).
+    """
+    results = {
+        'file': pn_metadata_file_name,
+        'checked': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'version': __version__,
+        'mismatch_levels': mismatch_levels,
+        'protocols': [{
+            'protocol': protocol,
+            'report': "reports/{}_report.txt".format(report_name),
+            'csvs': "csvs/{}_csvs".format(report_name),
+            'levels': [[level_diff.level, len(level_diff.left_only), len(level_diff.right_only)] for level_diff in level_diffs],
+        } for protocol, design_id, report_name, level_diffs in check_results],
+    }
+
+    if not os.path.isdir(results_directory):
+        os.makedirs(results_directory, exist_ok=True)
+    results_file_name = check_results_file_name(pn_metadata_file_name, rules)
+    temp_file_name = "{}.{}.tmp".format(results_file_name, os.getpid())
+    with open(temp_file_name, 'w') as f:
+        json.dump(results, f, indent=2)
+    os.replace(temp_file_name, results_file_name)
+
+
+def replay_pn_metadata_check(pn_metadata_file_name, rules_file_name=None):
+    """
+    prints the results of the last check of the file without parsing it or contacting the study designer.
+    returns the mismatch levels of that check, or None when this content of the file has not been checked before
+    under the same exclusion rules.
+    """
+    rules = find_exclusion_rules(pn_metadata_file_name, rules_file_name)
+    try:
+        with open(check_results_file_name(pn_metadata_file_name, rules)) as f:
+            results = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    print("results of the check of {0} on {1}, the file has not changed since: \n".format(pn_metadata_file_name, results['checked']))
+    for protocol_results in results['protocols']:
+        if protocol_results['protocol'] is not None and len(results['protocols']) > 1:
+            print("=============================== protocol {} ===============================".format(protocol_results['protocol']))
+        for level, left_only_count, right_only_count in protocol_results['levels']:
+            title, left_message, right_message = diff_level_messages[level]
+            if left_only_count == 0 and right_only_count == 0:
+                print("{:<40} ALL VALUES MATCH".format(title))
+            else:
+                print("{:<40} {} only in pn_metadata, {} only in study designer".format(title, left_only_count, right_only_count))
+        print("\nreport: {} \ncsvs: {} \n".format(protocol_results['report'], protocol_results['csvs']))
+
+    return results['mismatch_levels']
+
+
+def clear_check_results():
+    """
+    removes every recorded check result.
+    """
+    if os.path.isdir(results_directory):
+        for entry in os.scandir(results_directory):
+            if entry.name.endswith(".json") or entry.name.endswith(".tmp"):
+                os.remove(entry.path)
+
+# ---------------------------------------- mismatch history
+
+
+history_database_schema = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    study TEXT NOT NULL,
+    protocol TEXT,
+    design_id TEXT,
+    checked TEXT NOT NULL,
+    file TEXT NOT NULL,
+    version TEXT
+);
+CREATE TABLE IF NOT EXISTS mismatches (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id),
+    level TEXT NOT NULL,
+    side TEXT NOT NULL,
+    key TEXT NOT NULL,
+    item TEXT NOT NULL,
+    include_in_reports TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_study ON runs (study, protocol, run_id);
+CREATE INDEX IF NOT EXISTS mismatches_key ON mismatches (key, run_id);
+CREATE INDEX IF NOT EXISTS mismatches_item ON mismatches (item, run_id);
+CREATE INDEX IF NOT EXISTS mismatches_run ON mismatches (run_id, level);
+"""
+
+
+def connect_history_database(database_file_name=None):
+    """
+    opens the mismatch history database, creating it on first use.
+    """
+    import sqlite3
+
+    database_file_name = database_file_name or history_database_file_name
+    if os.path.dirname(database_file_name) and not os.path.isdir(os.path.dirname(database_file_name)):
+        os.makedirs(os.path.dirname(database_file_name), exist_ok=True)
+    connection = sqlite3.connect(database_file_name, timeout=history_database_timeout)
+    connection.executescript(history_database_schema)
+
+    return connection
+
 
-        dataframe = create_kdsu_su_name_csv_diff_report(kdSU_name_map, su_name_map)
-        file.write(dataframe.to_string())
-        file.write('\n\n')
+def record_mismatch_history(pn_metadata_file_name, check_results, database_file_name=None):
+    """
+    appends one run per protocol and every value each side is missing to the history database.
+    check_results is a list of (protocol, design_id, report_name, level_diffs). runs are never updated or removed.
+    """
+    study = os.path.basename(pn_metadata_file_name)
+    checked = time.strftime('%Y-%m-%dT%H:%M:%S')
+
+    connection = connect_history_database(database_file_name)
+    try:
+        with connection:
+            for protocol, design_id, report_name, level_diffs in check_results:
+                cursor = connection.execute("INSERT INTO runs (study, protocol, design_id, checked, file, version) VALUES (?, ?, ?, ?, ?, ?)",
+                                            (study, protocol, design_id, checked, os.path.abspath(pn_metadata_file_name), __version__))
+                run_id = cursor.lastrowid
+                rows = []
+                for level_diff in level_diffs:
+                    include_in_reports = {}
+                    if 'it-->IncludeInReports' in level_diff.columns:
+                        include_in_reports = dict(zip(level_diff.columns[level_diff.right_column], level_diff.columns['it-->IncludeInReports']))
+                    for side, keys in [('pn_metadata', level_diff.left_only), ('study_designer', level_diff.right_only)]:
+                        for key in keys:
+                            value = include_in_reports.get(key) if side == 'study_designer' else None
+                            rows.append((run_id, level_diff.level, side, key, key.split('-->')[-1], value.split('-->')[-1] if value else None))
+                connection.executemany("INSERT INTO mismatches (run_id, level, side, key, item, include_in_reports) VALUES (?, ?, ?, ?, ?, ?)", rows)
+    finally:
+        connection.close()
+
+
+def print_history_rows(header, rows):
+    """
+    prints query results as left aligned columns.
+    """
+    rows = [["" if value is None else str(value) for value in row] for row in rows]
+    widths = [max([len(name)] + [len(row[column]) for row in rows]) for column, name in enumerate(header)]
+    print("  ".join(name.ljust(width) for name, width in zip(header, widths)).rstrip())
+    for row in rows:
+        print("  ".join(value.ljust(width) for value, width in zip(row, widths)).rstrip())
+    print("({} rows)".format(len(rows)))
+
+
+def query_mismatch_history(command, argument=None, database_file_name=None):
+    """
+    answers the --query commands:
+    first-diverged KEY   when each study first and last diverged on KEY (a full key like ig-->it, or just the kdSU,
+                         kdIG or kdIT at its end), and whether the latest run still does
+    current [LEVEL]      the studies whose latest run has mismatches, at LEVEL only if given (e.g. kdig.kdit_ig.it_id
+                         for the item / includeInReports table)
+    runs [STUDY]         every recorded run with its mismatch count
+    """
+    connection = connect_history_database(database_file_name)
+    try:
+        if command == "first-diverged" and argument:
+            rows = connection.execute("""
+                SELECT r.study, r.protocol, m.level, m.side, m.key, MIN(r.checked), MAX(r.checked), COUNT(*),
+                       MAX(m.run_id) = (SELECT MAX(latest.run_id) FROM runs latest WHERE latest.study = r.study AND latest.protocol IS r.protocol)
+                FROM mismatches m JOIN runs r ON r.run_id = m.run_id
+                WHERE m.key = ? OR m.item = ?
+                GROUP BY r.study, r.protocol, m.level, m.side, m.key
+                ORDER BY MIN(r.checked), r.study""", (argument, argument)).fetchall()
+            rows = [row[:8] + ("yes" if row[8] else "no",) for row in rows]
+            print_history_rows(["study", "protocol", "level", "missing from", "key", "first diverged", "last diverged", "runs", "still diverged"],
+                               [row[:3] + ("study_designer" if row[3] == 'pn_metadata' else "pn_metadata",) + row[4:] for row in rows])
+        elif command == "current":
+            rows = connection.execute("""
+                WITH latest AS (SELECT study, protocol, MAX(run_id) AS run_id FROM runs GROUP BY study, protocol)
+                SELECT latest.study, latest.protocol, r.design_id, r.checked, m.level,
+                       SUM(m.side = 'pn_metadata'), SUM(m.side = 'study_designer')
+                FROM latest JOIN runs r ON r.run_id = latest.run_id JOIN mismatches m ON m.run_id = latest.run_id
+                WHERE ? IS NULL OR m.level = ?
+                GROUP BY latest.run_id, m.level
+                ORDER BY latest.study, latest.protocol, m.level""", (argument, argument)).fetchall()
+            print_history_rows(["study", "protocol", "design id", "checked", "level", "only in pn_metadata", "only in study designer"], rows)
+        elif command == "runs":
+            rows = connection.execute("""
+                SELECT r.run_id, r.study, r.protocol, r.design_id, r.checked, COUNT(m.run_id)
+                FROM runs r LEFT JOIN mismatches m ON m.run_id = r.run_id
+                WHERE ? IS NULL OR r.study = ?
+                GROUP BY r.run_id
+                ORDER BY r.run_id""", (argument, argument)).fetchall()
+            print_history_rows(["run", "study", "protocol", "design id", "checked", "mismatches"], rows)
+        else:
+            print("unknown query: {}. use first-diverged KEY, current [LEVEL] or runs [STUDY].".format(' '.join(filter(None, [command, argument]))))
+            return False
+    finally:
+        connection.close()
+
+    return True
+
+# ---------------------------------------- batch mode
+
+
+def collect_pn_metadata_file_names(paths):
+    """
+    expands the given files and directories into a sorted list of pn metadata xml files.
+    a file reached through several of the paths is listed once.
+    """
+    pn_metadata_file_names = []
+    seen = set()
+    for path in paths:
+        for pn_metadata_file_name in sorted(glob.glob(os.path.join(path, "*.xml"))) if os.path.isdir(path) else [path]:
+            if os.path.abspath(pn_metadata_file_name) not in seen:
+                seen.add(os.path.abspath(pn_metadata_file_name))
+                pn_metadata_file_names.append(pn_metadata_file_name)
+
+    return pn_metadata_file_names
+
+
+def check_unique_report_names(pn_metadata_file_names):
+    """
+    raises ValueError when different files share a base name. csvs, reports, incremental state and history are all
+    keyed by the base name, so such files would overwrite each other's results.
+    """
+    paths_by_name = {}
+    for pn_metadata_file_name in pn_metadata_file_names:
+        paths_by_name.setdefault(os.path.basename(pn_metadata_file_name), set()).add(os.path.abspath(pn_metadata_file_name))
+
+    duplicates = sorted((name, sorted(paths)) for name, paths in paths_by_name.items() if len(paths) > 1)
+    if duplicates:
+        raise ValueError("these files share a name and would overwrite each other's csvs and reports, rename them or check them separately:\n{}".format(
+            "\n".join("  {}: {}".format(name, ', '.join(paths)) for name, paths in duplicates)))
+
+
+def run_batch_check(job):
+    """
+    process pool entry point. runs one check with its terminal output captured so files do not interleave.
+    returns (pn_metadata_file_name, mismatch_levels, error, output)
+    """
+    pn_metadata_file_name, check_options = job
+    output = io.StringIO()
+    mismatch_levels = None
+    error = None
+    with contextlib.redirect_stdout(output):
+        try:
+            mismatch_levels = run_pn_metadata_check(pn_metadata_file_name, interactive=False, **check_options)
+        except SystemExit:
+            error = "check exited early"
+        except Exception as e:
+            error = "{}: {}".format(type(e).__name__, e)
+
+    return pn_metadata_file_name, mismatch_levels, error, output.getvalue()
+
+
+def run_batch(paths, workers=None, check_options=None):
+    """
+    checks every pn metadata file in paths across a process pool and prints a pass/fail summary per study.
+    check_options are passed on to run_pn_metadata_check. returns True when every study passed.
+    raises ValueError when two of the files share a name, see check_unique_report_names.
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    check_options = check_options or {}
+    pn_metadata_file_names = collect_pn_metadata_file_names(paths)
+    check_unique_report_names(pn_metadata_file_names)
+    results = {}
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run_batch_check, (pn_metadata_file_name, check_options)) for pn_metadata_file_name in pn_metadata_file_names]
+        for future in as_completed(futures):
+            pn_metadata_file_name, mismatch_levels, error, output = future.result()
+            print("=============================== {} ===============================".format(pn_metadata_file_name))
+            print(output)
+            results[pn_metadata_file_name] = (mismatch_levels, error)
+
+    print("------------------------------- batch summary -------------------------------")
+    all_passed = True
+    for pn_metadata_file_name in pn_metadata_file_names:
+        mismatch_levels, error = results[pn_metadata_file_name]
+        if error is not None:
+            all_passed = False
+            print("ERROR    {}    {}".format(pn_metadata_file_name, error))
+        elif mismatch_levels:
+            all_passed = False
+            print("FAIL     {}    {}".format(pn_metadata_file_name, ', '.join(mismatch_levels)))
+        else:
+            print("PASS     {}".format(pn_metadata_file_name))
+
+    return all_passed
+
+
+# ---------------------------------------- job queue
+
+# state is pending, running, passed, failed (a mismatch) or error (gave up after job_max_attempts).
+job_queue_schema = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    file TEXT NOT NULL,
+    design_id TEXT,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_expires REAL,
+    enqueued REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    mismatch_levels TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, job_id);
+"""
+
+
+def connect_job_queue(queue_file_name):
+    """
+    opens the job queue, creating it on first use. transactions are begun explicitly.
+    """
+    import sqlite3
+
+    if os.path.dirname(queue_file_name) and not os.path.isdir(os.path.dirname(queue_file_name)):
+        os.makedirs(os.path.dirname(queue_file_name), exist_ok=True)
+    connection = sqlite3.connect(queue_file_name, timeout=job_queue_timeout, isolation_level=None)
+    connection.executescript(job_queue_schema)
+
+    return connection
+
+
+def enqueue_jobs(queue_file_name, paths, design_id=None):
+    """
+    adds one job per pn metadata file in paths, checked against design_id or the latest design of each protocol.
+    paths are stored absolute, so every host has to see the files under the same path. returns the number of jobs added.
+    raises ValueError when a file shares its name with another file in the queue, since all jobs write to one output root.
+    """
+    pn_metadata_file_names = [os.path.abspath(pn_metadata_file_name) for pn_metadata_file_name in collect_pn_metadata_file_names(paths)]
+    connection = connect_job_queue(queue_file_name)
+    try:
+        connection.execute("BEGIN IMMEDIATE")
+        queued_file_names = [row[0] for row in connection.execute("SELECT DISTINCT file FROM jobs")]
+        try:
+            check_unique_report_names(queued_file_names + pn_metadata_file_names)
+        except ValueError:
+            connection.execute("ROLLBACK")
+            raise
+        connection.executemany("INSERT INTO jobs (file, design_id, enqueued) VALUES (?, ?, ?)",
+                               [(pn_metadata_file_name, design_id, time.time()) for pn_metadata_file_name in pn_metadata_file_names])
+        connection.execute("COMMIT")
+    finally:
+        connection.close()
+
+    return len(pn_metadata_file_names)
+
+
+def claim_job(connection, worker):
+    """
+    leases the oldest pending job, or a running job whose lease has expired, to worker.
+    jobs that already used up job_max_attempts are marked as errors instead. returns (job_id, file, design_id) or None.
+    """
+    now = time.time()
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        connection.execute("UPDATE jobs SET state = 'error', finished = ?, error = 'lease expired on every attempt' "
+                           "WHERE state = 'running' AND lease_expires < ? AND attempts >= ?", (now, now, job_max_attempts))
+        job = connection.execute("SELECT job_id, file, design_id FROM jobs WHERE state = 'pending' OR (state = 'running' AND lease_expires < ?) "
+                                 "ORDER BY job_id LIMIT 1", (now,)).fetchone()
+        if job is not None:
+            connection.execute("UPDATE jobs SET state = 'running', worker = ?, lease_expires = ?, attempts = attempts + 1, started = ? WHERE job_id = ?",
+                               (worker, now + job_lease_seconds, now, job[0]))
+        connection.execute("COMMIT")
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+
+    return job
+
+
+def renew_job_lease(queue_file_name, job_id, worker, stop_event):
+    """
+    extends the lease of a running job every third of job_lease_seconds until stop_event is set.
+    runs on its own thread with its own connection.
+    """
+    connection = connect_job_queue(queue_file_name)
+    try:
+        while not stop_event.wait(job_lease_seconds / 3):
+            connection.execute("UPDATE jobs SET lease_expires = ? WHERE job_id = ? AND worker = ? AND state = 'running'",
+                               (time.time() + job_lease_seconds, job_id, worker))
+    finally:
+        connection.close()
+
+
+def finish_job(connection, job_id, worker, mismatch_levels, error):
+    """
+    records the outcome of a job. a failed attempt goes back to pending until job_max_attempts is reached.
+    returns False when the lease had been lost to another worker, whose outcome then counts instead.
+    """
+    now = time.time()
+    if error is None:
+        cursor = connection.execute("UPDATE jobs SET state = ?, finished = ?, mismatch_levels = ?, error = NULL, lease_expires = NULL "
+                                    "WHERE job_id = ? AND worker = ? AND state = 'running'",
+                                    ('failed' if mismatch_levels else 'passed', now, json.dumps(mismatch_levels), job_id, worker))
+    else:
+        cursor = connection.execute("UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'error' ELSE 'pending' END, finished = ?, error = ?, lease_expires = NULL "
+                                    "WHERE job_id = ? AND worker = ? AND state = 'running'",
+                                    (job_max_attempts, now, error, job_id, worker))
+
+    return cursor.rowcount == 1
+
+
+def run_queue_worker(queue_file_name, output_root=".", check_options=None, worker=None):
+    """
+    checks jobs from the queue one after the other until no job is pending or running anymore.
+    csvs, reports and caches are written under output_root. returns the number of jobs this worker finished.
+    """
+    import socket
+
+    check_options = dict(check_options or {})
+    check_options.pop('design_id', None)
+    queue_file_name = os.path.abspath(queue_file_name)
+    if check_options.get('rules_file_name'):
+        check_options['rules_file_name'] = os.path.abspath(check_options['rules_file_name'])
+    worker = worker or "{}:{}".format(socket.gethostname(), os.getpid())
+
+    # every relative path the check writes to lands in the shared output root.
+    os.makedirs(output_root, exist_ok=True)
+    os.chdir(output_root)
+
+    connection = connect_job_queue(queue_file_name)
+    finished = 0
+    try:
+        while True:
+            job = claim_job(connection, worker)
+            if job is None:
+                remaining = connection.execute("SELECT COUNT(*) FROM jobs WHERE state IN ('pending', 'running')").fetchone()[0]
+                if remaining == 0:
+                    break
+                # another worker's job may still expire and come back.
+                time.sleep(job_poll_interval)
+                continue
+
+            job_id, pn_metadata_file_name, design_id = job
+            stop_event = threading.Event()
+            lease = threading.Thread(target=renew_job_lease, args=(queue_file_name, job_id, worker, stop_event), daemon=True)
+            lease.start()
+            start = time.perf_counter()
+            try:
+                pn_metadata_file_name, mismatch_levels, error, output = run_batch_check((pn_metadata_file_name, dict(check_options, design_id=design_id)))
+            finally:
+                stop_event.set()
+                lease.join()
+            elapsed = time.perf_counter() - start
+
+            if not finish_job(connection, job_id, worker, mismatch_levels, error):
+                print("LOST     {}    lease expired before the check finished    ({})".format(pn_metadata_file_name, worker))
+            elif error is not None:
+                print("ERROR    {}    {}    ({}, {:.2f} s)".format(pn_metadata_file_name, error, worker, elapsed))
+            elif mismatch_levels:
+                print("FAIL     {}    {}    ({}, {:.2f} s)".format(pn_metadata_file_name, ', '.join(mismatch_levels), worker, elapsed))
+            else:
+                print("PASS     {}    ({}, {:.2f} s)".format(pn_metadata_file_name, worker, elapsed))
+            sys.stdout.flush()
+            finished += 1
+    finally:
+        connection.close()
 
-        dataframe = create_kdsu_su_id_csv_diff_report(kdSU_name_map, su_name_map)
-        file.write(dataframe.to_string())
-        file.write('\n\n')
+    return finished
 
-        dataframe = create_kdig_ig_id_csv_diff_report(kdSU_kdIG_kdIT_map, su_ig_it_map)
-        file.write(dataframe.to_string())
-        file.write('\n\n')
 
-        dataframe = create_kdit_it_id_csv_diff_report(kdSU_kdIG_kdIT_map, su_ig_it_map)
-        file.write(dataframe.to_string())
-        file.write('\n\n')
+def run_queue_workers(queue_file_name, output_root=".", workers=None, check_options=None):
+    """
+    runs workers queue workers on this host in separate processes. returns the number of jobs they finished.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    workers = workers or os.cpu_count() or 1
+    output_root = os.path.abspath(output_root)
+    if workers == 1:
+        return run_queue_worker(queue_file_name, output_root, check_options)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run_queue_worker, queue_file_name, output_root, check_options) for worker in range(workers)]
+        return sum(future.result() for future in futures)
+
+
+def print_job_queue_progress(queue_file_name):
+    """
+    prints how many jobs are in each state, what every worker is doing, the recent throughput and the failed jobs.
+    """
+    connection = connect_job_queue(queue_file_name)
+    try:
+        now = time.time()
+        counts = dict(connection.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+        total = sum(counts.values())
+        done = sum(counts.get(state, 0) for state in ('passed', 'failed', 'error'))
+        print("jobs: {}    done: {} ({:.0%})    {}".format(total, done, done / total if total else 1,
+                                                        "    ".join("{}: {}".format(state, counts.get(state, 0)) for state in ('pending', 'running', 'passed', 'failed', 'error'))))
+
+        # throughput over the last ten minutes, and how long the pending and running jobs would take at that rate.
+        window = 600
+        recent = connection.execute("SELECT COUNT(*), MIN(finished) FROM jobs WHERE state IN ('passed', 'failed', 'error') AND finished >= ?", (now - window,)).fetchone()
+        if recent[0]:
+            rate = recent[0] / max(now - recent[1], 1.0)
+            remaining = counts.get('pending', 0) + counts.get('running', 0)
+            print("throughput: {:.2f} jobs/s over the last {} min    eta: {:.0f} s".format(rate, window // 60, remaining / rate))
+
+        workers = connection.execute("SELECT worker, SUM(state = 'running' AND lease_expires >= ?), SUM(state IN ('passed', 'failed')), MAX(finished) "
+                                     "FROM jobs WHERE worker IS NOT NULL GROUP BY worker ORDER BY worker", (now,)).fetchall()
+        if workers:
+            print("\n{:<40} {:>8} {:>8}  {}".format("worker", "running", "done", "last finished"))
+            for worker, running, worker_done, last_finished in workers:
+                print("{:<40} {:>8} {:>8}  {}".format(worker, running or 0, worker_done or 0,
+                                                      time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(last_finished)) if last_finished else "-"))
+
+        failures = connection.execute("SELECT state, file, design_id, attempts, mismatch_levels, error FROM jobs "
+                                      "WHERE state IN ('failed', 'error') OR (state = 'pending' AND error IS NOT NULL) ORDER BY job_id").fetchall()
+        if failures:
+            print()
+            for state, pn_metadata_file_name, design_id, attempts, mismatch_levels, error in failures:
+                if state == 'failed':
+                    print("FAIL     {}    {}".format(pn_metadata_file_name, ', '.join(json.loads(mismatch_levels))))
+                elif state == 'error':
+                    print("ERROR    {}    {} (after {} attempts)".format(pn_metadata_file_name, error, attempts))
+                else:
+                    print("RETRY    {}    {} (attempt {} failed)".format(pn_metadata_file_name, error, attempts))
+    finally:
+        connection.close()
+
+    return counts
+
+# ---------------------------------------- watch mode
+
+
+def scan_pn_metadata_files(directory):
+    """
+    returns file => (mtime_ns, size) for every *.xml in directory.
+    """
+    signatures = {}
+    try:
+        entries = list(os.scandir(directory))
+    except FileNotFoundError:
+        return signatures
+
+    for entry in entries:
+        if not entry.name.lower().endswith(".xml"):
+            continue
+        try:
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+        except FileNotFoundError:
+            # removed between the listing and the stat.
+            continue
+        signatures[entry.path] = (stat.st_mtime_ns, stat.st_size)
+
+    return signatures
+
+
+def run_watch_check(pn_metadata_file_name, check_options):
+    """
+    runs one check for watch mode. returns (mismatch_levels, error) instead of exiting, so the watch keeps going.
+    """
+    try:
+        return run_pn_metadata_check(pn_metadata_file_name, interactive=False, **check_options), None
+    except SystemExit:
+        return None, "check exited early"
+    except Exception as e:
+        return None, "{}: {}".format(type(e).__name__, e)
+
+
+def watch_directory(directory, check_options=None, poll_interval=None, debounce_seconds=None, check_existing=False, stop_event=None):
+    """
+    re-checks every *.xml in directory that is added or modified, once it has stopped changing for debounce_seconds.
+    runs in this process, so the imported modules and the parsed study designer exports stay warm between checks.
+    files already present are only checked when check_existing is set. runs until interrupted or stop_event is set.
+    """
+    check_options = check_options or {}
+    poll_interval = watch_poll_interval if poll_interval is None else poll_interval
+    debounce_seconds = watch_debounce_seconds if debounce_seconds is None else debounce_seconds
+
+    # file => signature it was last checked (or first seen) at.
+    checked = {} if check_existing else scan_pn_metadata_files(directory)
+    # file => (signature, time it was first seen with that signature) while waiting for the writes to settle.
+    pending = {}
+
+    print("watching {} for pn metadata files (ctrl+c to stop)".format(directory))
+    try:
+        while stop_event is None or not stop_event.is_set():
+            now = time.monotonic()
+            signatures = scan_pn_metadata_files(directory)
+
+            for pn_metadata_file_name in list(checked):
+                if pn_metadata_file_name not in signatures:
+                    del checked[pn_metadata_file_name]
+            for pn_metadata_file_name in list(pending):
+                if pn_metadata_file_name not in signatures:
+                    del pending[pn_metadata_file_name]
+
+            for pn_metadata_file_name, signature in signatures.items():
+                if checked.get(pn_metadata_file_name) == signature:
+                    pending.pop(pn_metadata_file_name, None)
+                elif pn_metadata_file_name not in pending or pending[pn_metadata_file_name][0] != signature:
+                    pending[pn_metadata_file_name] = (signature, now)
+
+            settled = sorted(pn_metadata_file_name for pn_metadata_file_name, (signature, seen) in pending.items()
+                             if now - seen >= debounce_seconds)
+            for pn_metadata_file_name in settled:
+                signature = pending.pop(pn_metadata_file_name)[0]
+                checked[pn_metadata_file_name] = signature
+
+                print("=============================== {} ===============================".format(pn_metadata_file_name))
+                start = time.perf_counter()
+                mismatch_levels, error = run_watch_check(pn_metadata_file_name, check_options)
+                elapsed = time.perf_counter() - start
+                if error is not None:
+                    print("ERROR    {}    {}    ({:.2f} s)".format(pn_metadata_file_name, error, elapsed))
+                elif mismatch_levels:
+                    print("FAIL     {}    {}    ({:.2f} s)".format(pn_metadata_file_name, ', '.join(mismatch_levels), elapsed))
+                else:
+                    print("PASS     {}    ({:.2f} s)".format(pn_metadata_file_name, elapsed))
+                sys.stdout.flush()
+
+            if stop_event is None:
+                time.sleep(poll_interval)
+            else:
+                stop_event.wait(poll_interval)
+    except KeyboardInterrupt:
+        pass
+
+    print("stopped watching {}".format(directory))
+
+
+# ---------------------------------------- service mode
+
+
+def level_diff_json(level_diff):
+    """
+    returns one level of a diff as a json-ready dict.
+    """
+    return {
+        'level': level_diff.level,
+        'left_column': level_diff.left_column,
+        'right_column': level_diff.right_column,
+        'left_only': list(level_diff.left_only),
+        'right_only': list(level_diff.right_only),
+    }
+
+
+def check_pn_metadata_json(pn_metadata_file_name, design_id=None, parser="streaming", use_cache=True, cache_size_mb=pn_metadata_cache_max_size_mb, ods_parser="streaming", design_workers=study_designer_fetch_workers, rules_file_name=None):
+    """
+    diffs one pn metadata file against the study designer without writing csvs or reports, and returns the four
+    level diffs of every checked design as a json-ready dict.
+    with design_id the file is compared against that design, otherwise against the latest design of each protocol.
+    protocols without a design are listed under protocols_without_design and count as a mismatch.
+    raises LookupError when none of the protocols has a design.
+    """
+    rules = find_exclusion_rules(pn_metadata_file_name, rules_file_name)
+    pn_metadata_protocol, kdSU_name_map, kdSU_kdIG_kdIT_map = parse_pn_metadata(pn_metadata_file_name, parser, use_cache, cache_size_mb, rules=rules)
+
+    protocol_maps = {}
+    unresolved_protocols = []
+    if design_id is not None:
+        su_name_map, su_ig_it_map, export_url = fetch_study_designer_maps(design_id, use_cache, ods_parser, rules)
+        protocol_maps[None] = (su_name_map, su_ig_it_map, design_id)
+    else:
+        protocol_designs = prefetch_study_designer_maps(pn_metadata_protocol, use_cache, ods_parser, design_workers, rules)
+        for protocol in pn_metadata_protocol:
+            study_design_ids, latest_design_id, export_url, su_name_map, su_ig_it_map = protocol_designs[protocol]
+            if latest_design_id is not None:
+                protocol_maps[protocol] = (su_name_map, su_ig_it_map, latest_design_id)
+            else:
+                unresolved_protocols.append(protocol)
+        if len(pn_metadata_protocol) == 0:
+            raise LookupError("found no protocol in the pn metadata, pass a design_id")
+        if len(protocol_maps) == 0:
+            raise LookupError("no study designer design found for protocols {}, pass a design_id".format(', '.join(pn_metadata_protocol)))
+
+    results = []
+    for protocol, (su_name_map, su_ig_it_map, checked_design_id) in protocol_maps.items():
+        level_diffs = diff_pn_metadata_against_study_designer(kdSU_name_map, kdSU_kdIG_kdIT_map, su_name_map, su_ig_it_map)
+        results.append({
+            'protocol': protocol,
+            'design_id': checked_design_id,
+            'mismatch_levels': find_mismatch_levels(level_diffs),
+            'levels': [level_diff_json(level_diff) for level_diff in level_diffs],
+        })
+
+    return {
+        'protocols': list(pn_metadata_protocol),
+        'mismatch': any(result['mismatch_levels'] for result in results) or len(unresolved_protocols) > 0,
+        'protocols_without_design': unresolved_protocols,
+        'results': results,
+    }
+
+
+def parse_service_address(address):
+    """
+    returns (host, port) for a [HOST:]PORT address.
+    """
+    host, separator, port = address.rpartition(':')
+    return host or service_host, int(port)
+
+
+def create_check_server(address, check_options=None):
+    """
+    returns a threaded http server answering pn metadata checks on address = (host, port).
+      GET  /health                         => {"status": "ok", "version": ...}
+      POST /check?path=FILE[&design_id=ID] checks a file the server can read
+      POST /check[?design_id=ID]           checks the pn metadata xml sent as the request body
+    a json body {"path": ..., "design_id": ...} works too. the response is check_pn_metadata_json's dict.
+    every request shares this process' in-memory parse and export caches.
+    """
+    import tempfile
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    from urllib.parse import urlsplit, parse_qs
+
+    check_options = dict(check_options or {})
+    options = dict((key, check_options[key]) for key in ('parser', 'use_cache', 'cache_size_mb', 'ods_parser', 'design_workers', 'rules_file_name') if key in check_options)
+
+    class CheckRequestHandler(BaseHTTPRequestHandler):
+
+        def send_json(self, status, body):
+            content = json.dumps(body).encode('utf8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_GET(self):
+            if urlsplit(self.path).path != '/health':
+                self.send_json(404, {'error': "unknown path {}".format(self.path)})
+                return
+            self.send_json(200, {'status': 'ok', 'version': __version__})
+
+        def do_POST(self):
+            url = urlsplit(self.path)
+            if url.path != '/check':
+                self.send_json(404, {'error': "unknown path {}".format(self.path)})
+                return
+
+            query = dict((key, values[-1]) for key, values in parse_qs(url.query).items())
+            try:
+                content_length = int(self.headers.get('Content-Length') or 0)
+            except ValueError:
+                content_length = -1
+            if content_length < 0:
+                # the end of the body is unknown, so the connection cannot be reused.
+                self.send_json(400, {'error': "invalid Content-Length {}".format(self.headers.get('Content-Length'))})
+                self.close_connection = True
+                return
+            if content_length > service_max_upload_mb * 1024 * 1024:
+                self.send_json(413, {'error': "uploads are limited to {} MB".format(service_max_upload_mb)})
+                self.close_connection = True
+                return
+
+            upload_file_name = None
+            try:
+                if self.headers.get('Content-Type', '').split(';')[0].strip() == 'application/json':
+                    try:
+                        query.update(json.loads(self.rfile.read(content_length) or b'{}'))
+                    except ValueError as e:
+                        self.send_json(400, {'error': "invalid json body: {}".format(e)})
+                        return
+                elif content_length > 0:
+                    # the parsers read files, so the upload is spooled to disk in chunks.
+                    with tempfile.NamedTemporaryFile(suffix='.xml', delete=False) as f:
+                        upload_file_name = f.name
+                        remaining = content_length
+                        while remaining > 0:
+                            chunk = self.rfile.read(min(remaining, 1024 * 1024))
+                            if not chunk:
+                                break
+                            f.write(chunk)
+                            remaining -= len(chunk)
+
+                pn_metadata_file_name = upload_file_name or query.get('path')
+                if not pn_metadata_file_name:
+                    self.send_json(400, {'error': "send the pn metadata xml as the body or pass its path"})
+                    return
+
+                self.send_json(*self.check(pn_metadata_file_name, query.get('design_id') or None))
+            finally:
+                if upload_file_name is not None:
+                    os.remove(upload_file_name)
+
+        def check(self, pn_metadata_file_name, design_id):
+            """
+            returns (status, body) for one check.
+            """
+            import requests
+
+            try:
+                return 200, check_pn_metadata_json(pn_metadata_file_name, design_id, **options)
+            except FileNotFoundError:
+                return 404, {'error': "{} not found".format(pn_metadata_file_name)}
+            except LookupError as e:
+                return 404, {'error': str(e)}
+            except StudyDesignerResponseError as e:
+                if design_id is not None:
+                    return 502, {'error': "bad study designer response for design {}: {}".format(design_id, e)}
+                return 502, {'error': "bad study designer response: {}".format(e)}
+            except requests.HTTPError as e:
+                if e.response is not None and e.response.status_code == 404:
+                    return 404, {'error': "study designer has no design {}".format(design_id)}
+                return 502, {'error': "study designer: {}".format(e)}
+            except requests.RequestException as e:
+                return 502, {'error': "study designer: {}".format(e)}
+            except Exception as e:
+                return 500, {'error': "{}: {}".format(type(e).__name__, e)}
+
+    return ThreadingHTTPServer(address, CheckRequestHandler)
+
+
+def serve_pn_metadata_checks(address, check_options=None):
+    """
+    answers pn metadata checks over http until interrupted, see create_check_server.
+    """
+    server = create_check_server(address, check_options)
+    print("serving pn metadata checks on http://{}:{}/check (ctrl+c to stop)".format(*server.server_address[:2]))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    # the frozen executable is also the interpreter of the --batch and --work worker processes. under the spawn start
+    # method (macos, windows) this turns such a launch into the worker instead of running the cli again.
+    from multiprocessing import freeze_support
+    freeze_support()
+
+    # this is used for writing buffer out to terminal.
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding="UTF-8")
+
+    parser = argparse.ArgumentParser(description="compares a pn metadata xml file against its study designer design.")
+    parser.add_argument("--version", action="version", version="%(prog)s {}".format(__version__))
+    parser.add_argument("--replay", metavar="FILE",
+                        help="print the results of the last check of FILE if it has not changed since, without parsing it or contacting the study designer api.")
+    parser.add_argument("--parser", choices=["streaming", "soup"], default="streaming",
+                        help="streaming (default) reads the xml incrementally, soup builds the whole BeautifulSoup tree.")
+    parser.add_argument("--ods-parser", choices=["streaming", "full"], default="streaming",
+                        help="streaming (default) builds the study designer maps questionnaire by questionnaire, full loads the whole export first.")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="always parse the pn metadata file and fetch the study designer api, ignoring the local caches.")
+    parser.add_argument("--clear-cache", action="store_true",
+                        help="remove every cached parsed-metadata entry, study designer response and recorded result before running.")
+    parser.add_argument("--cache-size-mb", type=float, default=pn_metadata_cache_max_size_mb,
+                        help="evict least recently used cache entries beyond this size (default: %(default)s).")
+    parser.add_argument("--batch", nargs="+", metavar="PATH",
+                        help="non-interactively check these pn metadata files, or every *.xml in these directories, in parallel.")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of worker processes for --batch and --work (default: number of cpus).")
+    parser.add_argument("--watch", metavar="DIR",
+                        help="stay running and check every pn metadata xml file added to or modified in DIR.")
+    parser.add_argument("--watch-existing", action="store_true",
+                        help="with --watch, also check the files already in DIR on start.")
+    parser.add_argument("--debounce", type=float, default=watch_debounce_seconds,
+                        help="with --watch, seconds a file must stop changing before it is checked (default: %(default)s).")
+    parser.add_argument("--design-id", metavar="ID",
+                        help="check against this study designer design instead of the latest design of each protocol.")
+    parser.add_argument("--queue", metavar="FILE",
+                        help="sqlite job queue shared by --enqueue, --work and --progress. may sit on a shared filesystem.")
+    parser.add_argument("--enqueue", nargs="+", metavar="PATH",
+                        help="add a job to --queue for each of these pn metadata files, or every *.xml in these directories, with --design-id if given.")
+    parser.add_argument("--work", action="store_true",
+                        help="check jobs from --queue with --workers processes until the queue is done, writing under --output-root.")
+    parser.add_argument("--output-root", default=".", metavar="DIR",
+                        help="with --work, the directory csvs/, reports/ and cache/ are written to (default: the current directory).")
+    parser.add_argument("--progress", action="store_true",
+                        help="print the state of the jobs in --queue.")
+    parser.add_argument("--gate", nargs="+", metavar="PATH",
+                        help="only check whether these pn metadata files (or directories) match their designs, stopping at the first difference. "
+                             "writes no csvs or reports. exits 0 on a match, 1 on a mismatch and 2 when a file could not be checked.")
+    parser.add_argument("--serve", metavar="[HOST:]PORT",
+                        help="stay running and answer checks over http, see create_check_server. HOST defaults to {}.".format(service_host))
+    parser.add_argument("--rules", metavar="FILE",
+                        help="exclusion rules file to use instead of <file>.rules.json next to each pn metadata file, see compile_exclusion_rules.")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only re-diff the signing units that changed since the last run of the same file.")
+    parser.add_argument("--sequential", action="store_true",
+                        help="wait for the pn metadata parse before contacting the study designer api instead of overlapping them.")
+    parser.add_argument("--design-workers", type=int, default=study_designer_fetch_workers,
+                        help="concurrent study designer export downloads for studies with several protocols (default: %(default)s).")
+    parser.add_argument("--columnar", action="store_true",
+                        help="also write the four diff tables to one memory-mappable reports/<file>_report.mcr.")
+    parser.add_argument("--no-history", action="store_true",
+                        help="do not append this run's mismatches to the mismatch history database.")
+    parser.add_argument("--query", nargs="+", metavar=("COMMAND", "ARGUMENT"),
+                        help="query the mismatch history: first-diverged KEY, current [LEVEL] or runs [STUDY].")
+    parser.add_argument("--history-db", default=history_database_file_name,
+                        help="mismatch history database (default: %(default)s).")
+    parser.add_argument("--profile", action="store_true",
+                        help="write the wall time, cpu time, peak rss, counts and http traffic of every stage to reports/<file>_profile.json.")
+    parser.add_argument("--profile-memory", action="store_true",
+                        help="--profile with tracemalloc peaks per stage. slows the run down.")
+    parser.add_argument("--cprofile", action="store_true",
+                        help="--profile plus a cProfile dump of the main thread to reports/<file>_profile.pstats.")
+    args = parser.parse_args()
+
+    check_options = {
+        'parser': args.parser,
+        'use_cache': not args.no_cache,
+        'cache_size_mb': args.cache_size_mb,
+        'incremental': args.incremental,
+        'ods_parser': args.ods_parser,
+        'overlap': not args.sequential,
+        'design_workers': args.design_workers,
+        'profile': args.profile,
+        'profile_memory': args.profile_memory,
+        'cprofile': args.cprofile,
+        'columnar': args.columnar,
+        'history': not args.no_history,
+        'rules_file_name': args.rules,
+        'design_id': args.design_id,
+        'history_database_file_name': args.history_db,
+    }
+
+    if args.rules:
+        try:
+            load_exclusion_rules(args.rules)
+        except (OSError, ValueError) as e:
+            print("unable to use the rules file: {}".format(e))
+            sys.exit(2)
+
+    if args.query:
+        sys.exit(0 if query_mismatch_history(args.query[0], args.query[1] if len(args.query) > 1 else None, args.history_db) else 2)
+
+    if args.replay:
+        mismatch_levels = replay_pn_metadata_check(args.replay, args.rules)
+        if mismatch_levels is None:
+            print("{} has not been checked in its current form, run the check without --replay first.".format(args.replay))
+            sys.exit(2)
+        sys.exit(1 if mismatch_levels else 0)
+
+    if args.clear_cache:
+        clear_pn_metadata_cache()
+        clear_http_cache()
+        clear_incremental_state()
+        clear_check_results()
+
+    if args.batch:
+        try:
+            all_passed = run_batch(args.batch, args.workers, check_options)
+        except ValueError as e:
+            print(e)
+            sys.exit(2)
+        sys.exit(0 if all_passed else 1)
+
+    if (args.enqueue or args.work or args.progress) and not args.queue:
+        parser.error("--enqueue, --work and --progress need --queue")
+
+    # --work moves into the output root, so the queue is resolved first.
+    queue_file_name = os.path.abspath(args.queue) if args.queue else None
+    if args.enqueue:
+        try:
+            print("added {} jobs to {}".format(enqueue_jobs(queue_file_name, args.enqueue, args.design_id), args.queue))
+        except ValueError as e:
+            print(e)
+            sys.exit(2)
+    if args.work:
+        run_queue_workers(queue_file_name, args.output_root, args.workers, check_options)
+    if args.progress:
+        print_job_queue_progress(queue_file_name)
+    if args.enqueue or args.work or args.progress:
+        sys.exit(0)
+
+    if args.gate:
+        sys.exit(run_gate(args.gate, check_options))
+
+    if args.serve:
+        serve_pn_metadata_checks(parse_service_address(args.serve), check_options)
+        sys.exit(0)
+
+    if args.watch:
+        watch_directory(args.watch, check_options, debounce_seconds=args.debounce, check_existing=args.watch_existing)
+        sys.exit(0)
+
+    pn_metadata_file_name = user_input_pn_metadata_file_name()
+    # pn_metadata_file_name = "pn_metadata.xml"
+
+    try:
+        run_pn_metadata_check(pn_metadata_file_name, **check_options)
+    except StudyDesignerResponseError as e:
+        print(e)
+        sys.exit(2)
@@ -10,7 +10,7 @@ a = Analysis(['main.py'],
              hiddenimports=[],
              hookspath=[],
              runtime_hooks=[],
-             excludes=[],
+             excludes=['pandas', 'numpy'],  # only level_diff_dataframe needs pandas, the executable never calls it
              win_no_prefer_redirects=False,
              win_private_assemblies=False,
              cipher=block_cipher,
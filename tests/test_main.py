@@ -0,0 +1,848 @@
+"""
+checks main.py against generated studies and benchmark.serve_study_designer standing in for the study designer api.
+run from the repository root with python -m pytest or python -m unittest discover tests.
+"""
+import contextlib
+import http.client
+import io
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+import urllib.error
+import urllib.request
+
+repository_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repository_directory)
+
+try:
+    import pandas
+except ImportError:  # the report writers no longer need it, only the comparison with it does.
+    pandas = None
+
+import benchmark
+import main
+from benchmark import generate_study, serve_study_designer
+
+
+class CheckTestCase(unittest.TestCase):
+    """
+    runs every test in its own working directory, so the caches, csvs and reports start empty.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        working_directory = os.getcwd()
+        os.chdir(self.directory)
+        self.addCleanup(os.chdir, working_directory)
+        for memo, lock in ((main.pn_metadata_memo, main.pn_metadata_memo_lock), (main.study_designer_memo, main.study_designer_memo_lock)):
+            with lock:
+                memo.clear()
+        # the checks print their progress, the tests only look at what they return.
+        stdout = contextlib.redirect_stdout(io.StringIO())
+        stdout.__enter__()
+        self.addCleanup(stdout.__exit__, None, None, None)
+
+    def generate_study(self, scale=0.5, mismatch_rate=0.0, seed=0):
+        """
+        returns (pn_metadata_file_name, ods_file_name, protocol) of a generated study in the working directory.
+        """
+        directory = os.path.join(self.directory, "study_{}_{}_{}".format(scale, mismatch_rate, seed))
+        os.makedirs(directory, exist_ok=True)
+        return generate_study(directory, scale, mismatch_rate, seed)
+
+    def write_export(self, content):
+        """
+        returns the name of an export file holding content.
+        """
+        export_file_name = os.path.join(self.directory, "export_{}.json".format(len(os.listdir(self.directory))))
+        with open(export_file_name, 'w') as f:
+            f.write(content)
+        return export_file_name
+
+# ---------------------------------------- parsing
+
+
+class ParseTest(CheckTestCase):
+
+    def test_streaming_parse_matches_soup(self):
+        pn_metadata_file_names = [os.path.join(repository_directory, name) for name in ("pn_metadata.xml", "pn__metadata.xml", "pn__metadata_proto.xml")]
+        pn_metadata_file_names.append(self.generate_study(mismatch_rate=0.2)[0])
+        for pn_metadata_file_name in pn_metadata_file_names:
+            with self.subTest(pn_metadata_file_name=os.path.basename(pn_metadata_file_name)):
+                streaming = main.parse_pn_metadata(pn_metadata_file_name, "streaming", use_cache=False)
+                soup = main.parse_pn_metadata(pn_metadata_file_name, "soup", use_cache=False)
+                self.assertEqual(streaming, soup)
+                self.assertTrue(streaming[1])
+
+# ---------------------------------------- exclusion rules
+
+
+class ExclusionRulesTest(CheckTestCase):
+
+    def test_name_patterns(self):
+        self.assertIsNone(main.compile_name_patterns([]))
+        cases = [
+            (["AddUser"], ["AddUser"], ["AddUsers", "adduser", ""]),
+            (["glob:Visit*", "glob:*End"], ["Visit", "Visit12", "VisitEnd", "LogPadEnd"], ["visit", "PreVisit", "Ends"]),
+            (["re:Register[A-Z]+[0-9]*", "Phase"], ["RegisterASMA1", "RegisterX", "Phase"], ["Register", "RegisterASMA1x", "Phase2"]),
+            # inline global flags, only allowed at the start of their own expression.
+            (["re:(?i)visit.*", "re:(?s)a.b", "glob:Z*"], ["VISITstart", "a\nb", "Zed"], ["preVisit", "ab"]),
+            # groups and backreferences, which an alternation would renumber.
+            (["re:(x)y", "re:(a)\\1", "re:(?P<c>c)(?P=c)", "glob:q*"], ["xy", "aa", "cc", "qq"], ["ab", "c", "xya"]),
+        ]
+        for patterns, matching, other in cases:
+            with self.subTest(patterns=patterns):
+                match = main.compile_name_patterns(patterns)
+                self.assertEqual([name for name in matching + other if match(name)], matching)
+                # the list matches exactly what its patterns match one by one.
+                alone = [main.compile_name_patterns([pattern]) for pattern in patterns]
+                self.assertEqual([match(name) for name in matching + other], [any(pattern_match(name) for pattern_match in alone) for name in matching + other])
+
+    def test_compile_exclusion_rules(self):
+        rules = main.default_exclusion_rules()
+        self.assertEqual([rules.kdSE("LogPad"), rules.kdSE("Diary"), rules.kdSU("AddUser"), rules.kdSU("SU00001"), rules.kdIG("Header"), rules.kdIT("Header"), rules.ig("-")],
+                         [True, False, False, True, False, True, False])
+        self.assertEqual(main.compile_exclusion_rules(main.default_exclusion_rules_source()).key, rules.key)
+
+        # a kind given replaces its hard-coded rule, the others keep theirs.
+        rules = main.compile_exclusion_rules({'kdSU': {'exclude': ["glob:Visit*"]}, 'it': {'include': ["glob:IT*"], 'exclude': ["IT2"]}, 'ig': {'include': []}})
+        self.assertEqual([rules.kdSU("AddUser"), rules.kdSU("VisitEnd"), rules.kdIG("Header"), rules.it("IT1"), rules.it("IT2"), rules.it("Other"), rules.ig("IG1")],
+                         [True, False, False, True, False, False, False])
+        self.assertNotEqual(rules.key, main.default_exclusion_rules().key)
+
+        for rules_source, message in [
+            ({'kdXX': {}}, "unknown kind 'kdXX'"),
+            ({'kdSU': ["AddUser"]}, "the rule for kdSU must be an object"),
+            ({'kdSU': {'exclude': [], 'except': []}}, "the rule for kdSU must be an object"),
+            ({'kdIG': {'exclude': "Header"}}, "include and exclude of kdIG must be lists"),
+            ({'su': {'exclude': [1]}}, "patterns must be strings, not 1"),
+            ({'it': {'include': ["re:IT("]}}, "invalid regular expression 're:IT\\('"),
+        ]:
+            with self.subTest(rules_source=rules_source):
+                with self.assertRaisesRegex(ValueError, message):
+                    main.compile_exclusion_rules(rules_source)
+
+    def test_load_exclusion_rules_errors(self):
+        for content, message in [
+            ('{"kdSU": ', "broken.json is not valid json: "),
+            ('["AddUser"]', "broken.json must hold a json object"),
+            ('{"kdSU": {"exclude": ["re:[A-"]}}', "broken.json: invalid regular expression"),
+        ]:
+            with self.subTest(content=content):
+                with open("broken.json", 'w') as f:
+                    f.write(content)
+                with self.assertRaisesRegex(ValueError, "^" + message):
+                    main.load_exclusion_rules("broken.json")
+        with self.assertRaises(FileNotFoundError):
+            main.load_exclusion_rules("missing.json")
+
+        # the cli refuses a broken --rules before doing anything else.
+        completed = subprocess.run([sys.executable, os.path.join(repository_directory, "main.py"), "--rules", "broken.json", "--query", "runs"], capture_output=True, text=True)
+        self.assertEqual(completed.returncode, 2)
+        self.assertIn("unable to use the rules file: broken.json: invalid regular expression", completed.stdout)
+        self.assertFalse(os.path.exists(main.history_database_file_name))
+
+    def test_study_rules_file(self):
+        pn_metadata_file_name, ods_file_name, protocol = self.generate_study()
+        default = main.parse_pn_metadata(pn_metadata_file_name)
+        with open(os.path.splitext(pn_metadata_file_name)[0] + main.exclusion_rules_suffix, 'w') as f:
+            json.dump({'kdSU': {'exclude': ["SU00001"] + main.kdSU_exclusion_list}, 'kdIT': {'exclude': ["glob:IT00000*"]}}, f)
+        with open("no_rules.json", 'w') as f:
+            f.write('{}')
+
+        rules = main.find_exclusion_rules(pn_metadata_file_name)
+        self.assertNotEqual(rules.key, main.default_exclusion_rules().key)
+        self.assertEqual(main.find_exclusion_rules(pn_metadata_file_name, "no_rules.json").key, main.default_exclusion_rules().key)
+        # the cached parse under the default rules is not reused for the study's own rules.
+        pn_metadata_protocol, kdSU_name_map, kdSU_kdIG_kdIT_map = main.parse_pn_metadata(pn_metadata_file_name, rules=rules)
+        self.assertEqual(sorted(kdSU_name_map), sorted(set(default[1]) - {"SU00001"}))
+        self.assertFalse(any(kdIT.startswith("IT00000") for kdIG_kdIT_map in kdSU_kdIG_kdIT_map.values() for kdIT_list in kdIG_kdIT_map.values() for kdIT in kdIT_list))
+
+        # SU00001 is only excluded on the pn metadata side, so it now differs from the design.
+        designs = [{'protocol': [protocol], 'designId': 'p@1'}]
+        with serve_study_designer(designs, {'p@1': ods_file_name}):
+            self.assertEqual(main.run_gate([pn_metadata_file_name]), 1)
+            self.assertEqual(main.run_gate([pn_metadata_file_name], {'rules_file_name': "no_rules.json"}), 0)
+
+    def test_rules_matching_hard_coded_lists(self):
+        pn_metadata_file_names = [os.path.join(repository_directory, name) for name in ("pn_metadata.xml", "pn__metadata.xml", "pn__metadata_proto.xml")]
+        pn_metadata_file_name, ods_file_name, protocol = self.generate_study()
+        pn_metadata_file_names.append(pn_metadata_file_name)
+        with open(ods_file_name) as f:
+            export = json.load(f)
+        export['questionnaires'][1:1] = [
+            {"su": "EndWebProUse", "name": "End", "items": [{"id": 0, "type": "question", "ig": "IG1", "it": "IT1", "includeInReports": True}]},
+            {"su": "SU99999", "name": "Blank", "items": [{"id": 0, "type": "header", "ig": "", "it": "Blank", "includeInReports": False}]},
+        ]
+        exports = {'p@1': self.write_export(json.dumps(export))}
+
+        # the hard-coded lists copied verbatim, then as globs and regular expressions that match the same names.
+        patterns_source = {
+            'kdSE': {'include': ["glob:LogPad"]},
+            'kdSU': {'exclude': ["re:A(nalysisPeriodLabel|ssigneSense|ssignment|PC)", "glob:End*Use"] + main.kdSU_exclusion_list[6:]},
+            'kdIG': {'exclude': ["re:(?i)protocol|header", "glob:FormLevel*"] + main.kdIG_exclusion_list[3:]},
+            'su': {'exclude': ["glob:EndWebPro*"]},
+            'ig': {'exclude': ["re:-?"]},
+        }
+        for name, rules_source in [("verbatim", main.default_exclusion_rules_source()), ("patterns", patterns_source)]:
+            with open("{}.rules.json".format(name), 'w') as f:
+                json.dump(rules_source, f)
+            rules = main.load_exclusion_rules("{}.rules.json".format(name))
+            for parser in ("streaming", "soup"):
+                for file_name in pn_metadata_file_names:
+                    with self.subTest(rules=name, parser=parser, pn_metadata_file_name=os.path.basename(file_name)):
+                        self.assertEqual(main.parse_pn_metadata(file_name, parser, use_cache=False, rules=rules), main.parse_pn_metadata(file_name, parser, use_cache=False))
+            with serve_study_designer([], exports):
+                expected = main.fetch_study_designer_maps('p@1', use_cache=False, ods_parser="full")
+                self.assertNotIn("EndWebProUse", expected[0])
+                self.assertEqual(expected[1]["SU99999"], {})
+                for ods_parser in ("streaming", "full"):
+                    with self.subTest(rules=name, ods_parser=ods_parser):
+                        self.assertEqual(main.fetch_study_designer_maps('p@1', use_cache=False, ods_parser=ods_parser, rules=rules), expected)
+
+# ---------------------------------------- pn_metadata cache
+
+
+class PnMetadataCacheTest(CheckTestCase):
+
+    def cache_file_names(self):
+        return sorted(os.listdir(main.pn_metadata_cache_directory))
+
+    def test_cached_parse_matches_fresh_parse(self):
+        pn_metadata_file_name = self.generate_study()[0]
+        fresh = main.parse_pn_metadata(pn_metadata_file_name, use_cache=True)
+        with main.pn_metadata_memo_lock:
+            main.pn_metadata_memo.clear()
+        with mock.patch.object(main, 'create_pn_metadata_kdSU_kdIG_kdIT_dictionary_streaming', side_effect=AssertionError("parsed again")):
+            self.assertEqual(main.parse_pn_metadata(pn_metadata_file_name, use_cache=True), fresh)
+
+        # the key is the content, so an edited file is parsed again.
+        with open(pn_metadata_file_name, 'a') as f:
+            f.write("\n")
+        self.assertEqual(main.parse_pn_metadata(pn_metadata_file_name, use_cache=True), fresh)
+        self.assertEqual(len(self.cache_file_names()), 2)
+
+    def test_evicts_least_recently_used_entries(self):
+        payload = "x" * 100 * 1024
+        for index, cache_key in enumerate(["a", "b", "c"]):
+            main.save_pn_metadata_cache(cache_key, [cache_key], {cache_key: payload}, {})
+            os.utime(os.path.join(main.pn_metadata_cache_directory, "{}.pickle".format(cache_key)), (index + 1, index + 1))
+
+        # reading "a" makes it the most recently used, so "b" and "c" go first.
+        self.assertEqual(main.load_pn_metadata_cache("a")[0], ["a"])
+        main.save_pn_metadata_cache("d", ["d"], {"d": payload}, {}, max_size_mb=0.25)
+        self.assertEqual(self.cache_file_names(), ["a.pickle", "d.pickle"])
+
+    def test_entry_evicted_while_read(self):
+        main.save_pn_metadata_cache("a", ["a"], {}, {})
+        with mock.patch.object(main.os, 'utime', side_effect=FileNotFoundError):
+            self.assertEqual(main.load_pn_metadata_cache("a"), (["a"], {}, {}))
+
+    def test_memo_keeps_most_recently_used_parses(self):
+        pn_metadata_file_names = [self.generate_study(scale=0.2, seed=seed)[0] for seed in range(3)]
+        cache_keys = [main.pn_metadata_cache_key(pn_metadata_file_name, main.default_exclusion_rules()) for pn_metadata_file_name in pn_metadata_file_names]
+        with mock.patch.object(main, 'pn_metadata_memo_size', 2):
+            for pn_metadata_file_name in pn_metadata_file_names[:2] + pn_metadata_file_names[:1] + pn_metadata_file_names[2:]:
+                main.parse_pn_metadata(pn_metadata_file_name)
+            self.assertEqual(list(main.pn_metadata_memo), [cache_keys[0], cache_keys[2]])
+
+# ---------------------------------------- study designer api
+
+
+class JsonArrayItemsTest(unittest.TestCase):
+
+    document = json.dumps({
+        "studyName": "a \"quoted\" [name] {with} \\ brackets",
+        "questionnaires": [
+            {"su": "A", "name": "a \\\"b\\\" }", "items": [{"ig": "[", "it": "{", "includeInReports": True}]},
+            {"su": "Bé", "name": "", "items": []},
+            {"su": "C", "name": "c", "items": [{"ig": "G", "it": "I\\n", "nested": [[1, 2], {"x": "]"}]}]},
+        ],
+        "trailer": ["questionnaires", {"questionnaires": []}],
+    })
+
+    def test_every_chunk_boundary(self):
+        expected = json.loads(self.document)['questionnaires']
+        for chunk_size in range(1, len(self.document) + 1):
+            with self.subTest(chunk_size=chunk_size):
+                chunks = (self.document[i:i + chunk_size] for i in range(0, len(self.document), chunk_size))
+                self.assertEqual(list(main.iter_json_array_items(chunks, 'questionnaires')), expected)
+
+    def test_prunes_items_while_reading(self):
+        # the items of a pruned questionnaire are not valid json, so decoding any of them would fail.
+        document = ('{"questionnaires": ['
+                    '{"su": "Keep", "name": "su", "other": "Drop", "items": [{"su": "Drop", "it": "a"}]}, '
+                    '{"su": "Drop", "items": [{"it": tru}, nul, 01]}, '
+                    '{"id": 3, "name": "late su", "su": "Drop", "items": [x, {"y": }]}, '
+                    '{"su": "Dr\\u006fp", "items": [z]}, '
+                    '{"su" : "Kept \\"too\\"", "items": []}, '
+                    '{"name": "no su", "items": []}'
+                    '], "su": "Drop"}')
+        expected = [
+            {"su": "Keep", "name": "su", "other": "Drop", "items": [{"su": "Drop", "it": "a"}]},
+            {"su": 'Kept "too"', "items": []},
+            {"name": "no su", "items": []},
+        ]
+        for chunk_size in range(1, len(document) + 1):
+            with self.subTest(chunk_size=chunk_size):
+                chunks = (document[i:i + chunk_size] for i in range(0, len(document), chunk_size))
+                self.assertEqual(list(main.iter_json_array_items(chunks, 'questionnaires', 'su', lambda su: su != "Drop")), expected)
+
+    def test_missing_array(self):
+        with self.assertRaises(KeyError):
+            list(main.iter_json_array_items(iter(['{"studyName": "x", "items": [{"questionnaires": []}]}']), 'questionnaires'))
+
+
+class StudyDesignerCacheTest(CheckTestCase):
+
+    def test_revalidates_with_etag(self):
+        with serve_study_designer([{'protocol': ['P'], 'designId': 'p@1'}], {}, etags=True) as served:
+            first = main.http_get_cached(main.study_designer_designs_url)
+            second = main.http_get_cached(main.study_designer_designs_url)
+            uncached = main.http_get_cached(main.study_designer_designs_url, use_cache=False)
+        self.assertEqual(first, second)
+        self.assertEqual(first, uncached)
+        self.assertEqual([status for path, status in served], [200, 304, 200])
+
+    def test_pinned_export_is_read_from_disk(self):
+        pn_metadata_file_name, ods_file_name, protocol = self.generate_study()
+        with serve_study_designer([], {'p@1': ods_file_name, 'p': ods_file_name}, etags=True) as served:
+            for ods_parser in ("streaming", "full"):
+                with main.study_designer_memo_lock:
+                    main.study_designer_memo.clear()
+                pinned = main.fetch_study_designer_maps('p@1', ods_parser=ods_parser)
+                # served from the in-memory memo, then from the body on disk.
+                self.assertEqual(main.fetch_study_designer_maps('p@1', ods_parser=ods_parser), pinned)
+                with main.study_designer_memo_lock:
+                    main.study_designer_memo.clear()
+                self.assertEqual(main.fetch_study_designer_maps('p@1', ods_parser=ods_parser), pinned)
+
+            # an unpinned export is revalidated every time.
+            unpinned = main.fetch_study_designer_maps('p')
+            self.assertEqual(main.fetch_study_designer_maps('p')[:2], unpinned[:2])
+            self.assertEqual(unpinned[:2], pinned[:2])
+
+        self.assertEqual(served, [('/api/v1/json/export/p@1/ods', 200), ('/api/v1/json/export/p/ods', 200), ('/api/v1/json/export/p/ods', 304)])
+
+
+class StudyDesignerResponseTest(CheckTestCase):
+
+    def test_malformed_export_is_an_error(self):
+        for content in ('{"studyName": "x"}', '{"questionnaires": [{"name": "no su", "items": []}]}', '<html>busy</html>'):
+            export_file_name = self.write_export(content)
+            for ods_parser in ("streaming", "full"):
+                with self.subTest(content=content, ods_parser=ods_parser):
+                    with serve_study_designer([], {'bad@1': export_file_name}):
+                        with self.assertRaises(main.StudyDesignerResponseError):
+                            main.fetch_study_designer_maps('bad@1', use_cache=False, ods_parser=ods_parser)
+
+# ---------------------------------------- diffing
+
+
+class AlignmentTest(unittest.TestCase):
+    """
+    align_sorted_columns against the recursive helpers it replaced, copied from the last release.
+    """
+
+    @staticmethod
+    def smaller_list_to_larger_comparison(sm, lg):
+        for i in range(len(sm)):
+            if sm[i] != lg[i]:
+                if sm[i] > lg[i]:
+                    sm.insert(i, '~~~ MISMATCH ~~~')
+                else:
+                    lg.insert(i, '~~~ MISMATCH ~~~')
+
+    @classmethod
+    def larger_list_to_smaller_comparison(cls, list_a, list_b):
+        lg = list_a
+        sm = list_b
+        if len(list_b) > len(list_a):
+            lg = list_b
+            sm = list_a
+        for i in range(len(lg)):
+            if i < len(sm):
+                if lg[i] != sm[i] and sm[i] != '~~~ MISMATCH ~~~' and lg[i] != '~~~ MISMATCH ~~~':
+                    if sm[i] > lg[i]:
+                        sm.insert(i, '~~~ MISMATCH ~~~')
+                    else:
+                        lg.insert(i, '~~~ MISMATCH ~~~')
+                        cls.larger_list_to_smaller_comparison(lg, sm)
+            else:
+                sm.append('~~~ MISMATCH ~~~')
+
+    def old_alignment(self, left, right):
+        """
+        returns the columns the last release wrote, or None where it could not build a table from them.
+        """
+        left = sorted(left)
+        right = sorted(right)
+        try:
+            if len(left) > len(right):
+                self.smaller_list_to_larger_comparison(right, left)
+                self.larger_list_to_smaller_comparison(left, right)
+            else:
+                self.smaller_list_to_larger_comparison(left, right)
+                self.larger_list_to_smaller_comparison(right, left)
+        except IndexError:
+            return None
+        return (left, right) if len(left) == len(right) else None
+
+    def test_matches_old_layout(self):
+        rnd = random.Random(0)
+        compared = 0
+        for case in range(2000):
+            universe = ["K{:03d}".format(i) for i in range(rnd.randint(1, 30))]
+            left = [value for value in universe if rnd.random() < 0.8]
+            right = [value for value in universe if rnd.random() < 0.8]
+            # the old helpers left columns of equal length unaligned.
+            expected = self.old_alignment(left, right) if len(left) != len(right) else None
+            if expected is not None:
+                compared += 1
+                self.assertEqual(main.align_sorted_columns(sorted(left), sorted(right)), expected)
+        self.assertGreater(compared, 1000)
+
+    def test_aligns_equal_lengths(self):
+        self.assertEqual(main.align_sorted_columns(['a', 'c'], ['b', 'c']), (['a', '~~~ MISMATCH ~~~', 'c'], ['~~~ MISMATCH ~~~', 'b', 'c']))
+        self.assertEqual(main.align_sorted_columns([], ['a']), (['~~~ MISMATCH ~~~'], ['a']))
+
+
+class IncrementalDiffTest(CheckTestCase):
+
+    def test_incremental_diff_matches_full_diff(self):
+        pn_metadata_file_name, ods_file_name, protocol = self.generate_study(mismatch_rate=0.1)
+        pn_metadata_protocol, kdSU_name_map, kdSU_kdIG_kdIT_map = main.parse_pn_metadata(pn_metadata_file_name, use_cache=False)
+        with open(ods_file_name) as f:
+            su_name_map, su_ig_it_map = main.create_study_designer_su_ig_it_dictionary(json.load(f))
+
+        def assert_same_diff():
+            full = main.diff_pn_metadata_against_study_designer(kdSU_name_map, kdSU_kdIG_kdIT_map, su_name_map, su_ig_it_map)
+            incremental = main.diff_pn_metadata_against_study_designer_incremental(pn_metadata_file_name, kdSU_name_map, kdSU_kdIG_kdIT_map, su_name_map, su_ig_it_map)
+            self.assertEqual(dict((level_diff.level, level_diff) for level_diff in incremental), dict((level_diff.level, level_diff) for level_diff in full))
+
+        # without a stored state, then with an unchanged one.
+        assert_same_diff()
+        assert_same_diff()
+
+        # an item renamed on one side, an item group moved on the other and a signing unit dropped.
+        su = sorted(su_ig_it_map)[0]
+        ig = sorted(su_ig_it_map[su])[0]
+        su_ig_it_map[su][ig][0] = main.StudyDesignerItem(su_ig_it_map[su][ig][0].it + "Renamed", True)
+        assert_same_diff()
+
+        kdSU, other_kdSU = sorted(kdSU_kdIG_kdIT_map)[:2]
+        kdIG = sorted(kdSU_kdIG_kdIT_map[kdSU])[0]
+        kdSU_kdIG_kdIT_map[other_kdSU][kdIG] = kdSU_kdIG_kdIT_map[kdSU].pop(kdIG)
+        assert_same_diff()
+
+        del su_ig_it_map[sorted(su_ig_it_map)[-1]]
+        assert_same_diff()
+
+# ---------------------------------------- multiple protocols
+
+
+class MultiProtocolTest(CheckTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.pn_metadata_file_name = os.path.join(self.directory, "study.xml")
+        kdSU_name_map, kdSU_kdIG_kdIT_map = benchmark.generate_pn_metadata(self.pn_metadata_file_name, 3, 12, 15, 80, ("ODS-1", "ODS 2/B"), seed=1)
+        self.exports = {'one@1': self.write_export(""), 'two@3': self.write_export("")}
+        benchmark.generate_ods_export(self.exports['one@1'], kdSU_name_map, kdSU_kdIG_kdIT_map, mismatch_rate=0.0)
+        benchmark.generate_ods_export(self.exports['two@3'], kdSU_name_map, kdSU_kdIG_kdIT_map, mismatch_rate=0.3)
+        self.designs = [{'protocol': ['ODS-1'], 'designId': 'one@1'}, {'protocol': 'ODS 2/B', 'designId': 'two@2'}, {'protocol': 'ODS 2/B', 'designId': 'two@3'}]
+
+    def test_checks_every_protocol(self):
+        with serve_study_designer(self.designs, self.exports):
+            mismatch_levels = main.run_pn_metadata_check(self.pn_metadata_file_name, interactive=False, history=False)
+            checks = main.check_pn_metadata_json(self.pn_metadata_file_name)
+
+        self.assertTrue(mismatch_levels)
+        self.assertTrue(all(level.startswith("ODS 2/B: ") for level in mismatch_levels))
+        for report_name in ("study.xml_ODS-1", "study.xml_ODS_2_B"):
+            self.assertTrue(os.path.exists(os.path.join("reports", "{}_report.txt".format(report_name))))
+            self.assertTrue(os.path.isdir(os.path.join("csvs", "{}_csvs".format(report_name))))
+        self.assertFalse(os.path.exists(os.path.join("reports", "study.xml_report.txt")))
+
+        self.assertEqual([(result['protocol'], result['design_id']) for result in checks['results']], [('ODS-1', 'one@1'), ('ODS 2/B', 'two@3')])
+        self.assertEqual(checks['results'][0]['mismatch_levels'], [])
+        self.assertEqual(["ODS 2/B: {}".format(level) for level in checks['results'][1]['mismatch_levels']], mismatch_levels)
+        self.assertEqual(checks['protocols_without_design'], [])
+
+    def test_protocol_without_design_fails(self):
+        designs = self.designs[:1]
+        with serve_study_designer(designs, self.exports):
+            self.assertEqual(main.run_pn_metadata_check(self.pn_metadata_file_name, interactive=False, history=False), ["ODS 2/B: no study designer design"])
+            checks = main.check_pn_metadata_json(self.pn_metadata_file_name)
+            self.assertEqual(main.run_gate([self.pn_metadata_file_name]), 2)
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                self.assertFalse(main.run_batch([self.pn_metadata_file_name], workers=1, check_options={'history': False}))
+        self.assertTrue(checks['mismatch'])
+        self.assertEqual(checks['protocols_without_design'], ["ODS 2/B"])
+        self.assertIn("FAIL     {}    ODS 2/B: no study designer design".format(self.pn_metadata_file_name), output.getvalue())
+
+# ---------------------------------------- reports
+
+
+class ReportWriterTest(CheckTestCase):
+    """
+    the csv and text writers against the DataFrame.to_csv and to_string output they replaced.
+    """
+
+    def level_diffs(self):
+        """
+        yields the level diffs of a generated study, then of columns holding the values pandas escapes or pads.
+        """
+        pn_metadata_file_name, ods_file_name, protocol = self.generate_study(mismatch_rate=0.2)
+        pn_metadata_protocol, kdSU_name_map, kdSU_kdIG_kdIT_map = main.parse_pn_metadata(pn_metadata_file_name, use_cache=False)
+        with open(ods_file_name) as f:
+            su_name_map, su_ig_it_map = main.create_study_designer_su_ig_it_dictionary(json.load(f))
+        yield from main.diff_pn_metadata_against_study_designer(kdSU_name_map, kdSU_kdIG_kdIT_map, su_name_map, su_ig_it_map)
+
+        rnd = random.Random(0)
+        alphabet = ['a', 'Z', ' ', ',', '"', "'", '\t', '\n', '\r', 'é', '中', '-->', '~']
+        for row_count in (0, 1, 9, 11, 150):
+            left = sorted(''.join(rnd.choice(alphabet) for length in range(rnd.randint(0, 12))) for row in range(row_count))
+            right = sorted(''.join(rnd.choice(alphabet) for length in range(rnd.randint(0, 12))) for row in range(row_count // 2))
+            left_column, right_column = main.align_sorted_columns(left, right)
+            yield main.LevelDiff('kdsu_su_name', 'random.csv', 'kdsu_name', 'su_name', [], [], {'kdsu_name': left_column, 'su_name': right_column})
+
+    @unittest.skipIf(pandas is None, "pandas is not installed")
+    def test_matches_pandas(self):
+        os.makedirs("csvs/study_csvs")
+        for index, level_diff in enumerate(self.level_diffs()):
+            with self.subTest(index=index, level=level_diff.level):
+                main.write_level_diff_csv(level_diff, "study")
+                with open("csvs/study_csvs/{}".format(level_diff.csv_name), 'rb') as f:
+                    written = f.read()
+                pandas.DataFrame(data=level_diff.columns).to_csv("expected.csv")
+                with open("expected.csv", 'rb') as f:
+                    self.assertEqual(written, f.read())
+
+                text = io.StringIO()
+                main.write_level_diff_text(level_diff, text)
+                self.assertEqual(text.getvalue(), pandas.DataFrame(data=level_diff.columns).to_string())
+
+
+class ColumnarReportTest(CheckTestCase):
+
+    def test_round_trip(self):
+        pn_metadata_file_name, ods_file_name, protocol = self.generate_study(mismatch_rate=0.2)
+        with serve_study_designer([{'protocol': [protocol], 'designId': 'p@1'}], {'p@1': ods_file_name}):
+            main.run_pn_metadata_check(pn_metadata_file_name, interactive=False, history=False, columnar=True)
+            pn_metadata_protocol, kdSU_name_map, kdSU_kdIG_kdIT_map = main.parse_pn_metadata(pn_metadata_file_name)
+            su_name_map, su_ig_it_map, export_url = main.fetch_study_designer_maps('p@1')
+        level_diffs = main.diff_pn_metadata_against_study_designer(kdSU_name_map, kdSU_kdIG_kdIT_map, su_name_map, su_ig_it_map)
+        level_diffs.append(main.LevelDiff('kdsu_su_id', 'empty.csv', 'kdsu', 'su', [], [], {'kdsu': [], 'su': []}))
+        main.write_columnar_report("written.mcr", level_diffs, {'file': 'study', 'rows': 3})
+
+        metadata, strings, tables = main.read_columnar_report("written.mcr")
+        self.assertEqual(metadata, {'file': 'study', 'rows': 3})
+        self.assertEqual([(table.level, table.csv_name, table.row_count) for table in tables], [(level_diff.level, level_diff.csv_name, len(level_diff.columns[level_diff.left_column])) for level_diff in level_diffs])
+        for table, level_diff in zip(tables, level_diffs):
+            with self.subTest(level=table.level, csv_name=table.csv_name):
+                self.assertEqual(dict((name, [strings[value] for value in values]) for name, values in table.columns.items()), level_diff.columns)
+                mismatch_rows = [index for index, row in main.level_diff_rows(level_diff) if '~~~ MISMATCH ~~~' in row]
+                self.assertEqual([index for index in range(table.row_count) if table.mismatch_bitmap[index >> 3] >> (index & 7) & 1], mismatch_rows)
+        self.assertTrue(any(table.mismatch_bitmap.tobytes().strip(b'\0') for table in tables))
+
+        # the report written by a check holds the same tables.
+        metadata, strings, tables = main.read_columnar_report("reports/{}_report.mcr".format(os.path.basename(pn_metadata_file_name)))
+        self.assertEqual(metadata['file'], os.path.basename(pn_metadata_file_name))
+        self.assertEqual([dict((name, [strings[value] for value in values]) for name, values in table.columns.items()) for table in tables], [level_diff.columns for level_diff in level_diffs[:4]])
+
+    def test_rejects_other_files(self):
+        with open("other.mcr", 'wb') as f:
+            f.write(b'\0' * main.columnar_report_header.size)
+        with self.assertRaisesRegex(ValueError, "not a version 1 columnar report"):
+            main.read_columnar_report("other.mcr")
+
+# ---------------------------------------- gate
+
+
+class GateTest(CheckTestCase):
+
+    def gate(self, paths, designs, exports, **check_options):
+        with serve_study_designer(designs, exports):
+            return main.run_gate(paths, dict(check_options, use_cache=False))
+
+    def test_exit_status(self):
+        pn_metadata_file_name, ods_file_name, protocol = self.generate_study()
+        mismatch_file_name, mismatch_ods_file_name, mismatch_protocol = self.generate_study(scale=0.4, mismatch_rate=0.2)
+        designs = [{'protocol': [protocol], 'designId': 'match@1'}, {'protocol': mismatch_protocol, 'designId': 'mismatch@2'}]
+        exports = {'match@1': ods_file_name, 'mismatch@2': mismatch_ods_file_name, 'bad@1': self.write_export('{"studyName": "x"}')}
+
+        self.assertEqual(self.gate([pn_metadata_file_name], designs, exports), 0)
+        self.assertEqual(self.gate([mismatch_file_name], designs, exports), 1)
+        self.assertEqual(self.gate([pn_metadata_file_name, mismatch_file_name], designs, exports), 1)
+        self.assertEqual(self.gate([pn_metadata_file_name], designs, exports, design_id='mismatch@2'), 1)
+        # a file that could not be checked never passes.
+        self.assertEqual(self.gate([pn_metadata_file_name], designs, exports, design_id='bad@1'), 2)
+        self.assertEqual(self.gate([pn_metadata_file_name], designs, exports, design_id='bad@1', ods_parser='full'), 2)
+        self.assertEqual(self.gate([pn_metadata_file_name], [], exports), 2)
+        self.assertEqual(self.gate([pn_metadata_file_name], designs, exports, design_id='missing@1'), 2)
+
+# ---------------------------------------- mismatch history
+
+
+class MismatchHistoryTest(CheckTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.pn_metadata_file_name, ods_file_name, protocol = self.generate_study(scale=0.3)
+        kdSU_name_map, kdSU_kdIG_kdIT_map = benchmark.generate_pn_metadata(os.path.join(self.directory, "copy.xml"), 3, 10, 15, 90, (protocol,), 0)
+        mismatch_ods_file_name = self.write_export("")
+        benchmark.generate_ods_export(mismatch_ods_file_name, kdSU_name_map, kdSU_kdIG_kdIT_map, mismatch_rate=0.3)
+        designer = serve_study_designer([], {'match@1': ods_file_name, 'mismatch@1': mismatch_ods_file_name})
+        designer.__enter__()
+        self.addCleanup(designer.__exit__, None, None, None)
+
+    def check(self, design_id):
+        return main.run_pn_metadata_check(self.pn_metadata_file_name, interactive=False, design_id=design_id, history_database_file_name="history.sqlite")
+
+    def query(self, command, argument=None):
+        """
+        returns the (header, rows) a --query prints.
+        """
+        with mock.patch.object(main, 'print_history_rows') as print_history_rows:
+            self.assertTrue(main.query_mismatch_history(command, argument, "history.sqlite"))
+        return print_history_rows.call_args[0]
+
+    def test_queries(self):
+        mismatch_levels = self.check('mismatch@1')
+        self.assertEqual(self.check('match@1'), [])
+        self.assertEqual(self.check('mismatch@1'), mismatch_levels)
+        self.assertFalse(os.path.exists(main.history_database_file_name))
+        levels = dict((level['level'], level) for level in main.check_pn_metadata_json(self.pn_metadata_file_name, 'mismatch@1')['results'][0]['levels'])
+        study = os.path.basename(self.pn_metadata_file_name)
+
+        header, rows = self.query("runs")
+        mismatch_count = sum(len(level['left_only']) + len(level['right_only']) for level in levels.values())
+        self.assertEqual([(row[0], row[1], row[3], row[5]) for row in rows], [(1, study, 'mismatch@1', mismatch_count), (2, study, 'match@1', 0), (3, study, 'mismatch@1', mismatch_count)])
+        self.assertEqual(self.query("runs", "other.xml")[1], [])
+
+        header, rows = self.query("current")
+        self.assertEqual([(row[0], row[2], row[4], row[5], row[6]) for row in rows],
+                         sorted((study, 'mismatch@1', level, len(levels[level]['left_only']), len(levels[level]['right_only'])) for level in mismatch_levels))
+        self.assertEqual([row[4] for row in self.query("current", "kdsu_su_id")[1]], ['kdsu_su_id'] if 'kdsu_su_id' in mismatch_levels else [])
+
+        key = (levels['kdsu_su_id']['left_only'] or levels['kdsu_su_id']['right_only'])[0]
+        header, rows = self.query("first-diverged", key)
+        self.assertEqual([(row[0], row[2], row[4], row[7], row[8]) for row in rows], [(study, 'kdsu_su_id', key, 2, 'yes')])
+        self.check('match@1')
+        self.assertEqual(self.query("first-diverged", key)[1][0][8], 'no')
+        self.assertEqual(self.query("current")[1], [])
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertFalse(main.query_mismatch_history("latest", None, "history.sqlite"))
+
+    def test_cli_uses_history_db(self):
+        self.check('mismatch@1')
+        output = subprocess.run([sys.executable, os.path.join(repository_directory, "main.py"), "--query", "runs", "--history-db", "history.sqlite"],
+                                capture_output=True, text=True, check=True).stdout
+        self.assertIn("mismatch@1", output)
+        self.assertTrue(output.rstrip().endswith("(1 rows)"))
+
+# ---------------------------------------- batch
+
+
+class BatchTest(CheckTestCase):
+
+    def test_summary(self):
+        pn_metadata_file_name, ods_file_name, protocol = self.generate_study()
+        mismatch_file_name, mismatch_ods_file_name, mismatch_protocol = self.generate_study(scale=0.4, mismatch_rate=0.2)
+        os.makedirs("batch")
+        shutil.copy(pn_metadata_file_name, "batch/match.xml")
+        shutil.copy(mismatch_file_name, "batch/mismatch.xml")
+        with open("batch/broken.xml", 'w') as f:
+            f.write("<ODM><Study")
+        designs = [{'protocol': [protocol], 'designId': 'match@1'}, {'protocol': [mismatch_protocol], 'designId': 'mismatch@1'}]
+
+        output = io.StringIO()
+        with serve_study_designer(designs, {'match@1': ods_file_name, 'mismatch@1': mismatch_ods_file_name}), contextlib.redirect_stdout(output):
+            all_passed = main.run_batch(["batch", "batch/match.xml"], workers=2, check_options={'history': False})
+
+        self.assertFalse(all_passed)
+        summary = output.getvalue().split("batch summary")[1].splitlines()[1:]
+        self.assertEqual([line.split()[:2] for line in summary], [['ERROR', 'batch/broken.xml'], ['PASS', 'batch/match.xml'], ['FAIL', 'batch/mismatch.xml']])
+        for name in ("match.xml", "mismatch.xml"):
+            self.assertTrue(os.path.exists(os.path.join("reports", "{}_report.txt".format(name))))
+
+    def test_refuses_files_sharing_a_name(self):
+        pn_metadata_file_name = self.generate_study(scale=0.2)[0]
+        for directory in ("one", "two"):
+            os.makedirs(directory)
+            shutil.copy(pn_metadata_file_name, os.path.join(directory, "study.xml"))
+
+        with self.assertRaisesRegex(ValueError, "study.xml: "):
+            main.run_batch(["one", "two"], workers=1)
+        # the same file reached twice is checked once.
+        self.assertEqual(main.collect_pn_metadata_file_names(["one", "one/study.xml", os.path.abspath("one/study.xml")]), ["one/study.xml"])
+        main.check_unique_report_names(main.collect_pn_metadata_file_names(["one", "one/study.xml"]))
+
+# ---------------------------------------- job queue
+
+
+class JobQueueTest(CheckTestCase):
+
+    def jobs(self, connection):
+        return connection.execute("SELECT job_id, state, attempts, worker, error FROM jobs ORDER BY job_id").fetchall()
+
+    def expire_lease(self, connection, job_id):
+        connection.execute("UPDATE jobs SET lease_expires = ? WHERE job_id = ?", (time.time() - 1, job_id))
+
+    def test_claim_lease_expiry_and_retry(self):
+        for name in ("one.xml", "two.xml", "three.xml"):
+            open(name, 'w').close()
+        self.assertEqual(main.enqueue_jobs("queue.sqlite", ["one.xml", "two.xml", "three.xml"]), 3)
+        os.makedirs("other")
+        open("other/one.xml", 'w').close()
+        with self.assertRaisesRegex(ValueError, "one.xml: "):
+            main.enqueue_jobs("queue.sqlite", ["other/one.xml"])
+
+        connection = main.connect_job_queue("queue.sqlite")
+        self.addCleanup(connection.close)
+        self.assertEqual(len(self.jobs(connection)), 3)
+        self.assertEqual(main.claim_job(connection, "w1"), (1, os.path.abspath("one.xml"), None))
+        self.assertEqual(main.claim_job(connection, "w2")[0], 2)
+        self.assertEqual(main.claim_job(connection, "w3")[0], 3)
+        self.assertIsNone(main.claim_job(connection, "w4"))
+
+        # an expired lease goes to the next worker, and the late outcome of the first one is dropped.
+        self.expire_lease(connection, 1)
+        self.assertEqual(main.claim_job(connection, "w4")[0], 1)
+        self.assertFalse(main.finish_job(connection, 1, "w1", [], None))
+        self.assertTrue(main.finish_job(connection, 1, "w4", ["kdsu_su_id"], None))
+        self.assertTrue(main.finish_job(connection, 2, "w2", [], None))
+
+        # a failed attempt is retried until job_max_attempts, so is an expired one.
+        self.assertTrue(main.finish_job(connection, 3, "w3", None, "OSError: busy"))
+        self.assertEqual(main.claim_job(connection, "w5")[0], 3)
+        self.expire_lease(connection, 3)
+        self.assertEqual(main.claim_job(connection, "w6")[0], 3)
+        self.expire_lease(connection, 3)
+        self.assertIsNone(main.claim_job(connection, "w7"))
+        self.assertEqual(self.jobs(connection), [(1, 'failed', 2, 'w4', None), (2, 'passed', 1, 'w2', None), (3, 'error', 3, 'w6', 'lease expired on every attempt')])
+
+        self.assertEqual(main.print_job_queue_progress("queue.sqlite"), {'failed': 1, 'passed': 1, 'error': 1})
+
+    def test_worker_drains_queue(self):
+        pn_metadata_file_name, ods_file_name, protocol = self.generate_study()
+        mismatch_file_name, mismatch_ods_file_name, mismatch_protocol = self.generate_study(scale=0.4, mismatch_rate=0.2)
+        with open("broken.xml", 'w') as f:
+            f.write("<ODM><Study")
+        main.enqueue_jobs("queue.sqlite", [pn_metadata_file_name, mismatch_file_name, "broken.xml"])
+        main.enqueue_jobs("queue.sqlite", [pn_metadata_file_name], design_id='mismatch@1')
+
+        designs = [{'protocol': [protocol], 'designId': 'match@1'}, {'protocol': [mismatch_protocol], 'designId': 'mismatch@1'}]
+        with serve_study_designer(designs, {'match@1': ods_file_name, 'mismatch@1': mismatch_ods_file_name}):
+            self.assertEqual(main.run_queue_worker("queue.sqlite", "out", {'history': False}, "w"), 4 + main.job_max_attempts - 1)
+
+        self.assertEqual(os.getcwd(), os.path.join(self.directory, "out"))
+        connection = main.connect_job_queue(os.path.join(self.directory, "queue.sqlite"))
+        self.addCleanup(connection.close)
+        self.assertEqual([row[1:3] for row in self.jobs(connection)], [('passed', 1), ('failed', 1), ('error', main.job_max_attempts), ('failed', 1)])
+        self.assertTrue(os.path.exists(os.path.join("reports", "{}_report.txt".format(os.path.basename(mismatch_file_name)))))
+
+# ---------------------------------------- service
+
+
+class ServiceTest(CheckTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.pn_metadata_file_name, ods_file_name, protocol = self.generate_study(mismatch_rate=0.1)
+        exports = {'p@1': ods_file_name, 'bad@1': self.write_export('{"questionnaires": 3}')}
+        designer = serve_study_designer([{'protocol': [protocol], 'designId': 'p@1'}], exports)
+        designer.__enter__()
+        self.addCleanup(designer.__exit__, None, None, None)
+
+        server = main.create_check_server(('127.0.0.1', 0), {'use_cache': True})
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.url = "http://127.0.0.1:{}".format(server.server_address[1])
+
+    def request(self, path, data=None, content_type=None, method='POST'):
+        """
+        returns (status, json body) of one request to the check server.
+        """
+        request = urllib.request.Request(self.url + path, data=data, method=method)
+        if content_type is not None:
+            request.add_header('Content-Type', content_type)
+        try:
+            with urllib.request.urlopen(request, timeout=60) as response:
+                return response.status, json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            with e:
+                return e.code, json.loads(e.read())
+
+    def test_health(self):
+        self.assertEqual(self.request('/health', method='GET'), (200, {'status': 'ok', 'version': main.__version__}))
+        self.assertEqual(self.request('/nope', method='GET')[0], 404)
+
+    def test_check(self):
+        expected = main.check_pn_metadata_json(self.pn_metadata_file_name, use_cache=False)
+        self.assertTrue(expected['mismatch'])
+
+        with open(self.pn_metadata_file_name, 'rb') as f:
+            upload = f.read()
+        path_query = '/check?path={}'.format(urllib.request.quote(self.pn_metadata_file_name))
+        self.assertEqual(self.request(path_query), (200, expected))
+        self.assertEqual(self.request('/check', upload, 'application/xml'), (200, expected))
+        self.assertEqual(self.request('/check', json.dumps({'path': self.pn_metadata_file_name, 'design_id': 'p@1'}).encode('utf8'), 'application/json'),
+                         (200, dict(expected, results=[dict(expected['results'][0], protocol=None)])))
+
+    def send_content_length(self, content_length, content_type):
+        """
+        returns (status, json body) of a POST /check announcing content_length, which http.client would not send as is.
+        """
+        connection = http.client.HTTPConnection(self.url.split('//')[1], timeout=10)
+        try:
+            connection.putrequest('POST', '/check')
+            connection.putheader('Content-Type', content_type)
+            connection.putheader('Content-Length', content_length)
+            connection.endheaders()
+            response = connection.getresponse()
+            return response.status, json.loads(response.read())
+        finally:
+            connection.close()
+
+    def test_invalid_content_length(self):
+        for content_length in ('abc', '-5', '1e3'):
+            for content_type in ('application/json', 'application/xml'):
+                with self.subTest(content_length=content_length, content_type=content_type):
+                    self.assertEqual(self.send_content_length(content_length, content_type), (400, {'error': "invalid Content-Length {}".format(content_length)}))
+        self.assertEqual(self.request('/health', method='GET')[0], 200)
+
+    def test_errors(self):
+        status, body = self.request('/check')
+        self.assertEqual(status, 400)
+        status, body = self.request('/check', b'{not json', 'application/json')
+        self.assertEqual(status, 400)
+        status, body = self.request('/nope')
+        self.assertEqual(status, 404)
+        status, body = self.request('/check?path={}'.format(urllib.request.quote(os.path.join(self.directory, "missing.xml"))))
+        self.assertEqual(status, 404)
+        status, body = self.request('/check?path={}&design_id=missing@1'.format(urllib.request.quote(self.pn_metadata_file_name)))
+        self.assertEqual((status, body), (404, {'error': "study designer has no design missing@1"}))
+
+        # a malformed export is the study designer's fault, and the server keeps answering after it.
+        status, body = self.request('/check?path={}&design_id=bad@1'.format(urllib.request.quote(self.pn_metadata_file_name)))
+        self.assertEqual(status, 502)
+        self.assertIn("bad study designer response for design bad@1", body['error'])
+        self.assertEqual(self.request('/health', method='GET')[0], 200)
+
+
+if __name__ == '__main__':
+    unittest.main()